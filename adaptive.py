@@ -0,0 +1,113 @@
+"""
+Adaptive campaigns.
+
+Instead of asking every term times_per_term times up front, an adaptive
+campaign is published in rounds. The first round asks each term just often
+enough that it could pass the campaign's threshold. Once every page of a
+round has come back, the terms that are still inconclusive are packed into
+new pages for another round, each asking for as many more answers as the
+term could still need. Rounds stop when every term is decided or has had
+times_per_term answers, or when the next page would go over the campaign's
+budget.
+"""
+from models import db, Campaign, CampaignPage, CampaignTerm
+
+from itertools import groupby
+
+import math
+import numpy
+
+def required_votes(campaign):
+    """
+    The fewest votes that can take a term past the campaign's threshold
+    under majority voting.
+    """
+    needed = int(math.ceil((math.floor(campaign.get_threshold()) + 1) *
+                           campaign.times_per_term / 100.0))
+    return max(1, min(campaign.times_per_term, needed))
+
+def votes_needed(campaign):
+    """
+    How many more answers each undecided term should be asked for in the
+    next round, as {term_id: answers}. Terms that are decided, or that have
+    already had times_per_term answers, are left out.
+    """
+    results = campaign.get_results()
+    received = results.counts.sum(axis=1)
+    best = results.counts.max(axis=1) if results.counts.shape[1] else received
+    more = numpy.clip(required_votes(campaign) - best, 1,
+                      numpy.maximum(campaign.times_per_term - received, 1))
+
+    undecided = results.inconclusive() & (received < campaign.times_per_term)
+    return dict((results.termids[row], int(more[row])) for row in numpy.flatnonzero(undecided))
+
+def plan_round(campaign):
+    """
+    The pages for the campaign's next round, as a list of
+    (page number, assignments, [(term_id, term), ...]).
+
+    Terms needing the same number of answers share pages. Terms already on
+    a page of this round (from an interrupted run) or reused from an 
+    earlier campaign are skipped, and pages are dropped once the campaign's
+    budget would be exceeded.
+    """
+    roundnum = campaign.rounds_published or 0
+    if roundnum == 0:
+        needs = dict((termid, required_votes(campaign)) for termid, in
+                     db.session.query(CampaignTerm.id)
+                               .filter(CampaignTerm.campaign_id == campaign.id)
+                               .filter(CampaignTerm.reused_from == None))
+    else:
+        needs = votes_needed(campaign)
+
+    asked = set()
+    for term_ids, in db.session.query(CampaignPage.term_ids) \
+                               .filter(CampaignPage.campaign_id == campaign.id) \
+                               .filter(CampaignPage.round == roundnum):
+        asked.update(int(termid) for termid in (term_ids or "").split(",") if termid)
+    for termid in asked:
+        needs.pop(termid, None)
+    if not needs:
+        return []
+
+    terms = dict(db.session.query(CampaignTerm.id, CampaignTerm.term)
+                           .filter(CampaignTerm.campaign_id == campaign.id))
+
+    lastpage = db.session.query(db.func.max(CampaignPage.page_number)) \
+                         .filter(CampaignPage.campaign_id == campaign.id) \
+                         .scalar()
+    pagenum = 0 if lastpage is None else lastpage + 1
+
+    remaining = None
+    if campaign.budget is not None:
+        remaining = float(campaign.budget) - campaign.spent()
+    reward = float(campaign.reward_per_quiz)
+
+    # Cheapest terms to settle first, so a tight budget decides as many as it can
+    pages = []
+    ordered = sorted(needs, key=lambda termid: (needs[termid], termid))
+    for assignments, group in groupby(ordered, key=needs.get):
+        group = list(group)
+        for start in xrange(0, len(group), campaign.terms_per_quiz):
+            if remaining is not None:
+                if assignments * reward > remaining + 1e-9:
+                    return pages
+                remaining -= assignments * reward
+            chunk = group[start:start + campaign.terms_per_quiz]
+            pages.append((pagenum, assignments, [(termid, terms[termid]) for termid in chunk]))
+            pagenum += 1
+    return pages
+
+def campaigns_ready():
+    """
+    Ids of the adaptive campaigns that are waiting on a new round: every
+    page published so far has come back, and they haven't finished.
+    """
+    incomplete = db.session.query(CampaignPage.campaign_id) \
+                           .filter(CampaignPage.completed == False)
+    ready = db.session.query(Campaign.id) \
+                      .filter(Campaign.adaptive == True) \
+                      .filter(Campaign.job_generated == True) \
+                      .filter(db.func.coalesce(Campaign.finished, False) == False) \
+                      .filter(~Campaign.id.in_(incomplete))
+    return [campaignid for campaignid, in ready]
@@ -0,0 +1,102 @@
+"""
+Answer aggregation strategies.
+
+Each strategy turns a campaign's answers into a score from 0 to 100 for
+every term/option pair; the option with the best score is the term's answer
+if that score is over the campaign's threshold. Strategies take:
+
+    counts          - an array of vote counts, one row per term and one
+                      column per option
+    answers         - (rows, columns, workers): parallel arrays with the
+                      term row, option column and worker number of every
+                      individual answer
+    times_per_term  - how many answers each term was meant to get
+
+and work on the whole campaign at once.
+"""
+import numpy
+
+def majority(counts, answers, times_per_term):
+    """
+    The share of the requested answers that went to each option. A term
+    only passes the threshold once enough of its answers agree.
+    """
+    return counts * 100 // max(times_per_term, 1)
+
+def worker_weighted(counts, answers, times_per_term):
+    """
+    Weight every vote by how often its worker agrees with the majority
+    answer across the campaign, so careless workers count for less. Terms
+    that haven't had all their answers yet are scaled down accordingly.
+    """
+    rows, columns, workers = answers
+    if not len(rows) or not counts.shape[1]:
+        return majority(counts, answers, times_per_term)
+
+    winners = counts.argmax(axis=1)
+    agreed = numpy.bincount(workers, weights=(columns == winners[rows]))
+    answered = numpy.bincount(workers)
+    weights = (agreed + 1) / (answered + 2.0)
+
+    weighted = numpy.zeros(counts.shape)
+    numpy.add.at(weighted, (rows, columns), weights[workers])
+    totals = weighted.sum(axis=1)[:, numpy.newaxis]
+    completeness = numpy.minimum(counts.sum(axis=1) / float(max(times_per_term, 1)), 1.0)
+
+    shares = weighted / numpy.maximum(totals, 1e-12)
+    return shares * completeness[:, numpy.newaxis] * 100
+
+def dawid_skene(counts, answers, times_per_term, iterations=50, tolerance=1e-4):
+    """
+    Estimate how reliable each worker is (a confusion matrix per worker)
+    together with the probability of each answer for every term, by
+    expectation-maximisation starting from the vote shares. The score is
+    that probability, so answers from workers who are usually right can
+    pass the threshold with fewer votes.
+    """
+    rows, columns, workers = answers
+    nterms, noptions = counts.shape
+    if not len(rows) or not noptions:
+        return majority(counts, answers, times_per_term)
+    nworkers = workers.max() + 1
+
+    votes = counts.sum(axis=1)
+    answered = votes > 0
+    posterior = counts / numpy.maximum(votes, 1).astype(float)[:, numpy.newaxis]
+
+    for iteration in xrange(iterations):
+        # M-step: answer priors and each worker's confusion matrix,
+        # confusion[worker, true option, given option]
+        priors = (posterior[answered].sum(axis=0) + 1) / (answered.sum() + noptions)
+        confusion = numpy.zeros((nworkers * noptions, noptions))
+        numpy.add.at(confusion, workers * noptions + columns, posterior[rows])
+        confusion = confusion.reshape(nworkers, noptions, noptions).transpose(0, 2, 1) + 1
+        confusion /= confusion.sum(axis=2)[:, :, numpy.newaxis]
+
+        # E-step: probability of each true answer given everyone's votes
+        logposterior = numpy.tile(numpy.log(priors), (nterms, 1))
+        numpy.add.at(logposterior, rows, numpy.log(confusion)[workers, :, columns])
+        logposterior -= logposterior.max(axis=1)[:, numpy.newaxis]
+        estimate = numpy.exp(logposterior)
+        estimate /= estimate.sum(axis=1)[:, numpy.newaxis]
+        estimate[~answered] = 0
+
+        change = numpy.abs(estimate - posterior).max()
+        posterior = estimate
+        if change < tolerance:
+            break
+
+    return posterior * 100
+
+strategies = {
+    'majority': majority,
+    'weighted': worker_weighted,
+    'dawid_skene': dawid_skene,
+}
+
+# For the campaign forms, in the order they're offered
+choices = [
+    ('majority', 'Majority vote'),
+    ('weighted', 'Votes weighted by worker agreement'),
+    ('dawid_skene', 'Estimated worker reliability (Dawid-Skene)'),
+]
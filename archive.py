@@ -0,0 +1,128 @@
+"""
+Archives of finished campaigns' answers and tallies.
+
+Archiving a campaign (see Campaign.archive) writes its answers and tallies
+to ARCHIVE_DIR/campaign-<id>.npz, a compressed numpy file holding one array
+per column, and deletes those rows from the database, which keeps the
+answer and tally tables (and their indexes) down to the campaigns still
+running. The campaign itself, its options and its terms stay, and its
+results are read back from the archive, so the campaign page and the
+downloads work as before.
+
+This module only reads and writes the files; it doesn't touch the database.
+"""
+from collections import OrderedDict
+
+import numpy
+import os
+import settings
+import threading
+
+ARCHIVE_DIR = getattr(settings, 'ARCHIVE_DIR',
+                      os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+# Archives kept loaded, so paging through an archived campaign doesn't
+# decompress its file for every slice
+LOADED_ARCHIVES = 4
+
+ANSWER_COLUMNS = ['id', 'hit', 'worker', 'term_id', 'option_id', 'excluded']
+TALLY_COLUMNS = ['term_id', 'option_id', 'votes']
+
+_loaded = OrderedDict()
+_lock = threading.Lock()
+
+def archive_path(campaignid):
+    return os.path.join(ARCHIVE_DIR, "campaign-%s.npz" % int(campaignid))
+
+def write(campaignid, answers, tallies):
+    """
+    Write a campaign's archive. <answers> and <tallies> are lists of rows
+    with ANSWER_COLUMNS and TALLY_COLUMNS. The file is written under a
+    temporary name and moved into place, so a half-written archive is never
+    read. Returns its path.
+    """
+    if not os.path.isdir(ARCHIVE_DIR):
+        os.makedirs(ARCHIVE_DIR)
+    arrays = {}
+    for prefix, columns, rows in (('answer_', ANSWER_COLUMNS, answers),
+                                  ('tally_', TALLY_COLUMNS, tallies)):
+        values = zip(*rows) if rows else [()] * len(columns)
+        for column, value in zip(columns, values):
+            if column in ('hit', 'worker'):
+                array = numpy.array(value, dtype=unicode)
+            elif column == 'excluded':
+                array = numpy.array([bool(item) for item in value], dtype=bool)
+            else:
+                array = numpy.array(value, dtype=numpy.int64)
+            arrays[prefix + column] = array
+
+    path = archive_path(campaignid)
+    temporary = path + ".tmp"
+    with open(temporary, 'wb') as out:
+        numpy.savez_compressed(out, **arrays)
+    os.rename(temporary, path)
+    forget(campaignid)
+    return path
+
+def load(campaignid):
+    """
+    {array name: array} of a campaign's archive.
+    """
+    path = archive_path(campaignid)
+    modified = os.path.getmtime(path)
+    with _lock:
+        entry = _loaded.pop(campaignid, None)
+        if entry is not None and entry[0] == modified:
+            _loaded[campaignid] = entry
+            return entry[1]
+
+    archive = numpy.load(path)
+    try:
+        arrays = dict((name, archive[name]) for name in archive.files)
+    finally:
+        archive.close()
+    with _lock:
+        _loaded[campaignid] = (modified, arrays)
+        while len(_loaded) > LOADED_ARCHIVES:
+            _loaded.popitem(last=False)
+    return arrays
+
+def forget(campaignid):
+    with _lock:
+        _loaded.pop(campaignid, None)
+
+def read_tallies(campaignid, termids=None, first=None, last=None):
+    """
+    (term_id, option_id, votes) rows from a campaign's archive: every one,
+    those of <termids>, or those of the terms with ids from <first> to <last>.
+    """
+    arrays = load(campaignid)
+    terms, options, votes = arrays['tally_term_id'], arrays['tally_option_id'], arrays['tally_votes']
+    keep = numpy.ones(len(terms), dtype=bool)
+    if termids is not None:
+        keep &= numpy.in1d(terms, numpy.asarray(list(termids), dtype=numpy.int64))
+    if first is not None:
+        keep &= terms >= first
+    if last is not None:
+        keep &= terms <= last
+    return zip(terms[keep].tolist(), options[keep].tolist(), votes[keep].tolist())
+
+def read_answers(campaignid, include_excluded=False):
+    """
+    (id, worker, term_id, option_id) for the answers in a campaign's
+    archive, in id order, leaving out excluded ones unless asked for.
+    """
+    arrays = load(campaignid)
+    keep = numpy.ones(len(arrays['answer_id']), dtype=bool)
+    if not include_excluded:
+        keep = ~arrays['answer_excluded']
+    return zip(arrays['answer_id'][keep].tolist(), arrays['answer_worker'][keep].tolist(),
+               arrays['answer_term_id'][keep].tolist(), arrays['answer_option_id'][keep].tolist())
+
+def remove(campaignid):
+    """
+    Delete a campaign's archive, if it has one.
+    """
+    forget(campaignid)
+    path = archive_path(campaignid)
+    if os.path.exists(path):
+        os.remove(path)
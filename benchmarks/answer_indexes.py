@@ -0,0 +1,116 @@
+"""
+Benchmark the answer lookups with and without the CampaignAnswer indexes.
+
+    python benchmarks/answer_indexes.py [--answers 2000000] [--campaigns 20]
+
+Builds a synthetic SQLite database of answers spread over several campaigns,
+times the tally, per-cell count and ingest duplicate lookups with the 
+indexes dropped, then creates the indexes and times the same lookups again.
+"""
+from optparse import OptionParser
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import settings
+settings.DATABASE_URI = 'sqlite:///' + tempfile.mktemp(suffix='.db')
+
+from main import create_app
+from models import db, CampaignAnswer
+
+def build(numanswers, numcampaigns, terms_per_campaign, workers_per_term):
+    """
+    Insert <numanswers> synthetic answers, returning the HIT ids used.
+    """
+    table = CampaignAnswer.__table__
+    hits = []
+    batch = []
+    made = 0
+    termid = 0
+    while made < numanswers:
+        campaignid = (termid // terms_per_campaign) % numcampaigns + 1
+        hit = "HIT%08d" % (termid // 10)
+        if not hits or hits[-1] != hit:
+            hits.append(hit)
+        for worker in range(workers_per_term):
+            batch.append({'hit': hit, 'worker': "WORKER%04d" % random.randint(0, 5000) + str(worker),
+                          'campaign_id': campaignid, 'term_id': termid, 'option_id': random.randint(1, 5)})
+        made += workers_per_term
+        termid += 1
+        if len(batch) >= 10000:
+            db.engine.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.engine.execute(table.insert(), batch)
+    return hits
+
+def timed(label, func, repeat):
+    started = time.time()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.time() - started) / repeat
+    print "  %-40s %9.2f ms" % (label, elapsed * 1000)
+    return elapsed
+
+def run_lookups(terms_per_campaign, hits):
+    conn = db.engine.connect()
+    results = []
+    campaignid = 1
+    results.append(timed("tally for one campaign (GROUP BY)",
+                         lambda: conn.execute("SELECT term_id, option_id, COUNT(id) FROM campaign_answer "
+                                              "WHERE campaign_id = ? GROUP BY term_id, option_id",
+                                              campaignid).fetchall(), 3))
+    termid = random.randint(0, terms_per_campaign - 1)
+    results.append(timed("count for one term/option",
+                         lambda: conn.execute("SELECT COUNT(id) FROM campaign_answer "
+                                              "WHERE campaign_id = ? AND term_id = ? AND option_id = ?",
+                                              campaignid, termid, 3).scalar(), 10))
+    page = random.sample(hits, 100)
+    results.append(timed("ingest duplicate check (100 HITs)",
+                         lambda: conn.execute("SELECT hit, worker, term_id FROM campaign_answer "
+                                              "WHERE hit IN (%s)" % ", ".join("?" * len(page)),
+                                              *page).fetchall(), 10))
+    results.append(timed("answers by one worker",
+                         lambda: conn.execute("SELECT COUNT(id) FROM campaign_answer WHERE worker = ?",
+                                              "WORKER00420").scalar(), 10))
+    conn.close()
+    return results
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--answers", type="int", default=2000000)
+    parser.add_option("--campaigns", type="int", default=20)
+    parser.add_option("--terms-per-campaign", type="int", default=20000)
+    parser.add_option("--workers-per-term", type="int", default=5)
+    opts, _ = parser.parse_args()
+
+    db.create_all()
+    for index in CampaignAnswer.__table__.indexes:
+        index.drop(db.engine)
+
+    started = time.time()
+    hits = build(opts.answers, opts.campaigns, opts.terms_per_campaign, opts.workers_per_term)
+    print "Built %s answers in %.1fs (%s)" % (opts.answers, time.time() - started, settings.DATABASE_URI)
+
+    print "Without indexes:"
+    before = run_lookups(opts.terms_per_campaign, hits)
+
+    started = time.time()
+    for index in CampaignAnswer.__table__.indexes:
+        index.create(db.engine)
+    print "Created indexes in %.1fs" % (time.time() - started)
+
+    print "With indexes:"
+    after = run_lookups(opts.terms_per_campaign, hits)
+
+    print "Speedup: %s" % ", ".join("%.0fx" % (b / max(a, 1e-6)) for b, a in zip(before, after))
+    os.remove(settings.DATABASE_URI[len('sqlite:///'):])
+
+if __name__ == '__main__':
+    create_app()
+    main()
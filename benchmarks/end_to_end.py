@@ -0,0 +1,162 @@
+"""
+End-to-end throughput benchmark against the MTurk simulator.
+
+    python benchmarks/end_to_end.py [--scales 1k,100k,1m] [--latency 0] [--workers 8]
+                                    [--save results.json] [--compare baseline.json]
+
+For each scale (the number of answers collected), a fresh SQLite database
+is used to time:
+
+    create   - creating the campaign and loading its terms
+    publish  - publishing its HITs to the simulator
+    ingest   - fetching, storing and approving every answer
+    tally    - recounting the tallies from the raw answers, and building
+               the results shown on the campaign page
+    export   - streaming the .csv and .json downloads
+
+The simulator's answers are seeded, so runs of different versions do the
+same work. --save writes the timings as JSON; --compare prints each timing
+next to the ones saved from an earlier run.
+"""
+from optparse import OptionParser
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import settings
+settings.DATABASE_URI = 'sqlite:///' + tempfile.mktemp(suffix='.db')
+
+from main import create_app
+from models import db, Campaign
+from export import export_results
+from loader import create_campaign
+from simulator import MTurkSimulator
+
+import mturk
+
+STAGES = ['create', 'publish', 'ingest', 'tally', 'export']
+
+def parse_scale(scale):
+    """
+    "1k" -> 1000, "1m" -> 1000000.
+    """
+    multipliers = {'k': 1000, 'm': 1000000}
+    scale = scale.strip().lower()
+    if scale[-1] in multipliers:
+        return int(float(scale[:-1]) * multipliers[scale[-1]])
+    return int(scale)
+
+def revision():
+    """
+    The git revision being benchmarked, if there is one.
+    """
+    try:
+        return subprocess.Popen(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0].strip()
+    except OSError:
+        return None
+
+def timed(timings, stage, func, *args, **kwargs):
+    started = time.time()
+    result = func(*args, **kwargs)
+    timings[stage] = timings.get(stage, 0) + time.time() - started
+    return result
+
+def consume(stream):
+    return sum(len(chunk) for chunk in stream)
+
+def run(numanswers, opts):
+    """
+    Run every stage for a campaign that collects <numanswers> answers.
+    Returns {stage: seconds}.
+    """
+    db.drop_all()
+    db.create_all()
+    numterms = max(numanswers // opts.times_per_term, 1)
+    simulator = MTurkSimulator(workers=max(opts.times_per_term * 4, 20), accuracy=0.85,
+                               latency=opts.latency, seed=1)
+
+    timings = {}
+    terms = (u"term %s" % num for num in xrange(numterms))
+    campaign = timed(timings, 'create', create_campaign, u"benchmark", u"Is [term] a vegetable?",
+                     opts.terms_per_quiz, 0.05, opts.times_per_term, u"yes\nno\nmaybe", terms)
+    campaignid = campaign.id
+
+    failures = timed(timings, 'publish', mturk.create_campaign_hits, campaignid,
+                     connection_factory=simulator, workers=opts.workers)
+    if failures:
+        raise RuntimeError("%s pages could not be published" % failures)
+    timed(timings, 'ingest', mturk.retrieve_reviewable_hits,
+          connection_factory=simulator, workers=opts.workers)
+    db.session.remove()
+
+    campaign = Campaign.query.get(campaignid)
+    timed(timings, 'tally', campaign.rebuild_tally)
+    db.session.commit()
+    campaign = Campaign.query.get(campaignid)
+    timed(timings, 'tally', campaign.get_results)
+
+    for filetype in ('csv', 'json'):
+        stream, mimetype = export_results(campaign, filetype)
+        timed(timings, 'export', consume, stream)
+
+    answers = Campaign.query.get(campaignid).answer_count
+    if answers != numterms * opts.times_per_term:
+        raise RuntimeError("Expected %s answers, stored %s" % (numterms * opts.times_per_term, answers))
+    db.session.remove()
+    return timings
+
+def main():
+    parser = OptionParser(usage="python benchmarks/end_to_end.py [options]")
+    parser.add_option("--scales", default="1k,100k,1m", help="answers collected, e.g. 1k,100k,1m")
+    parser.add_option("--latency", type="float", default=0.0, help="seconds per simulated MTurk call")
+    parser.add_option("--workers", type="int", default=8, help="threads used to publish and fetch")
+    parser.add_option("--rate", type="float", default=0, 
+                      help="HIT creation calls per second, 0 for no limit")
+    parser.add_option("--terms-per-quiz", type="int", default=10)
+    parser.add_option("--times-per-term", type="int", default=3)
+    parser.add_option("--save", metavar="FILE", help="write the timings to FILE as JSON")
+    parser.add_option("--compare", metavar="FILE", help="compare with timings saved earlier")
+    opts, _ = parser.parse_args()
+    mturk.REQUESTS_PER_SECOND = opts.rate
+
+    baseline = {}
+    if opts.compare:
+        with open(opts.compare) as saved:
+            baseline = json.load(saved)['scales']
+
+    report = {'revision': revision(), 'latency': opts.latency, 'workers': opts.workers, 'rate': opts.rate,
+              'terms_per_quiz': opts.terms_per_quiz, 'times_per_term': opts.times_per_term,
+              'scales': {}}
+    print "%-8s %s" % ("answers", " ".join("%17s" % stage for stage in STAGES))
+    for scale in opts.scales.split(","):
+        numanswers = parse_scale(scale)
+        timings = run(numanswers, opts)
+        report['scales'][str(numanswers)] = timings
+
+        columns = []
+        for stage in STAGES:
+            column = "%8.2fs" % timings[stage]
+            before = baseline.get(str(numanswers), {}).get(stage)
+            if before:
+                column += " (%4.2fx)" % (before / max(timings[stage], 1e-6))
+            columns.append("%17s" % column)
+        print "%-8s %s" % (numanswers, " ".join(columns))
+        sys.stdout.flush()
+
+    if opts.compare:
+        print "(x = speedup over %s)" % opts.compare
+    if opts.save:
+        with open(opts.save, "w") as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    create_app()
+    main()
@@ -0,0 +1,126 @@
+"""
+Benchmark retrieve_reviewable_hits() against a stub MTurk connection.
+
+    python benchmarks/fetch_results.py [--hits 500] [--latency 0.05] [--workers 1,8,32]
+
+The stub answers every call after a fixed delay, standing in for the
+round trip to Mechanical Turk. A fresh SQLite database is used for each run.
+"""
+from optparse import OptionParser
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import settings
+settings.DATABASE_URI = 'sqlite:///' + tempfile.mktemp(suffix='.db')
+
+from main import create_app
+from models import db, Campaign, CampaignOption, CampaignTerm
+import mturk
+
+class ResultSet(list):
+    """
+    Stand-in for boto's ResultSet: a list with paging attributes.
+    """
+    def __init__(self, items, total):
+        list.__init__(self, items)
+        self.NumResults = str(len(items))
+        self.TotalNumResults = str(total)
+
+class Record(object):
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+class StubConnection(object):
+    """
+    Serves a fixed set of reviewable HITs, sleeping <latency> seconds per call.
+    <hits> maps HIT ids to lists of assignments.
+    """
+    def __init__(self, hits, latency):
+        self.hits = hits
+        self.hitids = sorted(hits)
+        self.latency = latency
+
+    def _page(self, items, page_size, page_number):
+        time.sleep(self.latency)
+        start = (page_number - 1) * page_size
+        return ResultSet(items[start:start + page_size], len(items))
+
+    def get_reviewable_hits(self, page_size=10, page_number=1):
+        return self._page([Record(HITId=hitid) for hitid in self.hitids], page_size, page_number)
+
+    def get_assignments(self, hitid, page_size=10, page_number=1):
+        return self._page(self.hits[hitid], page_size, page_number)
+
+    def approve_assignment(self, assignmentid, feedback=None):
+        time.sleep(self.latency)
+
+    def reject_assignment(self, assignmentid, feedback=None):
+        time.sleep(self.latency)
+
+    def block_worker(self, workerid, reason):
+        time.sleep(self.latency)
+
+    def dispose_hit(self, hitid):
+        time.sleep(self.latency)
+
+def build_hits(campaign, numhits, terms_per_quiz, times_per_term):
+    """
+    Build <numhits> HITs for <campaign>, each answered by <times_per_term> workers.
+    """
+    terms = CampaignTerm.query.filter_by(campaign_id=campaign.id).order_by(CampaignTerm.id).all()
+    options = CampaignOption.query.filter_by(campaign_id=campaign.id).all()
+
+    hits = {}
+    for hitnum in range(numhits):
+        hitid = "HIT%06d" % hitnum
+        page = terms[hitnum * terms_per_quiz:(hitnum + 1) * terms_per_quiz]
+        assignments = []
+        for worker in range(times_per_term):
+            fields = []
+            for i, term in enumerate(page):
+                option = options[(i + worker) % len(options)]
+                fields.append(("%s|%s|%s" % (campaign.id, term.id, term.term),
+                               "%s|%s" % (option.id, option.option_text)))
+            assignments.append(Record(AssignmentId="%s-%s" % (hitid, worker),
+                                      WorkerId="WORKER%03d" % worker,
+                                      answers=[[Record(fields=[field]) for field in fields]]))
+        hits[hitid] = assignments
+    return hits
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--hits", type="int", default=500)
+    parser.add_option("--latency", type="float", default=0.05)
+    parser.add_option("--workers", default="1,8,32")
+    parser.add_option("--terms-per-quiz", type="int", default=10)
+    parser.add_option("--times-per-term", type="int", default=3)
+    opts, _ = parser.parse_args()
+
+    for workers in [int(n) for n in opts.workers.split(",")]:
+        db.drop_all()
+        db.create_all()
+        campaign = Campaign("benchmark", "Is [term] a vegetable?", opts.terms_per_quiz, 0.05, opts.times_per_term)
+        db.session.add(campaign)
+        for text in ("yes", "no"):
+            db.session.add(CampaignOption(campaign, text))
+        for num in range(opts.hits * opts.terms_per_quiz):
+            db.session.add(CampaignTerm(campaign, "term%s" % num))
+        db.session.commit()
+
+        hits = build_hits(campaign, opts.hits, opts.terms_per_quiz, opts.times_per_term)
+        factory = lambda: StubConnection(hits, opts.latency)
+
+        started = time.time()
+        mturk.retrieve_reviewable_hits(connection_factory=factory, workers=workers)
+        elapsed = time.time() - started
+        print "%3d workers: %7.2fs for %s HITs (%s answers)" % (
+            workers, elapsed, opts.hits, opts.hits * opts.terms_per_quiz * opts.times_per_term)
+
+if __name__ == '__main__':
+    create_app()
+    main()
@@ -0,0 +1,219 @@
+"""
+Load test of the campaign pages under different ways of serving the app.
+
+    python benchmarks/load_test.py [--modes single,threaded,workers:4] [--concurrency 16]
+                                   [--duration 10] [--terms 2000] [--no-cache]
+                                   [--query-latency 0.002]
+    python benchmarks/load_test.py --url http://localhost:8000 --campaign 1
+
+Builds a campaign with answers (from the MTurk simulator) in a fresh SQLite
+database, then for each mode starts a server on it and has <concurrency>
+clients request the campaign list, the campaign page and its CSV download
+for <duration> seconds:
+
+    single        - one request at a time and a new database connection per
+                    query, the way main.py used to run
+    threaded      - a thread per request, with DB_POOL_SIZE connections kept
+    workers:N     - N worker processes sharing the listening socket, each
+                    with a thread per request (how gunicorn or uwsgi run 
+                    wsgi.py with --workers/--processes and --threads)
+
+With --url, an already running server (e.g. gunicorn serving wsgi.py) is
+tested instead. --no-cache turns the response cache off, so every request
+builds its page. --query-latency adds a delay to every SQL query, standing
+in for the round trip to a database server on another machine; SQLite on
+the same machine has none, so without it there is nothing for the threads
+to overlap and only extra CPUs help.
+"""
+from optparse import OptionParser, SUPPRESS_HELP
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import settings
+
+def build_database(path, numterms, times_per_term):
+    """
+    A campaign of <numterms> terms, each answered <times_per_term> times.
+    Returns the campaign id.
+    """
+    settings.DATABASE_URI = 'sqlite:///' + path
+
+    from main import create_app
+    from models import db
+    from loader import create_campaign
+    from simulator import MTurkSimulator
+    import mturk
+
+    create_app()
+    db.create_all()
+    simulator = MTurkSimulator(workers=20, accuracy=0.85, seed=1)
+    campaign = create_campaign(u"load test", u"Is [term] a vegetable?", 10, 0.05, times_per_term,
+                               u"yes\nno\nmaybe", (u"term %s" % num for num in xrange(numterms)))
+    campaignid = campaign.id
+    mturk.REQUESTS_PER_SECOND = 0
+    mturk.create_campaign_hits(campaignid, connection_factory=simulator)
+    mturk.retrieve_reviewable_hits(connection_factory=simulator)
+    db.session.remove()
+    return campaignid
+
+def serve(mode, port, path, cache, query_latency):
+    """
+    Run the app on <port> (in this process, until killed).
+    """
+    if query_latency:
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        def round_trip(*args):
+            time.sleep(query_latency)
+        event.listen(Engine, 'before_cursor_execute', round_trip)
+
+    settings.DATABASE_URI = 'sqlite:///' + path
+    settings.ACTION_LOG_ASYNC = True
+    if mode != 'single':
+        settings.DB_POOL_SIZE = getattr(settings, 'DB_POOL_SIZE', None) or 20
+    if not cache:
+        settings.RESPONSE_CACHE_SIZE = 0
+
+    from main import create_app
+    from werkzeug.serving import make_server
+
+    app = create_app()
+    server = make_server('127.0.0.1', port, app, threaded=(mode != 'single'))
+    server.socket.listen(128)
+    if mode.startswith('workers'):
+        # Fork the workers once the socket is listening; the database isn't
+        # connected to until the first request, so each gets its own pool
+        for _ in range(int(mode.split(':')[1]) - 1):
+            if os.fork() == 0:
+                break
+    server.serve_forever()
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib2.urlopen(url).read()
+            return
+        except Exception:
+            time.sleep(0.1)
+    raise RuntimeError("The server at %s didn't start" % url)
+
+def load(base, paths, concurrency, duration):
+    """
+    Request <paths> from <base> round-robin from <concurrency> threads for
+    <duration> seconds. Returns (requests, errors, sorted latencies).
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client(offset):
+        num = offset
+        while time.time() < deadline:
+            url = base + paths[num % len(paths)]
+            num += 1
+            started = time.time()
+            try:
+                urllib2.urlopen(url).read()
+                failed = False
+            except Exception:
+                failed = True
+            elapsed = time.time() - started
+            with lock:
+                if failed:
+                    errors[0] += 1
+                else:
+                    latencies.append(elapsed)
+
+    threads = [threading.Thread(target=client, args=(num,)) for num in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return len(latencies) + errors[0], errors[0], latencies
+
+def report(label, requests, errors, latencies, duration):
+    if latencies:
+        mean = sum(latencies) / len(latencies) * 1000
+        p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    else:
+        mean = p95 = 0
+    print "%-14s %8.1f %8.1f %8.1f %7s" % (label, requests / float(duration), mean, p95, errors)
+    sys.stdout.flush()
+
+def main():
+    parser = OptionParser(usage="python benchmarks/load_test.py [options]")
+    parser.add_option("--modes", default="single,threaded,workers:4")
+    parser.add_option("--concurrency", type="int", default=16, help="simultaneous clients")
+    parser.add_option("--duration", type="float", default=10, help="seconds per mode")
+    parser.add_option("--terms", type="int", default=2000)
+    parser.add_option("--times-per-term", type="int", default=3)
+    parser.add_option("--no-cache", action="store_true", default=False,
+                      help="turn the response cache off")
+    parser.add_option("--query-latency", type="float", default=0, 
+                      help="seconds added to every SQL query made by the server")
+    parser.add_option("--url", help="test a server that is already running")
+    parser.add_option("--campaign", type="int", default=1, help="campaign to request, with --url")
+    parser.add_option("--serve", help=SUPPRESS_HELP)
+    parser.add_option("--port", type="int", help=SUPPRESS_HELP)
+    parser.add_option("--database", help=SUPPRESS_HELP)
+    opts, _ = parser.parse_args()
+
+    if opts.serve:
+        serve(opts.serve, opts.port, opts.database, not opts.no_cache, opts.query_latency)
+        return
+
+    print "%-14s %8s %8s %8s %7s" % ("mode", "req/s", "mean ms", "p95 ms", "errors")
+    if opts.url:
+        paths = ["/campaigns", "/campaigns/%s" % opts.campaign, "/campaigns/%s.csv" % opts.campaign]
+        report(opts.url, *load(opts.url.rstrip("/"), paths, opts.concurrency, opts.duration),
+               duration=opts.duration)
+        return
+
+    path = tempfile.mktemp(suffix='.db')
+    campaignid = build_database(path, opts.terms, opts.times_per_term)
+    paths = ["/campaigns", "/campaigns/%s" % campaignid, "/campaigns/%s.csv" % campaignid]
+    try:
+        for mode in opts.modes.split(","):
+            port = free_port()
+            command = [sys.executable, os.path.abspath(__file__), "--serve", mode,
+                       "--port", str(port), "--database", path]
+            if opts.no_cache:
+                command.append("--no-cache")
+            if opts.query_latency:
+                command.extend(["--query-latency", str(opts.query_latency)])
+            with open(os.devnull, "w") as devnull:
+                server = subprocess.Popen(command, stdout=devnull, stderr=devnull, preexec_fn=os.setsid)
+            try:
+                base = "http://127.0.0.1:%s" % port
+                wait_for(base + paths[0])
+                report(mode, *load(base, paths, opts.concurrency, opts.duration),
+                       duration=opts.duration)
+            finally:
+                # The server and any workers it forked
+                os.killpg(server.pid, signal.SIGTERM)
+                server.wait()
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    main()
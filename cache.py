@@ -0,0 +1,165 @@
+"""
+Caching the campaign page and result downloads.
+
+Every campaign has a results version that goes up whenever its answers,
+tallies or terms change. The ETag of a cached page or download is made from
+that version (and anything else it shows), so:
+
+    * a client that already has the current version gets a 304
+    * otherwise the response body is served from memory if it was built
+      for the same ETag, or built and kept for next time
+
+Bodies are kept in a least-recently-used cache of at most RESPONSE_CACHE_SIZE
+bytes. Each campaign resource has a single entry, replaced when its ETag
+changes. Answers are stored by the job worker, another process, so nothing
+tells the cache when they arrive: it is the new results version in the
+ETag that keeps pages and downloads fresh.
+"""
+from collections import OrderedDict
+from flask import request, Response
+
+import hashlib
+import settings
+import threading
+
+RESPONSE_CACHE_SIZE = getattr(settings, 'RESPONSE_CACHE_SIZE', 64 * 1024 * 1024)
+RESPONSE_CACHE_ENTRY_SIZE = getattr(settings, 'RESPONSE_CACHE_ENTRY_SIZE', 8 * 1024 * 1024)
+# Longest a request waits for another thread to build the same body
+BUILD_WAIT = 30
+
+class LRUCache(object):
+    """
+    Response bodies keyed by (campaign id, resource), each stored with the
+    ETag it was built for. Holds at most <max_bytes> of bodies and nothing
+    over <max_entry_bytes>; the least recently used entries go first.
+    """
+    def __init__(self, max_bytes=RESPONSE_CACHE_SIZE, max_entry_bytes=RESPONSE_CACHE_ENTRY_SIZE):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.building = {}
+
+    def get(self, campaignid, resource, etag):
+        """
+        The body stored for this resource, if it was built for <etag>.
+        """
+        with self.lock:
+            entry = self.entries.pop((campaignid, resource), None)
+            if entry is None or entry[0] != etag:
+                if entry is not None:
+                    self.size -= len(entry[1])
+                self.misses += 1
+                return None
+            self.entries[(campaignid, resource)] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, campaignid, resource, etag, body):
+        if len(body) > self.max_entry_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop((campaignid, resource), None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.entries[(campaignid, resource)] = (etag, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get_or_build(self, campaignid, resource, etag, build):
+        """
+        The body stored for this resource if it was built for <etag>, 
+        otherwise build() it and store it. On a threaded server, requests
+        for a body that's already being built wait for it instead of all
+        building it at once.
+        """
+        body = self.get(campaignid, resource, etag)
+        if body is not None:
+            return body
+
+        key = (campaignid, resource, etag)
+        with self.lock:
+            building = self.building.get(key)
+            if building is None:
+                building = self.building[key] = threading.Event()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            building.wait(BUILD_WAIT)
+            body = self.get(campaignid, resource, etag)
+            return body if body is not None else build()
+
+        try:
+            body = build()
+            self.set(campaignid, resource, etag, body)
+            return body
+        finally:
+            with self.lock:
+                del self.building[key]
+            building.set()
+
+    def invalidate(self, campaignid):
+        """
+        Drop every entry for a campaign.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == campaignid]:
+                self.size -= len(self.entries.pop(key)[1])
+
+    def tee(self, campaignid, resource, etag, stream):
+        """
+        Pass a streamed body through, keeping a copy to store if the whole
+        thing is sent and it isn't too big.
+        """
+        chunks = []
+        size = 0
+        for chunk in stream:
+            if chunks is not None:
+                size += len(chunk)
+                if size > self.max_entry_bytes:
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            self.set(campaignid, resource, etag, "".join(chunks))
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size,
+                    'hits': self.hits, 'misses': self.misses}
+
+responses = LRUCache()
+
+def campaign_etag(campaign, *extra):
+    """
+    An ETag for something built from a campaign's results, plus any <extra>
+    values it also depends on.
+    """
+    parts = (campaign.id, campaign.results_version, campaign.aggregation, campaign.threshold) + extra
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+def not_modified(etag, last_modified=None):
+    """
+    True if the client's copy (from If-None-Match, or failing that
+    If-Modified-Since) is still current.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return request.if_modified_since >= last_modified.replace(microsecond=0)
+    return False
+
+def not_modified_response(etag, last_modified=None):
+    response = Response(status=304)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
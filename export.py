@@ -0,0 +1,123 @@
+"""
+Streaming exports of campaign results.
+
+Each exporter reads what it needs from the campaign up front and returns a
+generator that reads the results a chunk of terms at a time, yielding the 
+encoded text for each chunk. Memory use stays flat and the first bytes go 
+out before the whole campaign has been read.
+"""
+from cStringIO import StringIO
+
+import csv
+import json
+import zlib
+
+import settings
+
+CHUNK_SIZE = getattr(settings, 'EXPORT_CHUNK_SIZE', 1000)
+
+def _encode(value):
+    """
+    The csv module can't write unicode, so hand it utf-8 instead.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def export_csv(campaign):
+    """
+    Results as CSV: the term, the chosen answer and the votes for each option.
+    """
+    option_texts = [option.option_text for option in campaign.options]
+    chunks = campaign.iter_result_chunks(CHUNK_SIZE)
+
+    def generate():
+        buf = StringIO()
+        writer = csv.writer(buf)
+        writer.writerow([_encode(text) for text in ["term", "answer"] + option_texts])
+        yield buf.getvalue()
+
+        for chunk in chunks:
+            buf = StringIO()
+            writer = csv.writer(buf)
+            for term, answer, votes in chunk:
+                writer.writerow([_encode(term), _encode(answer)] + 
+                                [votes[text] for text in option_texts])
+            yield buf.getvalue()
+    return generate()
+
+def export_json(campaign):
+    """
+    Results as a single JSON array of [term, answer, {option: votes}] elements.
+    """
+    chunks = campaign.iter_result_chunks(CHUNK_SIZE)
+
+    def generate():
+        yield "["
+        separator = "\n"
+        for chunk in chunks:
+            if chunk:
+                yield separator + ",\n".join(json.dumps(result) for result in chunk)
+                separator = ",\n"
+        yield "\n]\n"
+    return generate()
+
+def export_ndjson(campaign):
+    """
+    Results as newline delimited JSON, one [term, answer, {option: votes}] per line.
+    """
+    chunks = campaign.iter_result_chunks(CHUNK_SIZE)
+
+    def generate():
+        for chunk in chunks:
+            yield "".join(json.dumps(result) + "\n" for result in chunk)
+    return generate()
+
+def gzip_stream(chunks):
+    """
+    Gzip-compress a stream of strings as it is generated.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+# filetype: (exporter, mimetype)
+exporters = {
+    'csv': (export_csv, 'text/csv'),
+    'json': (export_json, 'text/json'),
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+}
+
+def export_mimetype(filetype):
+    """
+    The mimetype of <filetype>, or None if it isn't supported. Lets callers
+    check a filetype without reading any results.
+    """
+    if filetype.endswith('.gz'):
+        return 'application/x-gzip' if filetype[:-len('.gz')] in exporters else None
+    if filetype in exporters:
+        return exporters[filetype][1]
+    return None
+
+def export_results(campaign, filetype):
+    """
+    Return a (generator, mimetype) pair for <filetype>, or None if the 
+    filetype isn't supported. Any of the formats can be gzipped by adding
+    ".gz" to the filetype, e.g. "csv.gz".
+    """
+    mimetype = export_mimetype(filetype)
+    if mimetype is None:
+        return None
+
+    compressed = filetype.endswith('.gz')
+    if compressed:
+        filetype = filetype[:-len('.gz')]
+
+    exporter, _ = exporters[filetype]
+    stream = exporter(campaign)
+    if compressed:
+        return gzip_stream(stream), mimetype
+    return stream, mimetype
@@ -1,4 +1,6 @@
-from flaskext.wtf import Form, DecimalField, IntegerField, TextField, TextAreaField, NumberRange,  Required
+from flaskext.wtf import Form, BooleanField, DecimalField, FileField, FloatField, IntegerField, SelectField, TextField, TextAreaField, NumberRange, Optional, Required, ValidationError
+
+import aggregation
 
 class NewCampaignForm(Form):
     title = TextField('Campaign Name', validators=[Required()])
@@ -7,8 +9,8 @@ class NewCampaignForm(Form):
                          validators=[Required()])
     options = TextAreaField('Answers, separated by newlines',
                             validators=[Required()])
-    terms = TextAreaField('Terms to test, separated by newlines', 
-                          validators=[Required()])
+    terms = TextAreaField('Terms to test, separated by newlines')
+    terms_file = FileField('...or upload a file of terms, one per line')
     terms_per_quiz = IntegerField('How many terms should be presented on each quiz?', 
                                 validators=[NumberRange(min=0, max=50, 
                                             message='Specify fewer than 50 terms per quiz')])
@@ -16,5 +18,25 @@ class NewCampaignForm(Form):
                           validators=[NumberRange(min=0.009, max=5.00, 
                                       message='Reward should be between .01 and 5.00')])
     times_per_term = IntegerField('How many times should each quiz be presented?',
-                                    validators=[NumberRange(min=1,max=50)]) 
-  
+                                    validators=[NumberRange(min=1,max=50)])
+    aggregation = SelectField('How should the answers be combined?', 
+                              choices=aggregation.choices, default='majority')
+    threshold = FloatField('Percentage an answer must pass to be accepted \
+                            <span class="tip">leave blank for the default</span>',
+                           validators=[Optional(), NumberRange(min=0, max=100)])
+    adaptive = BooleanField('Ask again only about terms that are still undecided \
+                             <span class="tip">terms are asked at most as many times as above</span>')
+    budget = DecimalField('Most to spend on an adaptive campaign \
+                           <span class="tip">leave blank for no limit</span>',
+                          validators=[Optional(), NumberRange(min=0)])
+    reuse_results = BooleanField('Fill in terms an earlier campaign with the same question and answers decided \
+                                  <span class="tip">they won\'t be asked again</span>', 
+                                 default=True)
+
+    def validate_terms(self, field):
+        """
+        Terms can come from the textarea or from an uploaded file, but
+        there has to be at least one of them.
+        """
+        if not (field.data and field.data.strip()) and not self.terms_file.data:
+            raise ValidationError('Enter some terms or upload a file of terms')
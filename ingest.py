@@ -0,0 +1,235 @@
+"""
+Storing the answers retrieved from Mechanical Turk.
+
+A page of HITs is stored at once: every answer on the page is parsed first,
+duplicates are found with one set-based lookup, and the new answers are 
+inserted in bulk along with their tallies.
+
+What has been done with each HIT and assignment is kept in the sync tables
+(HitSync and AssignmentSync), committed with the answers, so a fetch can
+skip the assignments it has already stored and approve or dispose of 
+whatever an earlier fetch didn't get to. The workers' statistics are
+updated in the same transaction, and their assignments reviewed on them
+(see quality).
+"""
+from datetime import datetime
+from instrumentation import log_action
+from models import db, batches, AssignmentSync, CampaignAnswer, CampaignPage, HitSync, record_votes
+
+import quality
+
+def parse_assignment(hitid, assignment):
+    """
+    Generate a (hit, worker, campaign_id, term_id, option_id) tuple for each 
+    question answered in <assignment>.
+    """
+    # Multiple questions can be attached to a single assignment
+    for answer in assignment.answers[0]:
+        for identifier, optionfield in answer.fields:
+            campaignid, termid, _ = identifier.split("|", 2)
+            optionid, _ = optionfield.split("|", 1)
+            yield (hitid, assignment.WorkerId, int(campaignid), int(termid), int(optionid))
+
+def existing_answers(hitids):
+    """
+    Return the set of (hit, worker, term_id) keys already stored for <hitids>.
+    """
+    existing = set()
+    for batch in batches(hitids):
+        existing.update(db.session.query(CampaignAnswer.hit,
+                                         CampaignAnswer.worker,
+                                         CampaignAnswer.term_id)
+                                  .filter(CampaignAnswer.hit.in_(batch)))
+    return existing
+
+def mark_pages_completed(hitids):
+    """
+    Mark the campaign pages of reviewable HITs as completed. Reviewable HITs
+    won't get any more answers. Left for the caller to commit.
+    """
+    for batch in batches(hitids):
+        CampaignPage.query.filter(CampaignPage.hit_id.in_(batch)) \
+                          .update({'completed': True}, synchronize_session=False)
+
+### Sync state ###
+def hit_states(hitids):
+    """
+    {hit_id: status} for the HITs in <hitids> that have been seen before.
+    """
+    states = {}
+    for batch in batches(hitids):
+        states.update(db.session.query(HitSync.hit_id, HitSync.status)
+                                .filter(HitSync.hit_id.in_(batch)))
+    return states
+
+def stored_assignments(hitids):
+    """
+    The ids of the assignments of <hitids> whose answers are already stored.
+    """
+    stored = set()
+    for batch in batches(hitids):
+        stored.update(assignmentid for assignmentid, in 
+                      db.session.query(AssignmentSync.assignment_id)
+                                .filter(AssignmentSync.hit_id.in_(batch)))
+    return stored
+
+def pending_approvals(hitids):
+    """
+    (hit_id, assignment_id) of every stored assignment of <hitids> that
+    hasn't been approved or rejected yet.
+    """
+    pending = []
+    for batch in batches(hitids):
+        pending.extend(db.session.query(AssignmentSync.hit_id, AssignmentSync.assignment_id)
+                                 .filter(AssignmentSync.hit_id.in_(batch))
+                                 .filter(AssignmentSync.status == 'stored')
+                                 .order_by(AssignmentSync.assignment_id))
+    return pending
+
+def record_reviews(results):
+    """
+    Record the outcome of reviewing assignments, given a list of
+    (hit_id, assignment_id, decision, error) with decision 'approved' or
+    'rejected' and error None for success. HITs left with nothing to review
+    become 'approved'. Committed with one log entry per assignment; returns
+    the ids of the HITs that are now approved.
+    """
+    now = datetime.utcnow()
+    reviewed = [{'b_assignment_id': assignmentid, 'b_status': decision} 
+                for _, assignmentid, decision, error in results if error is None]
+    failed = [{'b_assignment_id': assignmentid, 'b_error': str(error)[:500]} 
+              for _, assignmentid, _, error in results if error is not None]
+
+    table = AssignmentSync.__table__
+    if reviewed:
+        db.session.execute(table.update()
+                                .where(table.c.assignment_id == db.bindparam('b_assignment_id'))
+                                .values(status=db.bindparam('b_status'), updated=now,
+                                        attempts=db.func.coalesce(table.c.attempts, 0) + 1),
+                           reviewed)
+    if failed:
+        db.session.execute(table.update()
+                                .where(table.c.assignment_id == db.bindparam('b_assignment_id'))
+                                .values(error=db.bindparam('b_error'), updated=now,
+                                        attempts=db.func.coalesce(table.c.attempts, 0) + 1),
+                           failed)
+
+    for hitid, assignmentid, decision, error in results:
+        action = "approve_assignment" if decision == 'approved' else "reject_assignment"
+        if error is None:
+            log_action(action, "HITId: %s, AssignmentId: %s" % (hitid, assignmentid))
+        else:
+            log_action(action + " - failed",
+                       "HITId: %s, AssignmentId: %s, error: %s" % (hitid, assignmentid, error))
+
+    hitids = set(hitid for hitid, _, _, _ in results)
+    waiting = set(hitid for hitid, _ in pending_approvals(hitids))
+    done = sorted(hitids - waiting)
+    set_hit_status(done, 'approved')
+    db.session.commit()
+    return done
+
+def set_hit_status(hitids, status):
+    """
+    Move HITs that have been seen before to <status>. Left for the caller to commit.
+    """
+    for batch in batches(hitids):
+        HitSync.query.filter(HitSync.hit_id.in_(batch)) \
+                     .update({'status': status, 'updated': datetime.utcnow()}, 
+                             synchronize_session=False)
+
+def record_sync(hits):
+    """
+    Record the assignments of <hits> (see store_answers) as stored, or as
+    approved or rejected if Mechanical Turk says they already are. Every HIT gets a
+    HitSync row: 'stored', or 'approved' if it has nothing left to approve.
+    Left for the caller to commit.
+    """
+    now = datetime.utcnow()
+    hitids = [hitid for hitid, _ in hits]
+    known = stored_assignments(hitids)
+    rows = []
+    for hitid, assignments in hits:
+        for assignment in assignments:
+            if assignment.AssignmentId in known:
+                continue
+            known.add(assignment.AssignmentId)
+            status = {'Approved': 'approved', 'Rejected': 'rejected'}.get(
+                getattr(assignment, 'AssignmentStatus', None), 'stored')
+            rows.append({'assignment_id': assignment.AssignmentId,
+                         'hit_id': hitid,
+                         'worker_id': assignment.WorkerId,
+                         'status': status,
+                         'attempts': 0,
+                         'updated': now})
+    if rows:
+        db.session.execute(AssignmentSync.__table__.insert(), rows)
+
+    seen = hit_states(hitids)
+    waiting = set(hitid for hitid, _ in pending_approvals(hitids))
+    new = [{'hit_id': hitid, 'status': 'stored' if hitid in waiting else 'approved', 'updated': now}
+           for hitid in hitids if hitid not in seen]
+    if new:
+        db.session.execute(HitSync.__table__.insert(), new)
+    set_hit_status([hitid for hitid in seen if hitid in waiting and seen[hitid] != 'stored'], 'stored')
+
+### Answers ###
+def store_answers(hits):
+    """
+    Store the answers from a page of HITs. <hits> is a list of 
+    (hit_id, assignments) pairs, and should leave out the assignments 
+    already stored (see stored_assignments).
+
+    Answers that have already been stored are skipped, so a page can safely
+    be stored more than once. Answers from rejected workers are stored but
+    not counted. The answers, their tallies, the workers' statistics, the 
+    sync state of the HITs and assignments and one log entry per HIT are
+    committed together. Returns the number of new answers.
+    """
+    seen = existing_answers(hitid for hitid, _ in hits)
+    statuses = quality.worker_statuses(assignment.WorkerId 
+                                       for _, assignments in hits for assignment in assignments)
+
+    rows = []
+    votes = {}
+    stored_per_hit = {}
+    timings = []
+    for hitid, assignments in hits:
+        stored_per_hit[hitid] = 0
+        for assignment in assignments:
+            excluded = quality.is_excluded(statuses.get(assignment.WorkerId))
+            stored = 0
+            for hit, worker, campaignid, termid, optionid in parse_assignment(hitid, assignment):
+                if (hit, worker, termid) in seen:
+                    continue
+                seen.add((hit, worker, termid))
+
+                rows.append({'hit': hit, 
+                             'worker': worker, 
+                             'campaign_id': campaignid,
+                             'term_id': termid,
+                             'option_id': optionid,
+                             'excluded': excluded})
+                if not excluded:
+                    key = (campaignid, termid, optionid)
+                    votes[key] = votes.get(key, 0) + 1
+                stored += 1
+            if stored:
+                timings.append((assignment.WorkerId, stored, quality.assignment_seconds(assignment)))
+            stored_per_hit[hitid] += stored
+
+    if rows:
+        db.session.execute(CampaignAnswer.__table__.insert(), rows)
+        if votes:
+            record_votes(votes)
+        quality.record_answers(rows, timings)
+    record_sync(hits)
+
+    for hitid, assignments in hits:
+        if stored_per_hit[hitid] > 0:
+            log_action("store_answers",
+                       "HITId: %s, %s new answers from %s assignments" %
+                       (hitid, stored_per_hit[hitid], len(assignments)))
+
+    db.session.commit()
+    return len(rows)
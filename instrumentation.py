@@ -0,0 +1,275 @@
+"""
+Instrumentation: where the time goes.
+
+    * Every request's latency, SQL query count and SQL time, per route
+    * Every MTurk API call's latency and errors, per method
+    * Optionally, a cProfile dump of a request
+
+The numbers are kept in memory by each process (the web app and the job
+worker separately) and the web app serves its own at /metrics. The worker
+prints each job's MTurk calls when the job finishes.
+
+ActionLog rows are also written from here: log_action() queues them and a
+background thread inserts them in batches, so logging doesn't hold up the
+transactions that store answers.
+"""
+from flask import g, request
+from flaskext.sqlalchemy import get_debug_queries
+from models import db, ActionLog
+from datetime import datetime
+
+import Queue
+import atexit
+import cache
+import cProfile
+import os
+import settings
+import sys
+import threading
+import time
+
+PROFILE_DIR = getattr(settings, 'PROFILE_DIR', None)
+ACTION_LOG_ASYNC = getattr(settings, 'ACTION_LOG_ASYNC', True)
+ACTION_LOG_BATCH_SIZE = getattr(settings, 'ACTION_LOG_BATCH_SIZE', 500)
+ACTION_LOG_FLUSH_INTERVAL = getattr(settings, 'ACTION_LOG_FLUSH_INTERVAL', 1.0)
+
+class Timings(object):
+    """
+    Thread-safe counts and times, by name.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, name, seconds, error=False, **counters):
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = {'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+            stats['count'] += 1
+            stats['errors'] += int(bool(error))
+            stats['total_ms'] += seconds * 1000
+            stats['max_ms'] = max(stats['max_ms'], seconds * 1000)
+            for counter, value in counters.items():
+                stats[counter] = stats.get(counter, 0) + value
+
+    def snapshot(self):
+        """
+        A copy of the stats with averages filled in.
+        """
+        with self.lock:
+            snapshot = {}
+            for name, stats in self.stats.items():
+                stats = dict(stats)
+                stats['avg_ms'] = stats['total_ms'] / stats['count']
+                snapshot[name] = stats
+            return snapshot
+
+    def since(self, before):
+        """
+        The stats recorded since <before>, an earlier snapshot. The max
+        can't be separated out, so it's left off.
+        """
+        since = {}
+        for name, stats in self.snapshot().items():
+            earlier = before.get(name, {})
+            count = stats['count'] - earlier.get('count', 0)
+            if count:
+                total = stats['total_ms'] - earlier.get('total_ms', 0)
+                since[name] = {'count': count, 
+                               'errors': stats['errors'] - earlier.get('errors', 0),
+                               'total_ms': total, 
+                               'avg_ms': total / count}
+        return since
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+routes = Timings()
+mturk_calls = Timings()
+
+### Requests ###
+def start_request():
+    g.request_started = time.time()
+    g.profiler = None
+    if PROFILE_DIR and request.args.get('profile'):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+def finish_request(exception=None):
+    started = getattr(g, 'request_started', None)
+    if started is None:
+        return
+    elapsed = time.time() - started
+
+    queries = get_debug_queries()
+    rule = request.url_rule.rule if request.url_rule is not None else '(no route)'
+    routes.record("%s %s" % (request.method, rule), elapsed, error=exception is not None,
+                  sql_queries=len(queries),
+                  sql_ms=sum(query.end_time - query.start_time for query in queries) * 1000)
+
+    if getattr(g, 'profiler', None) is not None:
+        g.profiler.disable()
+        if not os.path.isdir(PROFILE_DIR):
+            os.makedirs(PROFILE_DIR)
+        name = "%s-%s.prof" % (datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f"),
+                               request.endpoint or 'unknown')
+        g.profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+
+def init_app(app):
+    """
+    Time every request made to <app>. With PROFILE_DIR set, a request with
+    ?profile=1 is also run under cProfile and its stats written to PROFILE_DIR.
+    """
+    app.before_request(start_request)
+    app.teardown_request(finish_request)
+
+### MTurk ###
+class InstrumentedConnection(object):
+    """
+    Wraps an MTurk connection, timing every method called on it.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getattr__(self, name):
+        attribute = getattr(self.connection, name)
+        if not callable(attribute):
+            return attribute
+        def timed(*args, **kwargs):
+            started = time.time()
+            try:
+                result = attribute(*args, **kwargs)
+            except Exception:
+                mturk_calls.record(name, time.time() - started, error=True)
+                raise
+            mturk_calls.record(name, time.time() - started)
+            return result
+        return timed
+
+def summarize(stats):
+    """
+    One line describing a set of MTurk call stats.
+    """
+    if not stats:
+        return "no MTurk calls"
+    return ", ".join("%s: %s calls, %.0fms avg%s" % (name, call['count'], call['avg_ms'],
+                                                     ", %s errors" % call['errors'] if call['errors'] else "")
+                     for name, call in sorted(stats.items()))
+
+### Action log ###
+class ActionLogWriter(object):
+    """
+    Inserts queued ActionLog rows from a background thread, up to
+    ACTION_LOG_BATCH_SIZE rows per insert and at least every
+    ACTION_LOG_FLUSH_INTERVAL seconds. The thread uses its own connection,
+    never the session.
+    """
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.written = 0
+        self.failed = 0
+
+    def log(self, source, message):
+        self.queue.put({'log_time': datetime.utcnow(),
+                        'log_source': source,
+                        'log_message': message})
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="action-log-writer")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def take(self, timeout):
+        """
+        Wait up to <timeout> seconds for the next batch of rows.
+        """
+        rows = []
+        deadline = time.time() + timeout
+        while len(rows) < ACTION_LOG_BATCH_SIZE:
+            try:
+                row = self.queue.get(timeout=max(deadline - time.time(), 0.001))
+            except Queue.Empty:
+                break
+            if row is None:
+                # Asked to stop by close()
+                self.queue.task_done()
+                return rows, True
+            rows.append(row)
+        return rows, False
+
+    def write(self, rows, retries=3):
+        """
+        Insert a batch, retrying while the database is busy (SQLite locks
+        the whole file while answers are being stored).
+        """
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    db.engine.execute(ActionLog.__table__.insert(), rows)
+                    self.written += len(rows)
+                    return
+                except Exception:
+                    if attempt == retries:
+                        raise
+                    time.sleep(2 ** attempt)
+        except Exception:
+            self.failed += len(rows)
+            print >> sys.stderr, "Couldn't write %s action log entries: %s" % (len(rows), sys.exc_info()[1])
+        finally:
+            for _ in rows:
+                self.queue.task_done()
+
+    def run(self):
+        while True:
+            rows, stopping = self.take(ACTION_LOG_FLUSH_INTERVAL)
+            if rows:
+                self.write(rows)
+            if stopping:
+                return
+
+    def flush(self):
+        """
+        Wait until every queued row has been written.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        """
+        Write everything still queued and stop the thread. Runs at exit.
+        """
+        with self.lock:
+            thread = self.thread
+        if thread is not None and thread.is_alive():
+            self.queue.put(None)
+            thread.join()
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'written': self.written, 'failed': self.failed}
+
+action_log = ActionLogWriter()
+atexit.register(action_log.close)
+
+def log_action(source, message):
+    """
+    Add an entry to the action log. Entries are written in the background
+    unless ACTION_LOG_ASYNC is off.
+    """
+    if ACTION_LOG_ASYNC:
+        action_log.log(source, message)
+    else:
+        db.session.add(ActionLog(source, message))
+
+def metrics():
+    """
+    Everything recorded by this process so far.
+    """
+    return {'pid': os.getpid(),
+            'routes': routes.snapshot(),
+            'mturk': mturk_calls.snapshot(),
+            'action_log': action_log.stats(),
+            'response_cache': cache.responses.stats()}
@@ -0,0 +1,296 @@
+"""
+Background jobs: a small SQLite-backed queue and the worker that runs it.
+
+Publishing HITs and fetching results can take minutes on large campaigns, 
+so the web views only queue a job and a separate worker process 
+(python manage.py worker) runs it, recording its progress as it goes. 
+The worker also queues a results fetch every FETCH_INTERVAL seconds while
+any campaign is waiting for answers.
+
+A running job's heartbeat is updated every few seconds while it runs. If a
+worker dies mid-job, its job stops beating and is failed after JOB_TIMEOUT
+seconds. The same task can then be queued again.
+"""
+from datetime import datetime
+from models import db, pending_jobs_exist, stale_outcomes, Campaign
+from mturk import create_campaign_hits, create_next_round, retrieve_reviewable_hits
+
+import adaptive
+import instrumentation
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+import settings
+
+QUEUE_PATH = getattr(settings, 'JOB_QUEUE_PATH', '/tmp/docsift-jobs.db')
+POLL_INTERVAL = getattr(settings, 'JOB_POLL_INTERVAL', 2)
+FETCH_INTERVAL = getattr(settings, 'FETCH_INTERVAL', 300)
+JOB_TIMEOUT = getattr(settings, 'JOB_TIMEOUT', 600)
+
+# Seconds between the heartbeats of a running job
+HEARTBEAT_INTERVAL = JOB_TIMEOUT / 10.0
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+### The queue ###
+def connect():
+    """
+    Open the queue database, creating the table the first time.
+    """
+    conn = sqlite3.connect(QUEUE_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("""CREATE TABLE IF NOT EXISTS job (
+                        id INTEGER PRIMARY KEY,
+                        task TEXT NOT NULL,
+                        campaign_id INTEGER,
+                        status TEXT NOT NULL,
+                        progress TEXT,
+                        error TEXT,
+                        created REAL,
+                        started REAL,
+                        heartbeat REAL,
+                        finished REAL)""")
+    if 'heartbeat' not in [column['name'] for column in conn.execute("PRAGMA table_info(job)")]:
+        conn.execute("ALTER TABLE job ADD COLUMN heartbeat REAL")
+    conn.execute("CREATE INDEX IF NOT EXISTS job_status ON job (status, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS job_campaign ON job (campaign_id, id)")
+    return conn
+
+class Job(object):
+    """
+    A row of the job table.
+    """
+    def __init__(self, row):
+        for key in row.keys():
+            setattr(self, key, row[key])
+
+    @property
+    def active(self):
+        return self.status in (QUEUED, RUNNING)
+
+    def created_date(self):
+        return datetime.utcfromtimestamp(self.created)
+
+    def __repr__(self):
+        return "<Job %s: %s for campaign %s, %s>" % (self.id, self.task, self.campaign_id, self.status)
+
+def expire_stale(conn):
+    """
+    Fail the running jobs whose worker hasn't sent a heartbeat for
+    JOB_TIMEOUT seconds. Run inside the caller's transaction.
+    """
+    now = time.time()
+    conn.execute("UPDATE job SET status = ?, error = ?, finished = ? "
+                 "WHERE status = ? AND COALESCE(heartbeat, started) < ?",
+                 (FAILED, "The worker running this job stopped responding", now, RUNNING, now - JOB_TIMEOUT))
+
+def enqueue(task, campaign_id=None):
+    """
+    Queue <task> unless the same task is already waiting or running. 
+    Returns the job's id.
+    """
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        expire_stale(conn)
+        row = conn.execute("SELECT id FROM job WHERE task = ? AND campaign_id IS ? AND status IN (?, ?)",
+                           (task, campaign_id, QUEUED, RUNNING)).fetchone()
+        if row is not None:
+            conn.execute("COMMIT")
+            return row['id']
+        jobid = conn.execute("INSERT INTO job (task, campaign_id, status, created) VALUES (?, ?, ?, ?)",
+                             (task, campaign_id, QUEUED, time.time())).lastrowid
+        conn.execute("COMMIT")
+        return jobid
+    finally:
+        conn.close()
+
+def claim():
+    """
+    Mark the oldest queued job as running and return it, or None if the
+    queue is empty. Safe to call from several workers at once.
+    """
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        expire_stale(conn)
+        row = conn.execute("SELECT * FROM job WHERE status = ? ORDER BY id LIMIT 1", (QUEUED,)).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        now = time.time()
+        conn.execute("UPDATE job SET status = ?, started = ?, heartbeat = ? WHERE id = ?",
+                     (RUNNING, now, now, row['id']))
+        conn.execute("COMMIT")
+        return get_job(row['id'])
+    finally:
+        conn.close()
+
+def update_progress(jobid, progress):
+    conn = connect()
+    try:
+        conn.execute("UPDATE job SET progress = ?, heartbeat = ? WHERE id = ?", (progress, time.time(), jobid))
+    finally:
+        conn.close()
+
+def beat(jobid):
+    conn = connect()
+    try:
+        conn.execute("UPDATE job SET heartbeat = ? WHERE id = ? AND status = ?", (time.time(), jobid, RUNNING))
+    finally:
+        conn.close()
+
+def keep_alive(jobid, stopped):
+    """
+    Send a heartbeat for <jobid> every HEARTBEAT_INTERVAL seconds until the
+    <stopped> event is set.
+    """
+    while not stopped.wait(HEARTBEAT_INTERVAL):
+        try:
+            beat(jobid)
+        except sqlite3.Error:
+            pass
+
+def finish(jobid, error=None):
+    """
+    Record a running job as done, or failed with <error>. A job that 
+    expire_stale has already failed keeps that failure, since another job
+    may have taken its place.
+    """
+    conn = connect()
+    try:
+        conn.execute("UPDATE job SET status = ?, error = ?, finished = ? WHERE id = ? AND status = ?",
+                     (FAILED if error else DONE, error, time.time(), jobid, RUNNING))
+    finally:
+        conn.close()
+
+def get_job(jobid):
+    conn = connect()
+    try:
+        row = conn.execute("SELECT * FROM job WHERE id = ?", (jobid,)).fetchone()
+        return Job(row) if row is not None else None
+    finally:
+        conn.close()
+
+def latest_job(task=None, campaign_id=None):
+    """
+    The most recent job for a campaign (or the most recent <task> job when
+    no campaign is given), or None.
+    """
+    conn = connect()
+    try:
+        query = "SELECT * FROM job WHERE 1 = 1"
+        params = []
+        if task is not None:
+            query += " AND task = ?"
+            params.append(task)
+        if campaign_id is not None:
+            query += " AND campaign_id = ?"
+            params.append(campaign_id)
+        row = conn.execute(query + " ORDER BY id DESC LIMIT 1", params).fetchone()
+        return Job(row) if row is not None else None
+    finally:
+        conn.close()
+
+### Tasks ###
+def generate_hits(job):
+    def progress(done, total):
+        update_progress(job.id, "%s of %s pages published" % (done, total))
+    failures = create_campaign_hits(job.campaign_id, progress=progress)
+    if failures:
+        raise RuntimeError("%s pages could not be published" % failures)
+
+def fetch_results(job):
+    def progress(done, total):
+        update_progress(job.id, "%s of %s reviewable HITs processed" % (done, total))
+    retrieve_reviewable_hits(progress=progress)
+
+    # Majority outcomes are kept up to date as answers are stored; the
+    # other aggregation strategies weigh every answer, so theirs are 
+    # recomputed here for each campaign that got new ones
+    for campaignid in stale_outcomes():
+        update_progress(job.id, "Updating the outcomes of campaign %s" % campaignid)
+        Campaign.query.get(campaignid).refresh_outcomes()
+        db.session.commit()
+
+    # Adaptive campaigns whose last round has come back get another one
+    for campaignid in adaptive.campaigns_ready():
+        enqueue('next_round', campaignid)
+
+def next_round(job):
+    def progress(done, total):
+        update_progress(job.id, "%s of %s pages published" % (done, total))
+    failures = create_next_round(job.campaign_id, progress=progress)
+    if failures:
+        raise RuntimeError("%s pages could not be published" % failures)
+
+def archive_campaign(job):
+    campaign = Campaign.query.get(job.campaign_id)
+    if campaign is None or not campaign.archive():
+        raise RuntimeError("Only finished campaigns can be archived")
+    db.session.commit()
+
+tasks = {
+    'generate_hits': generate_hits,
+    'fetch_results': fetch_results,
+    'next_round': next_round,
+    'archive_campaign': archive_campaign,
+}
+
+### The worker ###
+def run_job(job):
+    """
+    Run a claimed job, recording whether it succeeded.
+    """
+    before = instrumentation.mturk_calls.snapshot()
+    stopped = threading.Event()
+    heart = threading.Thread(target=keep_alive, args=(job.id, stopped))
+    heart.daemon = True
+    heart.start()
+    try:
+        tasks[job.task](job)
+        finish(job.id)
+    except Exception:
+        finish(job.id, traceback.format_exc())
+    finally:
+        stopped.set()
+        heart.join()
+        db.session.remove()
+    print "Job %s: %s" % (job.id, instrumentation.summarize(
+        instrumentation.mturk_calls.since(before)))
+    sys.stdout.flush()
+
+def schedule_fetch():
+    """
+    Queue a results fetch if any campaign is still waiting for answers.
+    """
+    try:
+        if pending_jobs_exist():
+            enqueue('fetch_results')
+    finally:
+        db.session.remove()
+
+def run_worker(once=False):
+    """
+    Run queued jobs until interrupted, polling every JOB_POLL_INTERVAL seconds
+    and scheduling a results fetch every FETCH_INTERVAL seconds (0 turns the
+    scheduler off). With <once>, stop when the queue is empty.
+    """
+    next_fetch = time.time()
+    while True:
+        if FETCH_INTERVAL and time.time() >= next_fetch:
+            schedule_fetch()
+            next_fetch = time.time() + FETCH_INTERVAL
+
+        job = claim()
+        if job is not None:
+            print "Running job %s: %s (campaign %s)" % (job.id, job.task, job.campaign_id)
+            sys.stdout.flush()
+            run_job(job)
+        elif once:
+            return
+        else:
+            time.sleep(POLL_INTERVAL)
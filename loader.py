@@ -0,0 +1,121 @@
+"""
+Bulk loading of campaign options and terms.
+
+Terms are read a line at a time and written with executemany-style inserts
+in batches, so a campaign with hundreds of thousands of terms never has an
+ORM object per term in memory. Each term is stored with its fingerprint
+(see reuse).
+"""
+from models import db, Campaign, CampaignOption, CampaignTerm
+
+import re
+import reuse
+
+import settings
+
+BATCH_SIZE = getattr(settings, 'BULK_INSERT_BATCH_SIZE', 1000)
+
+def iter_lines(source):
+    """
+    Generate the non-empty lines of <source>, which can be a string or any
+    iterable of lines (an open file, an uploaded file, the request stream).
+    """
+    if isinstance(source, basestring):
+        lines = (match.group(0) for match in re.finditer(r'[^\n\r]+', source))
+    elif hasattr(source, 'readline'):
+        # Werkzeug's request stream doesn't stop iterating at the end of the
+        # body, so read streams line by line until readline comes back empty.
+        lines = iter(source.readline, '')
+    else:
+        lines = source
+
+    for line in lines:
+        if isinstance(line, str):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if len(line) > 0:
+            yield line
+
+def bulk_insert(model, campaignid, column, values, seen=None, extra=None):
+    """
+    Insert <values> into <column> of <model> for a campaign, BATCH_SIZE rows
+    per insert. Values already in <seen> (or repeated within <values>) are 
+    skipped. <extra>, if given, is called with each value for a dictionary
+    of other columns to set. Returns the number of rows inserted.
+    """
+    if seen is None:
+        seen = set()
+    table = model.__table__
+
+    inserted = 0
+    batch = []
+    for value in values:
+        if value in seen:
+            continue
+        seen.add(value)
+        row = {'campaign_id': campaignid, column: value}
+        if extra is not None:
+            row.update(extra(value))
+        batch.append(row)
+
+        if len(batch) >= BATCH_SIZE:
+            db.session.execute(table.insert(), batch)
+            inserted += len(batch)
+            batch = []
+
+    if batch:
+        db.session.execute(table.insert(), batch)
+        inserted += len(batch)
+    return inserted
+
+def fingerprinter(key):
+    """
+    An <extra> for bulk_insert that fingerprints terms under a 
+    reuse.question_key.
+    """
+    return lambda term: {'fingerprint': reuse.fingerprint(key, term)}
+
+def add_terms(campaign, source):
+    """
+    Add the terms in <source> (see iter_lines) to an existing campaign, 
+    skipping any it already has, and fill in those an earlier campaign 
+    decided if the campaign reuses results. The caller commits.
+    """
+    existing = set(term for term, in db.session.query(CampaignTerm.term)
+                                              .filter(CampaignTerm.campaign_id == campaign.id))
+    added = bulk_insert(CampaignTerm, campaign.id, 'term', iter_lines(source), existing,
+                        fingerprinter(reuse.campaign_key(campaign)))
+    if added:
+        if campaign.reuse_results:
+            reuse.prefill(campaign)
+        # New terms have no answers, so the other terms' outcomes still stand
+        campaign.touch_results(outcomes_changed=False)
+    return added
+
+def create_campaign(title, question, terms_per_quiz, reward, times_per_term, options, terms,
+                    aggregation='majority', threshold=None, adaptive=False, budget=None,
+                    reuse_results=False):
+    """
+    Create a campaign along with its options and terms, and commit it.
+    With <reuse_results>, terms an earlier campaign with the same question
+    and answers decided are filled in rather than asked (see reuse).
+
+    <options> and <terms> can be anything iter_lines accepts, so a form 
+    textarea, an uploaded file and a file opened from the command line all
+    go through the same path.
+    """
+    campaign = Campaign(title, question, terms_per_quiz, reward, times_per_term,
+                        aggregation=aggregation, threshold=threshold,
+                        adaptive=adaptive, budget=budget, reuse_results=reuse_results)
+    db.session.add(campaign)
+    db.session.flush()
+
+    options = list(iter_lines(options))
+    bulk_insert(CampaignOption, campaign.id, 'option_text', options)
+    bulk_insert(CampaignTerm, campaign.id, 'term', iter_lines(terms),
+                extra=fingerprinter(reuse.question_key(question, options)))
+    if reuse_results:
+        reuse.prefill(campaign)
+
+    db.session.commit()
+    return campaign
@@ -1,138 +1,360 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, Response
+from flask import Blueprint, Flask, render_template, request, redirect, url_for, flash, Response, abort, session
 from forms import NewCampaignForm
 
-from models import db, Campaign, CampaignOption, CampaignTerm, CampaignAnswer
-from mturk import create_campaign_hits, retrieve_reviewable_hits
-
+from models import db, init_db, delete_campaign, current_change, Campaign, CampaignOption, CampaignTerm, CampaignAnswer, term_counts, \
+                   finished_campaigns, pending_jobs_exist
+from export import export_results, export_mimetype
+from loader import create_campaign, add_terms
+from datetime import datetime
+from werkzeug.datastructures import CombinedMultiDict
+
+import aggregation
+import archive
+import cache
+import instrumentation
+import jobs
 import json
+import repository
 import sys
-import re
 
 import settings
 
-app = Flask(__name__)
+# Terms shown on the campaign page, and the most a results.json slice can ask for
+RESULTS_PER_PAGE = getattr(settings, 'RESULTS_PER_PAGE', 100)
+MAX_RESULTS_PER_PAGE = 500
+
+views = Blueprint('views', __name__)
+
+def create_app():
+    """
+    Create the application and bind the database to it. This is the only
+    application in the process: wsgi.py serves it, and manage.py and the
+    benchmarks create it to use the database.
 
-db.create_all()
+    No tables are created here; run "python manage.py migrate" first.
+    """
+    app = Flask(__name__)
+    app.secret_key = settings.APP_SECRET_KEY
+    init_db(app)
+    instrumentation.init_app(app)
+    app.register_blueprint(views)
+    return app
+
+def campaign_form(obj=None):
+    """
+    A NewCampaignForm of the request's fields and uploaded files, so an 
+    uploaded terms file comes through the form like the other fields.
+    """
+    return NewCampaignForm(CombinedMultiDict((request.files, request.form)), obj=obj)
+
+def create_campaign_from_form(form):
+    """
+    Create a campaign from a submitted NewCampaignForm. Terms are taken from
+    the uploaded file if there is one, otherwise from the textarea.
+    """
+    terms = form.terms_file.data or form.terms.data
+    return create_campaign(form.title.data, 
+                           form.question.data, 
+                           form.terms_per_quiz.data, 
+                           form.reward.data, 
+                           form.times_per_term.data,
+                           form.options.data,
+                           terms,
+                           aggregation=form.aggregation.data,
+                           threshold=form.threshold.data,
+                           adaptive=form.adaptive.data,
+                           budget=form.budget.data,
+                           reuse_results=form.reuse_results.data)
+
+def get_outcome_filter():
+    """
+    The ?outcome= a campaign's results are filtered by: 'decided', 
+    'inconclusive', an option id or None for every term.
+    """
+    outcome = request.args.get('outcome') or None
+    if outcome is None or outcome in ('decided', 'inconclusive'):
+        return outcome
+    try:
+        return int(outcome)
+    except ValueError:
+        abort(400)
+
+def get_int_list(name):
+    """
+    A comma-separated list of ids from the query string, or None.
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return [int(item) for item in value.split(',') if item.strip()]
+    except ValueError:
+        abort(400)
+
+def get_timestamp(name):
+    """
+    A UTC time from the query string (2011-12-31T23:59:59 or 2011-12-31),
+    or None.
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    abort(400)
+
+def get_cursor():
+    """
+    The ?cursor= of a page of results.json: (watermark, (campaign id, term
+    id) the last page ended at), or None on the first page.
+    """
+    value = request.args.get('cursor')
+    if not value:
+        return None
+    try:
+        watermark, campaignid, termid = [int(part) for part in value.split('-')]
+    except ValueError:
+        abort(400)
+    return watermark, (campaignid, termid or None)
+
+def result_json(matrix, result):
+    """
+    A term's result for the JSON views.
+    """
+    conclusive = matrix.conclusive[result.row]
+    return {'term_id': result.termid,
+            'term': result.term,
+            'answer': result.answer.option_text if conclusive else None,
+            'answer_option_id': result.answer.option_id if conclusive else None,
+            'percentage': result.answer.percentage if conclusive else None,
+            'reused': result.reused,
+            'votes': dict((item.option_text, item.times_selected) for item in result.results)}
+
+def render_results(campaign, matrix):
+    """
+    The <li> rows for a slice of a campaign's results.
+    """
+    return render_template('_results.html', campaign=campaign, resultset=matrix,
+                           firstoptionid=min([option.id for option in campaign.options] or [0]))
 
 ### Application Routes ###
-@app.route('/')
+@views.route('/')
 def home():
     """
     Redirect all requests to the campaign list for now.
     """
     return render_template('marketing.html')
 
-@app.route('/campaigns')
+@views.route('/campaigns')
 def listcampaigns():
     """
-    List all the campaigns. 
+    List the campaigns, a page at a time. 
+
+    Term counts come from a single aggregate query and answer counts from the
+    stored totals, so no terms or answers are loaded to build the list.
     """
-    campaigns = Campaign.query.all()
-    
+    counts = term_counts()
+    asked = term_counts(asked_only=True)
+    num_terms = db.func.coalesce(counts.c.num_terms, 0)
+    num_asked = db.func.coalesce(asked.c.num_terms, 0)
+    sort_columns = {'title': Campaign.title,
+                    'created': Campaign.created_date,
+                    'terms': num_terms,
+                    'answers': Campaign.answer_count}
+
+    sort = request.args.get('sort', 'created')
+    if sort not in sort_columns:
+        sort = 'created'
+    order = request.args.get('order', 'desc')
+    if order not in ('asc', 'desc'):
+        order = 'desc'
+    sort_column = sort_columns[sort]
+    if order == 'desc':
+        sort_column = sort_column.desc()
+
+    campaigns = Campaign.query.outerjoin(counts, Campaign.id == counts.c.campaign_id) \
+                              .outerjoin(asked, Campaign.id == asked.c.campaign_id) \
+                              .add_columns(num_terms, num_asked) \
+                              .order_by(sort_column, Campaign.id) \
+                              .paginate(request.args.get('page', 1, type=int),
+                                        per_page=getattr(settings, 'CAMPAIGNS_PER_PAGE', 25))
+
     # Report whether or not there are jobs pending
-    pending_jobs = False
-    for campaign in campaigns:
-        num_answers_expected = len(campaign.terms) * campaign.times_per_term
-        if (campaign.job_generated == True) and (len(campaign.answers) < num_answers_expected):
-            pending_jobs = True
+    pending_jobs = pending_jobs_exist()
 
-    return render_template('campaignlist.html', campaigns=campaigns, pending_jobs=pending_jobs)
+    return render_template('campaignlist.html', 
+                           campaigns=campaigns, 
+                           finished=finished_campaigns([campaign for campaign, _, _ in campaigns.items]),
+                           sort=sort,
+                           order=order,
+                           pending_jobs=pending_jobs,
+                           fetch_job=jobs.latest_job('fetch_results'))
 
-@app.route('/campaigns/new', methods=['GET','POST'])
+@views.route('/campaigns/new', methods=['GET','POST'])
 def newcampaign():
     """
     Create a new campaign. 
 
     MTurk jobs are spawned after the campaign is created.
     """
-    form = NewCampaignForm(request.form)
+    form = campaign_form()
     if request.method == 'POST' and form.validate():
-        # Add the campaign itself
-        campaign = Campaign(form.title.data, 
-                            form.question.data, 
-                            form.terms_per_quiz.data, 
-                            form.reward.data, 
-                            form.times_per_term.data)
-        db.session.add(campaign)
-
-        # Add the options 
-        options = re.split(r'[\n\r]+', form.options.data)
-        for option in options:
-            if len(option) > 0:
-                campaign_option = CampaignOption(campaign, option)
-                db.session.add(campaign_option)
-
-        # Add the terms
-        terms = re.split(r'[\n\r]+', form.terms.data)
-        for term in terms:
-            if len(term) > 0:
-                campaign_term = CampaignTerm(campaign, term)
-                db.session.add(campaign_term)
-
-        # Save everything to the db
-        db.session.commit()
-        return redirect(url_for('campaigndetails',id=campaign.id))
+        campaign = create_campaign_from_form(form)
+        return redirect(url_for('.campaigndetails',id=campaign.id))
     return render_template('newcampaign.html',form=form)
 
-@app.route('/campaigns/<id>')
+@views.route('/campaigns/<id>')
 def campaigndetails(id):
     """  
     Because campaign creation spawns a bunch of mturk jobs, campaigns are not editable. 
     If a campaign needs to be modified the old (incorrect) campaign should be deleted
     and a new campaign added in its place. 
-    """
-    campaign = Campaign.query.filter_by(id=id).first_or_404()
 
-    # Figure out what the first option ID is so the responses can be color-coded    
-    firstoptionid = 10000
-    for option in campaign.options:
-        if option.id < firstoptionid:
-            firstoptionid = option.id
+    The page only changes when the campaign's results, rounds, latest job or
+    whether it is finished do, so it is served from the response cache (or
+    as a 304) until then.
+    Pages showing flashed messages are never cached.
 
-    return render_template('campaigndetails.html', 
-                           campaign=campaign, 
-                           firstoptionid=firstoptionid,
-                           resultset=campaign.get_results())
+    Only the first RESULTS_PER_PAGE terms (optionally filtered by ?outcome=)
+    are on the page; the rest are loaded from results.json as it's scrolled.
+    """
+    version = repository.get_campaign_version(id)
+    outcome = get_outcome_filter()
+    job = jobs.latest_job(campaign_id=version.id)
+    finished = repository.is_finished(version.id)
+    etag = cache.campaign_etag(version, version.outcomes_version, outcome, version.job_generated, 
+                               version.rounds_published, version.finished, version.archived,
+                               finished, job and (job.id, job.status, job.progress))
+
+    def render():
+        campaign = repository.get_campaign(id)
+
+        # Figure out what the first option ID is so the responses can be color-coded    
+        firstoptionid = 10000
+        for option in campaign.options:
+            if option.id < firstoptionid:
+                firstoptionid = option.id
+
+        resultset, following = campaign.get_result_slice(limit=RESULTS_PER_PAGE, outcome=outcome)
+        return render_template('campaigndetails.html', 
+                               campaign=campaign, 
+                               firstoptionid=firstoptionid,
+                               finished=finished,
+                               job=job,
+                               aggregation_label=dict(aggregation.choices).get(campaign.aggregation, 
+                                                                               'Majority vote'),
+                               outcome=outcome,
+                               resultset=resultset,
+                               following=following).encode('utf-8')
+
+    if session.get('_flashes'):
+        return Response(render(), mimetype='text/html')
+    if cache.not_modified(etag):
+        return cache.not_modified_response(etag)
+
+    response = Response(cache.responses.get_or_build(version.id, 'details:%s' % outcome, etag, render), 
+                        mimetype='text/html')
+    response.set_etag(etag)
+    return response
+
+@views.route('/campaigns/<int:id>/results.json')
+def campaignresults(id):
+    """
+    A slice of a campaign's results, in term order: ?after= the id of the
+    last term already shown, ?limit= how many (RESULTS_PER_PAGE by default,
+    at most MAX_RESULTS_PER_PAGE) and ?outcome= to filter them as on the 
+    campaign page. Returns the results, the "next" value to pass as ?after=
+    (null after the last slice) and the rows rendered as HTML for the page.
+    """
+    version = repository.get_campaign_version(id)
+    outcome = get_outcome_filter()
+    after = request.args.get('after', type=int)
+    limit = min(max(request.args.get('limit', RESULTS_PER_PAGE, type=int), 1), MAX_RESULTS_PER_PAGE)
+
+    etag = cache.campaign_etag(version, version.outcomes_version, version.job_generated, 
+                               outcome, after, limit)
+    if cache.not_modified(etag):
+        return cache.not_modified_response(etag)
+
+    campaign = repository.get_campaign(id)
+    matrix, following = campaign.get_result_slice(after=after, limit=limit, outcome=outcome)
+    results = [result_json(matrix, result) for result in matrix]
+    response = Response(json.dumps({'results': results,
+                                    'next': following,
+                                    'html': render_results(campaign, matrix)}),
+                        mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+@views.route('/results.json')
+def batchresults():
+    """
+    Results across campaigns, a page at a time, for keeping a copy of them
+    elsewhere without downloading every campaign. ?campaigns=1,2,3 picks 
+    the campaigns and ?updated_since= (a UTC time) those whose results were
+    updated since; every campaign otherwise. Each page has the decided 
+    terms or, with ?since=<watermark>, every term whose results changed 
+    after the watermark, with "decided" false for those no longer decided.
+    ?limit= is as for a campaign's results.json.
+
+    Returns the results, the "next" value to pass as ?cursor= (null after
+    the last page) and the "watermark" to pass as ?since= on the next sync,
+    which is taken when the first page is read so nothing that changes 
+    while the pages are read is missed.
+    """
+    campaignids = get_int_list('campaigns')
+    updated_since = get_timestamp('updated_since')
+    since = request.args.get('since')
+    if since:
+        try:
+            since = int(since)
+        except ValueError:
+            abort(400)
+    else:
+        since = None
+    limit = min(max(request.args.get('limit', RESULTS_PER_PAGE, type=int), 1), MAX_RESULTS_PER_PAGE)
 
-@app.route('/campaigns/<id>/clone', methods=['GET', 'POST'])
+    cursor = get_cursor()
+    if cursor is None:
+        watermark, position = current_change(), None
+    else:
+        watermark, position = cursor
+    pages, following = repository.get_result_batch(campaignids, updated_since, since, position, limit)
+
+    results = []
+    for campaign, matrix in pages:
+        for result in matrix:
+            row = result_json(matrix, result)
+            row['campaign_id'] = campaign.id
+            row['decided'] = bool(matrix.conclusive[result.row])
+            results.append(row)
+    if following is not None:
+        following = "%s-%s-%s" % (watermark, following[0], following[1] or 0)
+    return Response(json.dumps({'results': results,
+                                'next': following,
+                                'watermark': watermark}),
+                    mimetype='application/json')
+
+@views.route('/campaigns/<id>/clone', methods=['GET', 'POST'])
 def clonecampaign(id):
     """
-    Clone a campaign from an existing campaign
+    Clone a campaign from an existing campaign. Reusing the original's 
+    decided terms is on by default, whether or not it reused any itself.
     """
-    campaign = Campaign.query.filter_by(id=id).first_or_404()
-    form = NewCampaignForm(request.form, obj=campaign)
-
-    allterms = [str(term.term) for term in campaign.terms]
+    campaign = repository.get_campaign_settings(id)
+    form = campaign_form(obj=campaign)
+    if request.method == 'GET':
+        form.reuse_results.data = True
 
-    results = campaign.get_results()
-    inconclusiveterms = [str(answer.term) for answer in results if answer.is_inconclusive()]
+    allterms = [str(term) for term in repository.get_term_texts(id)]
+    inconclusiveterms = [str(term) for term in repository.get_inconclusive_terms(id)]
 
     if request.method == 'POST' and form.validate():
-        # Add the campaign itself
-        campaign = Campaign(form.title.data, 
-                            form.question.data, 
-                            form.terms_per_quiz.data, 
-                            form.reward.data, 
-                            form.times_per_term.data)
-        db.session.add(campaign)
-
-        # Add the options 
-        options = re.split(r'[\n\r]+', form.options.data)
-        for option in options:
-            if len(option) > 0:
-                campaign_option = CampaignOption(campaign, option)
-                db.session.add(campaign_option)
-
-        # Add the terms
-        terms = re.split(r'[\n\r]+', form.terms.data)
-        for term in terms:
-            if len(term) > 0:
-                campaign_term = CampaignTerm(campaign, term)
-                db.session.add(campaign_term)
-
-        # Save everything to the db
-        db.session.commit()
-        return redirect(url_for('campaigndetails',id=campaign.id))
+        campaign = create_campaign_from_form(form)
+        return redirect(url_for('.campaigndetails',id=campaign.id))
 
     return render_template('clonecampaign.html',
                            original_campaign=campaign,
@@ -140,7 +362,26 @@ def clonecampaign(id):
                            inconclusiveterms=inconclusiveterms,
                            form=form)
 
-@app.route('/campaigns/<id>/delete', methods=['GET','POST'])
+@views.route('/campaigns/<int:id>/terms', methods=['POST'])
+def addterms(id):
+    """
+    Add terms to a campaign from the request body, one term per line. 
+
+    The body is read as a stream, so very large term lists can be posted 
+    directly (e.g. curl --data-binary @terms.txt). Terms can only be added 
+    until the campaign's jobs have been generated.
+    """
+    campaign = Campaign.query.filter_by(id=id).first_or_404()
+    if campaign.job_generated:
+        return Response("Jobs have already been generated for this campaign.\n", 
+                        status=409, mimetype='text/plain')
+
+    added = add_terms(campaign, request.stream)
+    db.session.commit()
+    cache.responses.invalidate(campaign.id)
+    return Response("Added %s terms.\n" % added, mimetype='text/plain')
+
+@views.route('/campaigns/<id>/delete', methods=['GET','POST'])
 def deletecampaign(id):
     """
     Delete an existing campaign. 
@@ -148,73 +389,117 @@ def deletecampaign(id):
     Because campaigns are tied to MTurk jobs, jobs will need to be cancelled where
     possible when the campaign is deleted (otherwise there will be jobs running 
     and the results will never be collected, wasting money).
+
+    The campaign's options, terms, answers, tallies, pages and archive go 
+    with it.
     """
     campaign = Campaign.query.filter_by(id=id).first_or_404()
     if request.method == 'POST':
-        campaignname = campaign.title
-        db.session.delete(campaign)
+        campaignid, campaignname = campaign.id, campaign.title
+        delete_campaign(campaignid)
         db.session.commit()
+        archive.remove(campaignid)
+        cache.responses.invalidate(campaignid)
         flash('Campaign "%s" was deleted!' % campaignname)
-        return redirect(url_for('listcampaigns'))
+        return redirect(url_for('.listcampaigns'))
     return render_template('deletecampaign.html', campaign=campaign)
 
-@app.route('/campaigns/<id>/generate', methods=['POST'])
+@views.route('/campaigns/<id>/generate', methods=['POST'])
 def generatecampaign(id):
     """
-    Generate MTurk jobs for the campaign represented by 'id'
+    Generate MTurk jobs for the campaign represented by 'id'. Only once:
+    later rounds of an adaptive campaign are published by the job worker.
+    """
+    campaign = Campaign.query.filter_by(id=id).first_or_404()
+    if campaign.job_generated:
+        flash("The Mechanical Turk jobs for this campaign have already been generated.")
+        return redirect(url_for('.campaigndetails', id=campaign.id))
+    jobs.enqueue('generate_hits', campaign.id)
+    flash("The Mechanical Turk jobs are being generated; check the campaign page for progress.")
+    return redirect(url_for('.listcampaigns'))
+
+@views.route('/campaigns/<id>/archive', methods=['POST'])
+def archivecampaign(id):
     """
-    create_campaign_hits(id)
-    flash("Mechanical Turk campaign created!")
-    return redirect(url_for('listcampaigns'))
+    Queue the archiving of a finished campaign's answers and tallies.
+    """
+    jobs.enqueue('archive_campaign', int(id))
+    flash("The campaign's answers are being archived.")
+    return redirect(url_for('.campaigndetails', id=id))
 
-@app.route('/campaigns/<id>.<filetype>')
+@views.route('/campaigns/<int:id>.<filetype>')
 def downloadresults(id, filetype):
     """
     Emit a parseable version of the campaign results for external consumption.
-    """
-    campaign = Campaign.query.filter_by(id=id).first_or_404()
-    results = campaign.get_result_dump()
 
-    if filetype == "csv":
-        # Build the CSV header
-        out = "\"term\", \"answer\""
-        
-        # Include each possible option in the header
-        for option in campaign.options:
-            out += ", \"%s\"" % option.option_text 
-        
-        # Create a newline before attaching the results
-        out += "\r\n"
-        
-        # Add the results to the CSV
-        for i in range(len(results)):
-            out += "\"%s\", \"%s\"" % (results[i][0], results[i][1])
-            
-            # Loop through the answer breakdown to provide supporting data
-            for option in campaign.options:
-                out += ", \"%s\"" % results[i][2][option.option_text]
-
-            # Add a new line before going to the next result
-            out += "\r\n"
-            
-        return Response(out, mimetype='text/csv')
-    elif filetype == "json":
-        # Returning JSON is as simple as it gets:
-        return Response(json.dumps(results,indent=2), mimetype='text/json')
-    else:
+    Supports csv, json and ndjson, each optionally gzipped (e.g. csv.gz). 
+    The results are streamed a chunk at a time rather than built in memory.
+
+    Downloads carry an ETag and Last-Modified from the campaign's results 
+    version, so unchanged results get a 304, and downloads small enough for
+    the response cache are kept there until the results change.
+    """
+    version = repository.get_campaign_version(id)
+    mimetype = export_mimetype(filetype)
+    if mimetype is None:
         return "Unknown filetype."
+
+    etag = cache.campaign_etag(version, filetype)
+    last_modified = version.results_updated
+    if cache.not_modified(etag, last_modified):
+        return cache.not_modified_response(etag, last_modified)
+
+    body = cache.responses.get(id, filetype, etag)
+    if body is None:
+        campaign = Campaign.query.get(id)
+        stream, mimetype = export_results(campaign, filetype)
+        body = cache.responses.tee(id, filetype, etag, stream)
+
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if filetype.endswith('.gz'):
+        response.headers['Content-Disposition'] = 'attachment; filename=campaign-%s.%s' % (id, filetype)
+    return response
      
 
-@app.route('/fetchresults', methods=['GET', 'POST'])
+@views.route('/jobs/<int:id>.json')
+def jobstatus(id):
+    """
+    Report the status and progress of a background job.
+    """
+    job = jobs.get_job(id)
+    if job is None:
+        abort(404)
+    return Response(json.dumps({'id': job.id,
+                                'task': job.task,
+                                'campaign_id': job.campaign_id,
+                                'status': job.status,
+                                'progress': job.progress,
+                                'error': job.error}), 
+                    mimetype='text/json')
+
+@views.route('/fetchresults', methods=['GET', 'POST'])
 def fetchresults():
-    if retrieve_reviewable_hits() == False:
-        flash("There were no results, wait a few minutes and try again")
-    return redirect(url_for('listcampaigns'))
-
+    """
+    Queue a fetch of the completed HITs; the job worker stores the results.
+    """
+    jobs.enqueue('fetch_results')
+    flash("Fetching results in the background, refresh in a few minutes to see them.")
+    return redirect(url_for('.listcampaigns'))
 
 
-### Application settings ###
-app.secret_key = settings.APP_SECRET_KEY
+@views.route('/metrics')
+def metrics():
+    """
+    Request, SQL and MTurk timings recorded by this process, as JSON.
+    """
+    return Response(json.dumps(instrumentation.metrics(), indent=2, sort_keys=True), 
+                    mimetype='application/json')
 
 if __name__ == '__main__':
+    # The development server; see wsgi.py for production
+    app = create_app()
+    db.create_all()
     app.run(debug=True, port=settings.PORT)
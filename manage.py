@@ -0,0 +1,191 @@
+"""
+Maintenance commands for docsift. Run them from the command line:
+
+    python manage.py migrate
+    python manage.py worker [--once]
+    python manage.py build_quizzes CAMPAIGN_ID DIRECTORY
+    python manage.py rebuild_tallies [campaign id ...]
+    python manage.py rebuild_worker_stats
+    python manage.py archive [campaign id ...]
+    python manage.py workers
+    python manage.py create_campaign --title TITLE --question QUESTION 
+                                     --options FILE --terms FILE [options]
+
+Every command but migrate refuses to run until migrate has brought the 
+schema up to date.
+"""
+from main import create_app
+from models import db, Campaign, WorkerStats
+from loader import create_campaign as load_campaign
+
+from mturk import create_campaign_hits
+
+import aggregation
+import jobs
+import migrations
+import quality
+import time
+
+from decimal import Decimal
+from optparse import OptionParser
+
+import sys
+
+def rebuild_tallies(*campaignids):
+    """
+    Recompute the vote tallies from the raw answers and report any
+    counts that had drifted. Rebuilds every campaign if no ids are given.
+    """
+    if campaignids:
+        campaigns = Campaign.query.filter(Campaign.id.in_(campaignids)).all()
+    else:
+        campaigns = Campaign.query.all()
+
+    for campaign in campaigns:
+        mismatches = campaign.rebuild_tally()
+        db.session.commit()
+        print "Campaign %s (%s): %s mismatched tallies" % (campaign.id, campaign.title, len(mismatches))
+        for termid, optionid, stored, counted in mismatches:
+            print "  term %s, option %s: stored %s, counted %s" % (termid, optionid, stored, counted)
+
+def archive(*campaignids):
+    """
+    Move the answers and tallies of finished campaigns to their archive 
+    files. Archives every finished campaign if no ids are given.
+    """
+    if campaignids:
+        campaigns = Campaign.query.filter(Campaign.id.in_(campaignids)).all()
+    else:
+        campaigns = Campaign.query.filter(Campaign.archived == None).all()
+
+    for campaign in campaigns:
+        if campaign.archive():
+            db.session.commit()
+            print "Campaign %s (%s): archived" % (campaign.id, campaign.title)
+        elif campaignids:
+            print "Campaign %s (%s): %s" % (campaign.id, campaign.title,
+                                            "already archived" if campaign.archived else "not finished")
+
+def rebuild_worker_stats():
+    """
+    Recount every worker's answers and agreement from the raw answers, and
+    apply the review policy to them.
+    """
+    changed = quality.rebuild_worker_stats()
+    db.session.commit()
+    print "Recounted %s workers; tallies changed in %s campaigns" % (WorkerStats.query.count(), len(changed))
+
+def workers():
+    """
+    List the workers the review policy has rejected or blocked.
+    """
+    print "%-20s %-9s %8s %8s %10s %7s" % ("worker", "status", "answers", "compared", "agreement", "rushed")
+    for worker in WorkerStats.query.filter(WorkerStats.status != 'ok').order_by(WorkerStats.worker_id):
+        agreement = worker.agreement()
+        print "%-20s %-9s %8s %8s %10s %3s/%-3s" % (worker.worker_id, worker.status, worker.answers, worker.compared,
+                                                "-" if agreement is None else "%.0f%%" % (agreement * 100),
+                                                worker.rushed, worker.timed)
+
+def create_campaign(*args):
+    """
+    Create a campaign from files of options and terms (one per line). 
+    Use "-" to read the terms from stdin.
+    """
+    parser = OptionParser(usage="python manage.py create_campaign [options]")
+    parser.add_option("--title")
+    parser.add_option("--question", help="the question to ask, with [term] where the term goes")
+    parser.add_option("--options", metavar="FILE", help="file of answers, one per line")
+    parser.add_option("--terms", metavar="FILE", help="file of terms, one per line")
+    parser.add_option("--terms-per-quiz", type="int", default=10)
+    parser.add_option("--reward", default="0.05", help="reward per quiz, in dollars")
+    parser.add_option("--times-per-term", type="int", default=3)
+    parser.add_option("--aggregation", choices=sorted(aggregation.strategies), default="majority",
+                      help="how answers are combined: %s" % ", ".join(sorted(aggregation.strategies)))
+    parser.add_option("--threshold", type="float", help="percentage an answer must pass")
+    parser.add_option("--adaptive", action="store_true", default=False,
+                      help="publish in rounds, re-asking only undecided terms")
+    parser.add_option("--budget", help="most to spend on an adaptive campaign, in dollars")
+    parser.add_option("--no-reuse", dest="reuse_results", action="store_false", default=True,
+                      help="ask every term, even those an earlier campaign decided")
+    opts, _ = parser.parse_args(list(args))
+
+    if not (opts.title and opts.question and opts.options and opts.terms):
+        parser.error("--title, --question, --options and --terms are required")
+
+    terms = sys.stdin if opts.terms == "-" else open(opts.terms)
+    campaign = load_campaign(opts.title.decode('utf-8'),
+                             opts.question.decode('utf-8'),
+                             opts.terms_per_quiz,
+                             Decimal(opts.reward),
+                             opts.times_per_term,
+                             open(opts.options),
+                             terms,
+                             aggregation=opts.aggregation,
+                             threshold=opts.threshold,
+                             adaptive=opts.adaptive,
+                             budget=Decimal(opts.budget) if opts.budget else None,
+                             reuse_results=opts.reuse_results)
+    print "Created campaign %s (%s)" % (campaign.id, campaign.title)
+    reused = campaign.reused_count()
+    if reused:
+        print "%s terms filled in from earlier campaigns, saving $%.2f" % (reused, campaign.savings())
+
+def migrate():
+    """
+    Bring the database schema up to date.
+    """
+    print "Schema is at version %s" % migrations.upgrade()
+
+def worker(*args):
+    """
+    Run the background job worker. With --once, exit when the queue is empty.
+    """
+    jobs.run_worker(once='--once' in args)
+
+def build_quizzes(campaignid, directory):
+    """
+    Dry run of HIT generation: write every quiz page of a campaign to 
+    <directory> as XML without publishing anything, and report the build rate.
+    """
+    if Campaign.query.get(campaignid) is None:
+        print "There is no campaign %s" % campaignid
+        return
+
+    written = [0]
+    def progress(done, total):
+        written[0] = done
+
+    started = time.time()
+    create_campaign_hits(campaignid, progress=progress, dry_run_dir=directory)
+    elapsed = time.time() - started
+    pages = written[0]
+    print "Built %s pages in %.2fs (%.0f pages/s)" % (pages, elapsed, pages / max(elapsed, 0.001))
+
+commands = {
+    'migrate': migrate,
+    'worker': worker,
+    'build_quizzes': build_quizzes,
+    'rebuild_tallies': rebuild_tallies,
+    'rebuild_worker_stats': rebuild_worker_stats,
+    'workers': workers,
+    'archive': archive,
+    'create_campaign': create_campaign,
+}
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in commands:
+        print __doc__
+        return 1
+
+    create_app()
+    if argv[1] != 'migrate':
+        version = migrations.get_version()
+        if version != migrations.latest_version():
+            print "The database schema is at version %s, not %s: run \"python manage.py migrate\" first" % \
+                  (version, migrations.latest_version())
+            return 1
+    commands[argv[1]](*argv[2:])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
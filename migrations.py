@@ -0,0 +1,256 @@
+"""
+Schema migrations.
+
+db.create_all() only creates tables that don't exist yet, so changes to 
+existing tables (new columns, new indexes) are made by the migrations below.
+Each migration checks the live schema before changing anything, so they are
+safe to run against a brand new database as well as an old one. The last
+version applied is kept in the schema_version table.
+
+Work on the data that goes through the models (which select every column
+they have) is queued with afterwards() and run once all the pending 
+migrations have brought the schema up to date.
+
+    python manage.py migrate
+"""
+from models import db, ActionLog, AssignmentSync, Campaign, CampaignAnswer, CampaignOption, \
+                   CampaignPage, CampaignTally, CampaignTerm, WorkerStats
+from sqlalchemy.engine.reflection import Inspector
+
+import quality
+import reuse
+
+### Schema helpers ###
+def column_names(tablename):
+    return set(column['name'] for column in Inspector.from_engine(db.engine).get_columns(tablename))
+
+def index_names(tablename):
+    return set(index['name'] for index in Inspector.from_engine(db.engine).get_indexes(tablename))
+
+def add_column(model, name, default=None):
+    """
+    Add the column <name> of <model> to its table if it isn't there yet.
+    <default> is an SQL literal. Returns True if the column was added.
+    """
+    table = model.__table__
+    if name in column_names(table.name):
+        return False
+
+    column = table.c[name]
+    ddl = "ALTER TABLE %s ADD COLUMN %s %s" % (table.name, column.name, 
+                                               column.type.compile(dialect=db.engine.dialect))
+    if default is not None:
+        ddl += " DEFAULT %s" % default
+    db.engine.execute(ddl)
+    return True
+
+def create_indexes(model):
+    """
+    Create any of <model>'s indexes that are missing from the database. 
+    Indexes on columns that a later migration adds are left to it.
+    """
+    existing = index_names(model.__table__.name)
+    columns = column_names(model.__table__.name)
+    for index in model.__table__.indexes:
+        if index.name not in existing and set(column.name for column in index.columns) <= columns:
+            print "  creating index %s" % index.name
+            index.create(db.engine)
+
+def delete_duplicates(tablename, columns):
+    """
+    Delete all but the first row of each group of rows that share <columns>.
+    Returns the number of rows deleted.
+    """
+    result = db.engine.execute("DELETE FROM %(table)s WHERE id NOT IN "
+                               "(SELECT id FROM (SELECT MIN(id) AS id FROM %(table)s "
+                               "GROUP BY %(columns)s) AS keep)" % 
+                               {'table': tablename, 'columns': ", ".join(columns)})
+    return result.rowcount
+
+# Data work queued by the migrations being applied
+deferred = []
+
+def afterwards(func):
+    """
+    Run func() once every pending migration has been applied.
+    """
+    if func not in deferred:
+        deferred.append(func)
+
+def rebuild_all_tallies():
+    for campaign in Campaign.query.all():
+        campaign.rebuild_tally()
+    db.session.commit()
+
+### Migrations ###
+def add_answer_count():
+    """
+    Per-campaign answer totals, filled in from the raw answers.
+    """
+    if add_column(Campaign, 'answer_count', '0'):
+        afterwards(rebuild_all_tallies)
+
+def add_indexes():
+    """
+    Indexes on the columns used by the tally, listing and ingest queries, and
+    uniqueness on answers (hit, worker, term), tallies and pages. Duplicate 
+    rows that would break the unique indexes are removed first.
+    """
+    removed = delete_duplicates('campaign_answer', ['hit', 'worker', 'term_id'])
+    removed += delete_duplicates('campaign_tally', ['campaign_id', 'term_id', 'option_id'])
+    delete_duplicates('campaign_page', ['campaign_id', 'page_number'])
+    if removed:
+        print "  removed %s duplicate answers and tallies" % removed
+        afterwards(rebuild_all_tallies)
+
+    for model in (ActionLog, CampaignOption, CampaignTerm, CampaignAnswer, CampaignPage, CampaignTally):
+        create_indexes(model)
+
+def add_aggregation_settings():
+    """
+    Per-campaign aggregation strategy and threshold. Existing campaigns keep
+    majority voting against the global THRESHOLD.
+    """
+    add_column(Campaign, 'aggregation', "'majority'")
+    add_column(Campaign, 'threshold')
+
+def add_adaptive_rounds():
+    """
+    Adaptive campaign settings and round tracking, and what each page asked
+    for. Campaigns that were already generated count as having published
+    their first round.
+    """
+    add_column(Campaign, 'adaptive', "'0'")
+    add_column(Campaign, 'budget')
+    if add_column(Campaign, 'rounds_published', '0'):
+        db.engine.execute("UPDATE campaign SET rounds_published = 1 WHERE job_generated")
+    add_column(Campaign, 'finished', "'0'")
+
+    add_column(CampaignPage, 'round', '0')
+    add_column(CampaignPage, 'assignments')
+    add_column(CampaignPage, 'term_ids')
+    add_column(CampaignPage, 'completed', "'0'")
+    create_indexes(CampaignPage)
+
+def add_results_version():
+    """
+    Results version and time of the last change, which the response cache
+    uses for ETags and Last-Modified. Existing campaigns start from when
+    they were created.
+    """
+    add_column(Campaign, 'results_version', '0')
+    if add_column(Campaign, 'results_updated'):
+        db.engine.execute("UPDATE campaign SET results_updated = created_date")
+
+def add_term_outcomes():
+    """
+    Each term's stored outcome, used to page through and filter results on
+    the campaign page, worked out for every existing campaign.
+    """
+    add_column(CampaignTerm, 'decided', '0')
+    add_column(CampaignTerm, 'answer_option_id')
+    add_column(CampaignTerm, 'answer_percentage')
+    add_column(Campaign, 'outcomes_version', '0')
+    create_indexes(CampaignTerm)
+    afterwards(refresh_all_outcomes)
+
+def refresh_all_outcomes():
+    for campaign in Campaign.query.all():
+        print "  working out the outcomes of campaign %s" % campaign.id
+        campaign.refresh_outcomes()
+        db.session.commit()
+
+def add_worker_stats():
+    """
+    Worker statistics and which answers are excluded from the tallies, with
+    the statistics filled in from the answers already stored (which may 
+    reject some workers, see quality).
+    """
+    add_column(CampaignAnswer, 'excluded', '0')
+    add_column(AssignmentSync, 'worker_id')
+    create_indexes(WorkerStats)
+    afterwards(rebuild_worker_stats)
+
+def rebuild_worker_stats():
+    quality.rebuild_worker_stats()
+    db.session.commit()
+    rejected = WorkerStats.query.filter(WorkerStats.status != 'ok').count()
+    print "  worker statistics: %s workers, %s rejected" % (WorkerStats.query.count(), rejected)
+
+def add_archives():
+    """
+    When each campaign's answers were archived (see archive).
+    """
+    add_column(Campaign, 'archived')
+
+def add_term_fingerprints():
+    """
+    Fingerprints of every term, so their outcomes can be reused by later
+    campaigns (see reuse), and which terms reused one.
+    """
+    add_column(CampaignTerm, 'fingerprint')
+    add_column(CampaignTerm, 'reused_from')
+    add_column(Campaign, 'reuse_results', '0')
+    create_indexes(CampaignTerm)
+    afterwards(fingerprint_all_terms)
+
+def add_change_numbers():
+    """
+    Which change (see models.next_change) last touched each term's and 
+    campaign's results. Results from before this are never reported as 
+    changed; the change counter's table is created by create_all.
+    """
+    add_column(CampaignTerm, 'changed')
+    add_column(Campaign, 'changed')
+    create_indexes(CampaignTerm)
+
+def fingerprint_all_terms():
+    for campaign in Campaign.query.all():
+        print "  fingerprinting the terms of campaign %s" % campaign.id
+        reuse.fingerprint_terms(campaign)
+        db.session.commit()
+
+# (version, description, migration), in the order they are applied
+migrations = [
+    (1, "Add campaign answer totals", add_answer_count),
+    (2, "Index answers, terms, options, tallies, pages and the action log", add_indexes),
+    (3, "Add per-campaign aggregation strategy and threshold", add_aggregation_settings),
+    (4, "Add adaptive rounds to campaigns and pages", add_adaptive_rounds),
+    (5, "Add campaign results versions", add_results_version),
+    (6, "Store term outcomes for paging through results", add_term_outcomes),
+    (7, "Add worker statistics and excluded answers", add_worker_stats),
+    (8, "Add campaign archives", add_archives),
+    (9, "Add term fingerprints for reusing earlier results", add_term_fingerprints),
+    (10, "Add change numbers for syncing results", add_change_numbers),
+]
+
+### Versioning ###
+def get_version():
+    db.engine.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    version = db.engine.execute("SELECT MAX(version) FROM schema_version").scalar()
+    return version or 0
+
+def latest_version():
+    return migrations[-1][0]
+
+def set_version(version):
+    db.engine.execute("DELETE FROM schema_version")
+    db.engine.execute("INSERT INTO schema_version (version) VALUES (%s)" % int(version))
+
+def upgrade():
+    """
+    Create any missing tables, then apply the migrations that haven't been
+    applied yet. Returns the schema version reached.
+    """
+    db.create_all()
+    current = get_version()
+    del deferred[:]
+    for version, description, migrate in migrations:
+        if version > current:
+            print "Migration %s: %s" % (version, description)
+            migrate()
+            current = version
+    for func in deferred:
+        func()
+    set_version(current)
+    return current
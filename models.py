@@ -1,231 +1,1312 @@
-from datetime import datetime
-from flask import Flask
-from flaskext.sqlalchemy import SQLAlchemy
-
-import math
-import settings
-
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = settings.DATABASE_URI
-db = SQLAlchemy(app)
-
-class ActionLog(db.Model):
-    """ 
-    Logging for activities on the site.
-    """
-    id = db.Column(db.Integer, primary_key=True)
-    log_time = db.Column(db.DateTime)
-    log_source = db.Column(db.String(100))
-    log_message = db.Column(db.String(2000))
-
-    def __init__(self, source, message):
-        self.log_time = datetime.utcnow()
-        self.log_source = source
-        self.log_message = message
-
-    def __repr__(self):
-        return "<Event: %s in %s at %s>" % (self.log_message, self.log_source, self.log_message)
-
-class Campaign(db.Model):
-    """
-    The categorization campaign.
-    """
-    id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String(80))
-    question = db.Column(db.String(500))
-    options = db.relationship("CampaignOption")
-    terms = db.relationship("CampaignTerm")
-    answers = db.relationship("CampaignAnswer")
-    reward_per_quiz = db.Column(db.Numeric)
-    terms_per_quiz = db.Column(db.Integer)
-    times_per_term = db.Column(db.Integer)
-    job_generated = db.Column(db.Boolean, default=False)
-    created_date = db.Column(db.DateTime)
-    
-    def cost(self):
-        """
-        Calculate how much a campaign will cost
-        """
-        numquizzes = math.ceil(
-            (len(self.terms) * self.times_per_term) / float(self.terms_per_quiz))
-        cost = float(numquizzes) * float(self.reward_per_quiz)
-        return cost
-
-    def get_results(self):
-        """
-        Used to display campaign results on the details page.
-        """
-        results = []
-        for term in self.terms:
-            result = [ResultItem(option.id,
-                                 option.option_text,
-                                 CampaignAnswer.query.filter_by(option_id = option.id,
-                                                              term_id = term.id).count(),
-                                 self.times_per_term) for option in self.options]
-            results.append(CampaignResult(term.id, term.term, result))
-        return results
-
-    def get_result_dump(self):
-        """ 
-        Use this to get a raw-ish dump of the results.
-        """
-        results = []
-        answered_times = 0
-        chosen_answer = ""
-        for term in self.terms:
-            answers = dict([(option.option_text,
-                            CampaignAnswer.query.filter_by(option_id = option.id,
-                                                           term_id = term.id).count())
-                            for option in self.options])
-            bestanswer = max(answers, key=answers.get)
-            bestanswer_count = answers[bestanswer]
-            bestanswer_percent = (bestanswer_count / float(self.times_per_term) * 100)
-
-            if bestanswer_percent < settings.THRESHOLD:
-                # If the required threshold hasn't been met, there is no real best answer
-                bestanswer = ""
-
-            result = [term.term, bestanswer,  answers]
-            results.append(result)
-
-        return results
-
-    def __init__(self, title, question, terms_per_quiz=None, reward_per_quiz=None, 
-                 times_per_term=None, created_date=None):
-        self.title = title
-        self.question = question
-        self.reward_per_quiz = reward_per_quiz
-        self.terms_per_quiz = terms_per_quiz
-        self.times_per_term = times_per_term
-        if created_date is None:
-            self.created_date = datetime.utcnow()
-
-    def __repr__(self):
-        return '<Campaign %r>' % self.title
-
-class CampaignOption(db.Model):
-    """
-    Represents the question displayed to the answerer: e.g. "Is this item a vegetable?"
-    """
-    id = db.Column(db.Integer, primary_key=True)
-    option_text = db.Column(db.String(500))
-
-    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'))
-    campaign = db.relationship('Campaign', 
-                               backref=db.backref('campaign_option', lazy='dynamic'))
-
-    answers = db.relationship('CampaignAnswer')
-    
-    def __init__(self, campaign, option_text):
-        self.campaign = campaign
-        self.option_text = option_text
-
-class CampaignTerm(db.Model):
-    """
-    The term being categorized.
-    """
-    id = db.Column(db.Integer, primary_key=True)
-    term = db.Column(db.String(100))
-
-    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'))
-    campaign = db.relationship('Campaign', 
-                               backref=db.backref('campaign_term', lazy='dynamic'))
-
-    answers = db.relationship("CampaignAnswer")
-
-    def __init__(self, campaign, term):
-        self.campaign = campaign
-        self.term = term
-
-class CampaignAnswer(db.Model):
-    """
-    The answerer's categorization of the term. 
-    There will be many of these for each term.
-    """
-    id = db.Column(db.Integer, primary_key=True)
-    hit = db.Column(db.String(50))
-    worker = db.Column(db.String(50))
-
-    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'))
-    term_id = db.Column(db.Integer, db.ForeignKey('campaign_term.id'))
-    option_id = db.Column(db.Integer, db.ForeignKey('campaign_option.id'))
-
-    campaign = db.relationship('Campaign',
-                               backref=db.backref('campaign_answer'))
-
-    term = db.relationship('CampaignTerm', 
-                           backref=db.backref('campaign_answer'))
-  
-    option = db.relationship('CampaignOption',
-                             backref=db.backref('campaign_answer'))
-
-    def __init__(self, hit, worker, campaign_id, term_id, option_id):
-        self.hit = hit
-        self.worker = worker
-        self.campaign_id = campaign_id
-        self.term_id = term_id
-        self.option_id = option_id
-    
-    def __repr__(self):
-        return "<Answer: '%s - %s'>" % (self.term.term, self.option.option_text)
-
-class ResultItem():
-    """
-    A non-database class used for reporting campaign results.
-    """
-    def __init__(self, option_id, option_text, times_selected, total_selections):
-        self.option_id = option_id
-        self.option_text = option_text
-        self.times_selected = times_selected
-        self.total_selections = total_selections
-        self.percentage = int((times_selected / float(total_selections)) * 100)
-        
-    def __repr__(self):
-        return "<Result: %s, %s%%>" % (self.answer, self.percentage)
-
-class CampaignResult():
-    """
-    A non-database class used for reporting campaign results.
-    """
-    def answer_breakdown(self):
-        """
-        Create a breakdown of answer selections for use in the 
-        summary view of the campaign.
-        """
-        out = ""
-        for result in self.results:
-            out += "%s: %s%% " % (result.option_text, result.percentage)
-        return out
-
-    def is_inconclusive(self, threshold=settings.THRESHOLD):
-        """
-        Return True if the result is inconclusive, otherwise return False.
-        """
-        print "testing conclusiveness"
-        inconclusive = True
-        for result in self.results:
-            if result.percentage > threshold:
-                inconclusive = False
-        return inconclusive
-
-    def choose_answer(self, threshold=settings.THRESHOLD):
-        """
-        Select the most frequently chosen answer.
-        """
-        answer = ResultItem(-1, "Inconclusive",0,1)
-        for result in self.results:
-            if (result.percentage > answer.percentage) and (result.percentage > threshold):
-                answer = result
-        return answer
-
-    def __init__(self, termid, term, result_items):
-        self.termid = termid
-        self.term = term
-        self.results = result_items
-        self.answer = self.choose_answer()
-    
-    def __repr__(self):
-        answer = self.choose_answer()
-        return (self.term, answer.answer_text, answer.percentage)
-
-
+from datetime import datetime
+from flaskext.sqlalchemy import SQLAlchemy
+from sqlalchemy.pool import QueuePool
+
+import aggregation
+import archive
+import math
+import numpy
+import settings
+
+# Answers read at a time when aggregating a campaign's raw answers
+ANSWER_BATCH_SIZE = getattr(settings, 'ANSWER_BATCH_SIZE', 50000)
+
+# Keep IN (...) clauses well under the database's parameter limits
+LOOKUP_BATCH_SIZE = 500
+
+def batches(items):
+    """
+    <items> a LOOKUP_BATCH_SIZE list at a time.
+    """
+    items = list(items)
+    for start in range(0, len(items), LOOKUP_BATCH_SIZE):
+        yield items[start:start + LOOKUP_BATCH_SIZE]
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    flaskext.sqlalchemy with a couple more pool options: max_overflow, and
+    a real pool for SQLite files (which otherwise open a new connection 
+    every time one is needed) when a pool size is set. Pooled SQLite
+    connections are handed from thread to thread, but only ever used by
+    one at a time.
+    """
+    def apply_pool_defaults(self, app, options):
+        SQLAlchemy.apply_pool_defaults(self, app, options)
+        if app.config.get('SQLALCHEMY_MAX_OVERFLOW') is not None:
+            options['max_overflow'] = app.config['SQLALCHEMY_MAX_OVERFLOW']
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername == 'sqlite' and options.get('pool_size'):
+            options['poolclass'] = QueuePool
+            options['connect_args'] = {'check_same_thread': False}
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+db = PooledSQLAlchemy()
+
+def init_db(app):
+    """
+    Configure the database from settings and bind it to <app>, the one
+    application in the process. Background jobs and commands use the same
+    binding outside of any request. Doesn't connect or create any tables.
+    """
+    app.config['SQLALCHEMY_DATABASE_URI'] = settings.DATABASE_URI
+    # Lets instrumentation count the queries made by each request
+    app.config['SQLALCHEMY_RECORD_QUERIES'] = getattr(settings, 'RECORD_QUERIES', True)
+    app.config['SQLALCHEMY_POOL_SIZE'] = getattr(settings, 'DB_POOL_SIZE', None)
+    app.config['SQLALCHEMY_POOL_TIMEOUT'] = getattr(settings, 'DB_POOL_TIMEOUT', None)
+    app.config['SQLALCHEMY_POOL_RECYCLE'] = getattr(settings, 'DB_POOL_RECYCLE', None)
+    app.config['SQLALCHEMY_MAX_OVERFLOW'] = getattr(settings, 'DB_MAX_OVERFLOW', None)
+    db.init_app(app)
+    db.app = app
+
+class ActionLog(db.Model):
+    """ 
+    Logging for activities on the site.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    log_time = db.Column(db.DateTime, index=True)
+    log_source = db.Column(db.String(100))
+    log_message = db.Column(db.String(2000))
+
+    def __init__(self, source, message):
+        self.log_time = datetime.utcnow()
+        self.log_source = source
+        self.log_message = message
+
+    def __repr__(self):
+        return "<Event: %s in %s at %s>" % (self.log_message, self.log_source, self.log_message)
+
+class Campaign(db.Model):
+    """
+    The categorization campaign.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(80))
+    question = db.Column(db.String(500))
+    options = db.relationship("CampaignOption", order_by="CampaignOption.id")
+    terms = db.relationship("CampaignTerm", order_by="CampaignTerm.id")
+    answers = db.relationship("CampaignAnswer")
+    reward_per_quiz = db.Column(db.Numeric)
+    terms_per_quiz = db.Column(db.Integer)
+    times_per_term = db.Column(db.Integer)
+    job_generated = db.Column(db.Boolean, default=False)
+    created_date = db.Column(db.DateTime)
+    answer_count = db.Column(db.Integer, default=0)
+    aggregation = db.Column(db.String(20), default='majority')
+    threshold = db.Column(db.Float)
+    adaptive = db.Column(db.Boolean, default=False)
+    budget = db.Column(db.Numeric)
+    rounds_published = db.Column(db.Integer, default=0)
+    finished = db.Column(db.Boolean, default=False)
+    results_version = db.Column(db.Integer, default=0)
+    results_updated = db.Column(db.DateTime)
+    outcomes_version = db.Column(db.Integer, default=0)
+    # When the answers and tallies were moved to the campaign's archive file
+    archived = db.Column(db.DateTime)
+    # Fill in terms an earlier campaign already decided (see reuse)
+    reuse_results = db.Column(db.Boolean, default=False)
+    # The last change (see next_change) to any of its terms' results
+    changed = db.Column(db.Integer)
+    
+    def touch_results(self, outcomes_changed=True):
+        """
+        Mark the campaign's results as changed, so cached pages and 
+        downloads built from them are rebuilt. Unless <outcomes_changed> is
+        False, the terms' stored outcomes are now out of date too.
+        """
+        in_sync = (self.outcomes_version or 0) == (self.results_version or 0)
+        self.results_version = (self.results_version or 0) + 1
+        self.results_updated = datetime.utcnow()
+        if in_sync and not outcomes_changed:
+            self.outcomes_version = self.results_version
+
+    def term_count(self):
+        """
+        The number of terms in the campaign, counted without loading them.
+        """
+        return db.session.query(db.func.count(CampaignTerm.id)) \
+                         .filter(CampaignTerm.campaign_id == self.id) \
+                         .scalar()
+
+    def reused_count(self):
+        """
+        The number of terms whose outcome was reused from an earlier campaign.
+        """
+        return db.session.query(db.func.count(CampaignTerm.id)) \
+                         .filter(CampaignTerm.campaign_id == self.id) \
+                         .filter(CampaignTerm.reused_from != None) \
+                         .scalar()
+
+    def quiz_cost(self, numterms):
+        """
+        What asking <numterms> terms times_per_term times costs.
+        """
+        numquizzes = math.ceil((numterms * self.times_per_term) / float(self.terms_per_quiz))
+        return float(numquizzes) * float(self.reward_per_quiz)
+
+    def cost(self):
+        """
+        Calculate how much a campaign will cost. For an adaptive campaign 
+        this is the most it can cost: every term asked times_per_term times,
+        or the budget if that's lower. Terms reused from earlier campaigns
+        aren't asked, so they cost nothing.
+        """
+        cost = self.quiz_cost(self.term_count() - self.reused_count())
+        if self.adaptive and self.budget is not None:
+            cost = min(cost, float(self.budget))
+        return cost
+
+    def savings(self):
+        """
+        What asking the reused terms as well would have cost.
+        """
+        reused = self.reused_count()
+        if not reused:
+            return 0.0
+        total = self.term_count()
+        return self.quiz_cost(total) - self.quiz_cost(total - reused)
+
+    def spent(self):
+        """
+        What the HITs published so far cost, i.e. the reward for every 
+        assignment they ask for.
+        """
+        assignments = db.session.query(db.func.sum(db.func.coalesce(CampaignPage.assignments, 
+                                                                    self.times_per_term))) \
+                                .filter(CampaignPage.campaign_id == self.id) \
+                                .scalar()
+        return float(assignments or 0) * float(self.reward_per_quiz)
+
+    def count_votes(self):
+        """
+        Count the raw answers for every term/option pair with a single grouped query.
+
+        Returns a list of (term_id, option_id, votes) tuples. This is the 
+        expensive path; the pages read from the CampaignTally table instead.
+        An archived campaign's votes are its archived tallies.
+        """
+        if self.archived:
+            return archive.read_tallies(self.id)
+        return db.session.query(CampaignAnswer.term_id,
+                                CampaignAnswer.option_id,
+                                db.func.count(CampaignAnswer.id)) \
+                         .filter(CampaignAnswer.campaign_id == self.id) \
+                         .filter(CampaignAnswer.excluded == False) \
+                         .group_by(CampaignAnswer.term_id, CampaignAnswer.option_id) \
+                         .all()
+
+    def get_tallies(self, termids=None):
+        """
+        (term_id, option_id, votes) for the campaign's tallies, or just those
+        of <termids>: from the tally table, or the archive once the campaign
+        has been archived.
+        """
+        if self.archived:
+            return archive.read_tallies(self.id, termids)
+        tallies = db.session.query(CampaignTally.term_id,
+                                   CampaignTally.option_id,
+                                   CampaignTally.votes) \
+                            .filter(CampaignTally.campaign_id == self.id)
+        if termids is not None:
+            tallies = tallies.filter(CampaignTally.term_id.in_(termids))
+        return tallies
+
+    def get_vote_matrix(self):
+        """
+        Read the vote count for every term/option pair from the tally table.
+
+        Returns a dictionary of {term_id: {option_id: votes}}. Pairs that
+        haven't received any votes yet are filled in with 0.
+        """
+        matrix = dict((termid, dict((option.id, 0) for option in self.options))
+                      for termid, in db.session.query(CampaignTerm.id)
+                                              .filter(CampaignTerm.campaign_id == self.id))
+
+        for term_id, option_id, votes in self.get_tallies():
+            if term_id in matrix and option_id in matrix[term_id]:
+                matrix[term_id][option_id] = votes
+        return matrix
+
+    def get_threshold(self):
+        """
+        The percentage an answer has to pass to be accepted; the global
+        THRESHOLD unless the campaign sets its own.
+        """
+        if self.threshold is None:
+            return settings.THRESHOLD
+        return self.threshold
+
+    def get_answer_block(self, termids, optionids, batch_size=ANSWER_BATCH_SIZE):
+        """
+        Read the campaign's raw answers (from the database or its archive),
+        <batch_size> at a time, into arrays for the aggregation strategies.
+        <termids> and <optionids> must be sorted; answers to other terms or
+        options are left out.
+
+        Returns (counts, (rows, columns, workers)) as described in aggregation.
+        """
+        termids = numpy.asarray(termids, dtype=numpy.int64)
+        optionids = numpy.asarray(optionids, dtype=numpy.int64)
+        workernumbers = {}
+        rows, columns, workers = [], [], []
+
+        for batch in self.iter_answer_batches(batch_size):
+            answerterms = numpy.array([answer[2] for answer in batch], dtype=numpy.int64)
+            answeroptions = numpy.array([answer[3] for answer in batch], dtype=numpy.int64)
+            answerworkers = numpy.array([workernumbers.setdefault(answer[1], len(workernumbers))
+                                         for answer in batch], dtype=numpy.int64)
+
+            row = numpy.minimum(numpy.searchsorted(termids, answerterms), max(len(termids) - 1, 0))
+            column = numpy.minimum(numpy.searchsorted(optionids, answeroptions), max(len(optionids) - 1, 0))
+            if len(termids) and len(optionids):
+                known = (termids[row] == answerterms) & (optionids[column] == answeroptions)
+            else:
+                known = numpy.zeros(len(batch), dtype=bool)
+            rows.append(row[known])
+            columns.append(column[known])
+            workers.append(answerworkers[known])
+
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        rows = numpy.concatenate(rows) if rows else empty
+        columns = numpy.concatenate(columns) if columns else empty
+        workers = numpy.concatenate(workers) if workers else empty
+
+        counts = numpy.zeros((len(termids), len(optionids)), dtype=numpy.int32)
+        numpy.add.at(counts, (rows, columns), 1)
+        return counts, (rows, columns, workers)
+
+    def iter_answer_batches(self, batch_size):
+        """
+        The campaign's counted answers as lists of up to <batch_size> 
+        (id, worker, term_id, option_id) tuples, in id order.
+        """
+        if self.archived:
+            answers = archive.read_answers(self.id)
+            for start in xrange(0, len(answers), batch_size):
+                yield answers[start:start + batch_size]
+            return
+
+        lastid = 0
+        while True:
+            batch = db.session.query(CampaignAnswer.id,
+                                     CampaignAnswer.worker,
+                                     CampaignAnswer.term_id,
+                                     CampaignAnswer.option_id) \
+                              .filter(CampaignAnswer.campaign_id == self.id) \
+                              .filter(CampaignAnswer.excluded == False) \
+                              .filter(CampaignAnswer.id > lastid) \
+                              .order_by(CampaignAnswer.id) \
+                              .limit(batch_size) \
+                              .all()
+            if not batch:
+                break
+            lastid = batch[-1][0]
+            yield batch
+
+    def get_inconclusive_terms(self, threshold=None):
+        """
+        The text of every term whose best answer hasn't passed <threshold>
+        (the campaign's threshold by default). For majority voting this is 
+        a single query against the tally table.
+        """
+        if threshold is None:
+            threshold = self.get_threshold()
+        if self.aggregation not in (None, 'majority') or self.archived:
+            results = self.get_results(threshold)
+            return [results.terms[row] for row in numpy.flatnonzero(results.inconclusive())]
+
+        # A term is conclusive when int(votes / times_per_term * 100) > threshold
+        # (see CampaignResult.is_inconclusive), i.e. when 
+        # votes * 100 >= (floor(threshold) + 1) * times_per_term
+        required = (int(math.floor(threshold)) + 1) * self.times_per_term
+
+        best = db.session.query(CampaignTally.term_id.label('term_id'),
+                                db.func.max(CampaignTally.votes).label('votes')) \
+                         .filter(CampaignTally.campaign_id == self.id) \
+                         .group_by(CampaignTally.term_id) \
+                         .subquery()
+        terms = db.session.query(CampaignTerm.term) \
+                          .outerjoin(best, CampaignTerm.id == best.c.term_id) \
+                          .filter(CampaignTerm.campaign_id == self.id) \
+                          .filter(CampaignTerm.reused_from == None) \
+                          .filter(db.func.coalesce(best.c.votes, 0) * 100 < required) \
+                          .order_by(CampaignTerm.id)
+        return [term for term, in terms]
+
+    def rebuild_tally(self):
+        """
+        Recompute the tally table and answer total from the raw answers.
+
+        Returns a list of (term_id, option_id, stored, counted) tuples for
+        every pair whose stored tally didn't match the raw answers. The
+        changes are left in the session for the caller to commit. Archived
+        campaigns have nothing to rebuild.
+        """
+        if self.archived:
+            return []
+        counted = dict(((term_id, option_id), votes)
+                       for term_id, option_id, votes in self.count_votes())
+        stored = dict(((tally.term_id, tally.option_id), tally.votes)
+                      for tally in CampaignTally.query.filter_by(campaign_id=self.id))
+
+        mismatches = []
+        for key in sorted(set(counted) | set(stored)):
+            if counted.get(key, 0) != stored.get(key, 0):
+                mismatches.append((key[0], key[1], stored.get(key, 0), counted.get(key, 0)))
+
+        CampaignTally.query.filter_by(campaign_id=self.id).delete()
+        if counted:
+            db.session.execute(CampaignTally.__table__.insert(),
+                               [dict(campaign_id=self.id, term_id=term_id,
+                                     option_id=option_id, votes=votes)
+                                for (term_id, option_id), votes in counted.items()])
+        self.answer_count = sum(counted.values())
+        if mismatches:
+            self.touch_results()
+            self.refresh_outcomes()
+        db.session.add(self)
+        return mismatches
+
+    def refresh_outcomes(self):
+        """
+        Work out every term's outcome from the current results and store
+        the ones that changed (see CampaignTerm), marking them with a new 
+        change number. Left in the session for the caller to commit.
+        """
+        version = self.results_version or 0
+        stored = dict((termid, (bool(decided), answer_option_id, answer_percentage))
+                      for termid, decided, answer_option_id, answer_percentage
+                      in db.session.query(CampaignTerm.id, CampaignTerm.decided,
+                                          CampaignTerm.answer_option_id,
+                                          CampaignTerm.answer_percentage)
+                                   .filter(CampaignTerm.campaign_id == self.id))
+        outcomes = [outcome for outcome in outcome_rows(self.get_results())
+                    if stored.get(outcome[0]) != outcome[1:]]
+        if outcomes:
+            self.changed = next_change()
+            write_outcomes(outcomes, self.changed)
+        self.outcomes_version = version
+        db.session.add(self)
+
+    def get_result_slice(self, after=None, limit=100, outcome=None, since=None):
+        """
+        Up to <limit> terms' results, in term order, starting after the term
+        with id <after>. <outcome> picks which terms: 'decided', 
+        'inconclusive', an option id (terms decided for that option) or
+        None for all of them. With <since>, only terms whose results have
+        changed after that change number (see next_change) are included.
+
+        The terms are found by their stored outcomes through an index, and
+        only their own tallies are read, so a slice costs the same however
+        large the campaign is. Returns (ResultMatrix, the id to pass as 
+        <after> for the next slice or None if this is the last).
+        """
+        query = db.session.query(CampaignTerm.id, CampaignTerm.term,
+                                 CampaignTerm.answer_option_id, CampaignTerm.answer_percentage,
+                                 CampaignTerm.reused_from) \
+                          .filter(CampaignTerm.campaign_id == self.id)
+        if outcome == 'decided':
+            query = query.filter(CampaignTerm.decided == True)
+        elif outcome == 'inconclusive':
+            query = query.filter(CampaignTerm.decided == False)
+        elif outcome is not None:
+            query = query.filter(CampaignTerm.answer_option_id == int(outcome))
+        if since is not None:
+            query = query.filter(CampaignTerm.changed > since)
+        if after is not None:
+            query = query.filter(CampaignTerm.id > after)
+        rows = query.order_by(CampaignTerm.id).limit(limit + 1).all()
+        following = rows[limit - 1][0] if len(rows) > limit else None
+        rows = rows[:limit]
+
+        termids = [row[0] for row in rows]
+        tallies = self.get_tallies(termids) if termids else []
+        options = [(option.id, option.option_text) for option in self.options]
+        matrix = ResultMatrix.from_outcomes([(row[0], row[1]) for row in rows], options,
+                                            tallies, self.times_per_term, self.get_threshold(),
+                                            [(row[2], row[3]) for row in rows])
+        matrix.reused[:] = [row[4] is not None for row in rows]
+        return matrix, following
+
+    def get_results(self, threshold=None):
+        """
+        Used to display campaign results on the details page. Returns a 
+        ResultMatrix, which can be iterated for one CampaignResult per term.
+
+        Majority results come straight from the tally table; the other 
+        aggregation strategies read the raw answers. Terms reused from an
+        earlier campaign keep the outcome they were given.
+        """
+        if threshold is None:
+            threshold = self.get_threshold()
+        terms = db.session.query(CampaignTerm.id, CampaignTerm.term) \
+                          .filter(CampaignTerm.campaign_id == self.id) \
+                          .order_by(CampaignTerm.id) \
+                          .all()
+        options = [(option.id, option.option_text) for option in self.options]
+
+        strategy = self.aggregation or 'majority'
+        if strategy != 'majority':
+            counts, answers = self.get_answer_block([termid for termid, term in terms],
+                                                    [optionid for optionid, option_text in options])
+            scores = aggregation.strategies[strategy](counts, answers, self.times_per_term)
+            matrix = ResultMatrix(terms, options, counts, self.times_per_term, threshold, scores)
+        else:
+            matrix = ResultMatrix.from_tallies(terms, options, self.get_tallies(), 
+                                               self.times_per_term, threshold)
+        matrix.reuse(self.reused_outcomes())
+        return matrix
+
+    def reused_outcomes(self):
+        """
+        (term_id, answer_option_id, answer_percentage) of the terms whose 
+        outcome was reused from an earlier campaign.
+        """
+        return db.session.query(CampaignTerm.id, CampaignTerm.answer_option_id,
+                                CampaignTerm.answer_percentage) \
+                         .filter(CampaignTerm.campaign_id == self.id) \
+                         .filter(CampaignTerm.reused_from != None)
+
+    def get_result_dump(self):
+        """ 
+        Use this to get a raw-ish dump of the results.
+        """
+        return [result for chunk in self.iter_result_chunks() for result in chunk]
+
+    def iter_result_chunks(self, chunk_size=1000):
+        """
+        Generate the result dump in lists of up to <chunk_size> terms, so large
+        campaigns can be exported without holding every result in memory.
+
+        The campaign's own fields are read before the generator is returned
+        and the results are read through a session of its own, which lets it
+        be consumed after the request's session has been removed (e.g. by a
+        streaming response).
+        """
+        if self.aggregation not in (None, 'majority'):
+            return _iter_matrix_chunks(self.get_results(), chunk_size)
+        options = [(option.id, option.option_text) for option in self.options]
+        return _iter_result_chunks(self.id, self.times_per_term, options, 
+                                   self.get_threshold(), chunk_size, bool(self.archived))
+
+    def is_finished(self):
+        """
+        True once every HIT published for the campaign has come back and
+        been reviewed and, for an adaptive campaign, its last round is done.
+        """
+        return self.id in finished_campaigns([self])
+
+    def archive(self):
+        """
+        Move the campaign's answers and tallies to its archive file (see 
+        archive), deleting them from the database; its results are read from
+        the archive from then on. Only finished campaigns can be archived, as
+        answers stored afterwards wouldn't be counted. Returns True if the 
+        campaign was archived; the deletes are left in the session for the
+        caller to commit.
+        """
+        if self.archived or not self.is_finished():
+            return False
+        answers = db.session.query(CampaignAnswer.id, CampaignAnswer.hit, CampaignAnswer.worker,
+                                   CampaignAnswer.term_id, CampaignAnswer.option_id, 
+                                   CampaignAnswer.excluded) \
+                            .filter(CampaignAnswer.campaign_id == self.id) \
+                            .order_by(CampaignAnswer.id) \
+                            .all()
+        tallies = db.session.query(CampaignTally.term_id, CampaignTally.option_id, CampaignTally.votes) \
+                            .filter(CampaignTally.campaign_id == self.id) \
+                            .order_by(CampaignTally.term_id, CampaignTally.option_id) \
+                            .all()
+        archive.write(self.id, answers, tallies)
+
+        CampaignAnswer.query.filter(CampaignAnswer.campaign_id == self.id) \
+                            .delete(synchronize_session=False)
+        CampaignTally.query.filter(CampaignTally.campaign_id == self.id) \
+                           .delete(synchronize_session=False)
+        self.archived = datetime.utcnow()
+        db.session.add(self)
+        return True
+
+    def __init__(self, title, question, terms_per_quiz=None, reward_per_quiz=None, 
+                 times_per_term=None, created_date=None, aggregation='majority', threshold=None,
+                 adaptive=False, budget=None, reuse_results=False):
+        self.title = title
+        self.question = question
+        self.reward_per_quiz = reward_per_quiz
+        self.terms_per_quiz = terms_per_quiz
+        self.times_per_term = times_per_term
+        self.aggregation = aggregation
+        self.threshold = threshold
+        self.adaptive = adaptive
+        self.budget = budget
+        self.reuse_results = reuse_results
+        self.rounds_published = 0
+        self.finished = False
+        self.answer_count = 0
+        self.results_version = 0
+        if created_date is None:
+            self.created_date = datetime.utcnow()
+        self.results_updated = datetime.utcnow()
+
+    def __repr__(self):
+        return '<Campaign %r>' % self.title
+
+def _iter_result_chunks(campaignid, times_per_term, options, threshold, chunk_size, archived=False):
+    """
+    Walk a campaign's terms in id order, reading the tallies (from the 
+    archive if <archived>) for one chunk of terms at a time. See 
+    Campaign.iter_result_chunks.
+
+    A streaming response reads the chunks after the request's session has
+    been removed, so they are read through a session of their own, closed
+    once the last chunk is read or the generator is closed.
+    """
+    lastid = 0
+    session = db.create_scoped_session()
+    try:
+        while True:
+            terms = session.query(CampaignTerm.id, CampaignTerm.term,
+                                  CampaignTerm.reused_from, CampaignTerm.answer_option_id) \
+                           .filter(CampaignTerm.campaign_id == campaignid) \
+                           .filter(CampaignTerm.id > lastid) \
+                           .order_by(CampaignTerm.id) \
+                           .limit(chunk_size) \
+                           .all()
+            if not terms:
+                break
+            firstid, lastid = terms[0][0], terms[-1][0]
+
+            if archived:
+                tallies = archive.read_tallies(campaignid, first=firstid, last=lastid)
+            else:
+                tallies = session.query(CampaignTally.term_id,
+                                        CampaignTally.option_id,
+                                        CampaignTally.votes) \
+                                 .filter(CampaignTally.campaign_id == campaignid) \
+                                 .filter(CampaignTally.term_id.between(firstid, lastid)) \
+                                 .all()
+            yield _chunk_results(terms, tallies, options, times_per_term, threshold)
+    finally:
+        session.remove()
+
+def _chunk_results(terms, tallies, options, times_per_term, threshold):
+    """
+    The [term, answer, {option: votes}] results of a chunk of terms, given
+    their (term_id, option_id, votes) tallies. The answers are decided by a
+    ResultMatrix of the chunk, the same way the campaign page decides them.
+    """
+    matrix = ResultMatrix.from_tallies([(termid, term) for termid, term, _, _ in terms], options,
+                                       tallies, times_per_term, threshold)
+    # Terms decided by an earlier campaign, not by votes in this one
+    matrix.reuse([(termid, answer_option_id, None) 
+                  for termid, term, reused_from, answer_option_id in terms
+                  if reused_from is not None])
+    return _matrix_results(matrix, 0, len(matrix))
+
+def _iter_matrix_chunks(matrix, chunk_size):
+    """
+    The result dump for a campaign whose ResultMatrix has already been 
+    worked out (by one of the aggregation strategies that need all of
+    the answers at once).
+    """
+    for start in xrange(0, len(matrix), chunk_size):
+        yield _matrix_results(matrix, start, min(start + chunk_size, len(matrix)))
+
+def _matrix_results(matrix, start, stop):
+    """
+    The [term, answer, {option: votes}] results of rows <start> to <stop>
+    of <matrix>; the answer is empty for inconclusive terms.
+    """
+    results = []
+    for row in xrange(start, stop):
+        answers = dict(zip(matrix.option_texts, [int(votes) for votes in matrix.counts[row]]))
+        bestanswer = ""
+        if matrix.conclusive[row]:
+            bestanswer = matrix.option_texts[matrix.winners[row]]
+        results.append([matrix.terms[row], bestanswer, answers])
+    return results
+
+class CampaignOption(db.Model):
+    """
+    Represents the question displayed to the answerer: e.g. "Is this item a vegetable?"
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    option_text = db.Column(db.String(500))
+
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), index=True)
+    campaign = db.relationship('Campaign', 
+                               backref=db.backref('campaign_option', lazy='dynamic'))
+
+    answers = db.relationship('CampaignAnswer')
+    
+    def __init__(self, campaign, option_text):
+        self.campaign = campaign
+        self.option_text = option_text
+
+class CampaignTerm(db.Model):
+    """
+    The term being categorized.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    term = db.Column(db.String(100))
+
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), index=True)
+    campaign = db.relationship('Campaign', 
+                               backref=db.backref('campaign_term', lazy='dynamic'))
+
+    # The term's outcome under the campaign's aggregation: whether it's
+    # decided, and if so the answer and its percentage. Kept up to date as
+    # answers come in so result pages can filter on it through an index.
+    decided = db.Column(db.Boolean, default=False)
+    answer_option_id = db.Column(db.Integer)
+    answer_percentage = db.Column(db.Integer)
+    # The question, answers and term, normalized and hashed, and the term of
+    # an earlier campaign whose outcome this one reused, if any (see reuse)
+    fingerprint = db.Column(db.String(40))
+    reused_from = db.Column(db.Integer)
+    # The last change (see next_change) to the term's tallies or outcome
+    changed = db.Column(db.Integer)
+
+    answers = db.relationship("CampaignAnswer")
+
+    def __init__(self, campaign, term):
+        self.campaign = campaign
+        self.term = term
+        self.decided = False
+
+# Result slices by outcome, in term order
+db.Index('ix_campaign_term_decided', CampaignTerm.campaign_id, CampaignTerm.decided, CampaignTerm.id)
+db.Index('ix_campaign_term_answer', CampaignTerm.campaign_id, CampaignTerm.answer_option_id, CampaignTerm.id)
+# Earlier outcomes of the same question, answers and term
+db.Index('ix_campaign_term_fingerprint', CampaignTerm.fingerprint, CampaignTerm.decided)
+# Terms changed since a watermark
+db.Index('ix_campaign_term_changed', CampaignTerm.campaign_id, CampaignTerm.changed)
+
+class CampaignAnswer(db.Model):
+    """
+    The answerer's categorization of the term. 
+    There will be many of these for each term.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    hit = db.Column(db.String(50))
+    worker = db.Column(db.String(50), index=True)
+
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'))
+    term_id = db.Column(db.Integer, db.ForeignKey('campaign_term.id'))
+    option_id = db.Column(db.Integer, db.ForeignKey('campaign_option.id'))
+
+    # Answers from workers the review policy has rejected are kept, but
+    # left out of the tallies and aggregation
+    excluded = db.Column(db.Boolean, default=False)
+
+    campaign = db.relationship('Campaign',
+                               backref=db.backref('campaign_answer'))
+
+    term = db.relationship('CampaignTerm', 
+                           backref=db.backref('campaign_answer'))
+  
+    option = db.relationship('CampaignOption',
+                             backref=db.backref('campaign_answer'))
+
+    def __init__(self, hit, worker, campaign_id, term_id, option_id):
+        self.hit = hit
+        self.worker = worker
+        self.campaign_id = campaign_id
+        self.term_id = term_id
+        self.option_id = option_id
+        self.excluded = False
+    
+    def __repr__(self):
+        return "<Answer: '%s - %s'>" % (self.term.term, self.option.option_text)
+
+# Tallies are counted per campaign, term and option, and a worker can only 
+# answer a term once per HIT (which is also how duplicates are found on ingest)
+db.Index('ix_campaign_answer_tally', 
+         CampaignAnswer.campaign_id, CampaignAnswer.term_id, CampaignAnswer.option_id)
+db.Index('ix_campaign_answer_unique', 
+         CampaignAnswer.hit, CampaignAnswer.worker, CampaignAnswer.term_id, unique=True)
+
+class CampaignPage(db.Model):
+    """
+    A published quiz page (one HIT) of a campaign. 
+    Recorded as each HIT is created, so an interrupted generation run can
+    pick up where it left off without creating the same HIT twice.
+
+    Pages remember which terms they asked about and how many assignments
+    they asked for, and are marked completed once their HIT is reviewable,
+    which is what adaptive campaigns use to decide when to start a new round.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    page_number = db.Column(db.Integer)
+    hit_id = db.Column(db.String(50), index=True)
+    created_date = db.Column(db.DateTime)
+    round = db.Column(db.Integer, default=0)
+    assignments = db.Column(db.Integer)
+    term_ids = db.Column(db.Text)
+    completed = db.Column(db.Boolean, default=False)
+
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'))
+
+    def __init__(self, campaign_id, page_number, hit_id, roundnum=0, assignments=None, term_ids=()):
+        self.campaign_id = campaign_id
+        self.page_number = page_number
+        self.hit_id = hit_id
+        self.round = roundnum
+        self.assignments = assignments
+        self.term_ids = ",".join(str(termid) for termid in term_ids)
+        self.completed = False
+        self.created_date = datetime.utcnow()
+
+    def __repr__(self):
+        return "<Page %s of campaign %s: HIT %s>" % (self.page_number, self.campaign_id, self.hit_id)
+
+db.Index('ix_campaign_page_unique', CampaignPage.campaign_id, CampaignPage.page_number, unique=True)
+
+class HitSync(db.Model):
+    """
+    How far a reviewable HIT has got through being fetched: 'stored' once
+    its assignments are stored, 'approved' once they have all been approved
+    or rejected and 'disposed' once it has been taken off Mechanical Turk
+    (or 'reviewing' once it has been marked as being reviewed there, when 
+    HITs aren't disposed of).
+    """
+    hit_id = db.Column(db.String(50), primary_key=True)
+    status = db.Column(db.String(20))
+    updated = db.Column(db.DateTime)
+
+    def __init__(self, hit_id, status):
+        self.hit_id = hit_id
+        self.status = status
+        self.updated = datetime.utcnow()
+
+    def __repr__(self):
+        return "<HIT %s: %s>" % (self.hit_id, self.status)
+
+class AssignmentSync(db.Model):
+    """
+    An assignment whose answers have been stored: 'stored' until it has
+    been reviewed, then 'approved' or 'rejected' (see quality). Failed 
+    reviews are counted in <attempts> and retried on the next fetch.
+    """
+    assignment_id = db.Column(db.String(50), primary_key=True)
+    hit_id = db.Column(db.String(50), index=True)
+    worker_id = db.Column(db.String(50))
+    status = db.Column(db.String(20))
+    attempts = db.Column(db.Integer, default=0)
+    error = db.Column(db.String(500))
+    updated = db.Column(db.DateTime)
+
+    def __init__(self, assignment_id, hit_id, status):
+        self.assignment_id = assignment_id
+        self.hit_id = hit_id
+        self.status = status
+        self.attempts = 0
+        self.updated = datetime.utcnow()
+
+    def __repr__(self):
+        return "<Assignment %s of HIT %s: %s>" % (self.assignment_id, self.hit_id, self.status)
+
+class WorkerStats(db.Model):
+    """
+    What we know about a Mechanical Turk worker, added to as their answers
+    are stored (see quality): how many answers and assignments, how many 
+    answers could be compared with the other workers' consensus on the term
+    and how many agreed with it, and how long their timed assignments took,
+    with how many of those were rushed.
+
+    <status> is the review policy's verdict: 'ok', 'rejected' (assignments
+    rejected and answers left out of the tallies) or 'blocked' (rejected, 
+    and blocked from our HITs once <block_sent>).
+    """
+    __tablename__ = 'worker_stats'
+    worker_id = db.Column(db.String(50), primary_key=True)
+    answers = db.Column(db.Integer, default=0)
+    assignments = db.Column(db.Integer, default=0)
+    compared = db.Column(db.Integer, default=0)
+    agreed = db.Column(db.Integer, default=0)
+    timed = db.Column(db.Integer, default=0)
+    seconds = db.Column(db.Float, default=0)
+    rushed = db.Column(db.Integer, default=0)
+    status = db.Column(db.String(20), default='ok')
+    block_sent = db.Column(db.Boolean, default=False)
+    updated = db.Column(db.DateTime)
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.answers = self.assignments = self.compared = self.agreed = 0
+        self.timed = self.rushed = 0
+        self.seconds = 0.0
+        self.status = 'ok'
+        self.block_sent = False
+        self.updated = datetime.utcnow()
+
+    def agreement(self):
+        """
+        The share of compared answers that agreed with the consensus, or
+        None if none could be compared yet.
+        """
+        if not self.compared:
+            return None
+        return self.agreed / float(self.compared)
+
+    def __repr__(self):
+        return "<Worker %s: %s>" % (self.worker_id, self.status)
+
+db.Index('ix_worker_stats_status', WorkerStats.status, WorkerStats.block_sent)
+
+class ChangeCounter(db.Model):
+    """
+    A single row counting the changes made to terms' results, which lets
+    consumers of the results pick up just what changed since they last 
+    looked (see next_change).
+    """
+    __tablename__ = 'change_counter'
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, default=0)
+
+    def __repr__(self):
+        return "<Change %s>" % self.value
+
+class CampaignTally(db.Model):
+    """
+    The number of votes a term has received for an option. 
+    Kept up to date as answers are retrieved so the results never have to be
+    counted from the raw answers.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    votes = db.Column(db.Integer, default=0)
+
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'))
+    term_id = db.Column(db.Integer, db.ForeignKey('campaign_term.id'))
+    option_id = db.Column(db.Integer, db.ForeignKey('campaign_option.id'))
+
+    def __init__(self, campaign_id, term_id, option_id, votes=0):
+        self.campaign_id = campaign_id
+        self.term_id = term_id
+        self.option_id = option_id
+        self.votes = votes
+
+    def __repr__(self):
+        return "<Tally: term %s, option %s, %s votes>" % (self.term_id, self.option_id, self.votes)
+
+db.Index('ix_campaign_tally_unique', 
+         CampaignTally.campaign_id, CampaignTally.term_id, CampaignTally.option_id, unique=True)
+
+def record_votes(votes):
+    """
+    Add newly retrieved answers to the tally table and the campaign answer totals,
+    and bump the results version of each campaign they belong to.
+
+    <votes> maps (campaign_id, term_id, option_id) tuples to the number of new
+    answers, or minus the number taken away when answers are excluded (see
+    quality.exclude_answers). The updates are made in the current session so they are committed
+    in the same transaction as the answers themselves. The terms and
+    campaigns are marked with a new change number.
+    """
+    if not votes:
+        return
+    tally = CampaignTally.__table__
+    campaign = Campaign.__table__
+
+    # Find out which pairs already have a tally row, a batch of terms at a time
+    terms_per_campaign = {}
+    for campaign_id, term_id, option_id in votes:
+        terms_per_campaign.setdefault(campaign_id, set()).add(term_id)
+
+    existing = set()
+    for campaign_id, term_ids in terms_per_campaign.items():
+        for batch in batches(sorted(term_ids)):
+            rows = db.session.query(tally.c.term_id, tally.c.option_id) \
+                             .filter(tally.c.campaign_id == campaign_id) \
+                             .filter(tally.c.term_id.in_(batch))
+            existing.update((campaign_id, term_id, option_id) for term_id, option_id in rows)
+
+    updates = [{'b_campaign_id': key[0], 'b_term_id': key[1], 'b_option_id': key[2], 'b_votes': count}
+               for key, count in votes.items() if key in existing]
+    inserts = [{'campaign_id': key[0], 'term_id': key[1], 'option_id': key[2], 'votes': count}
+               for key, count in votes.items() if key not in existing]
+
+    if updates:
+        db.session.execute(tally.update()
+                           .where(db.and_(tally.c.campaign_id == db.bindparam('b_campaign_id'),
+                                          tally.c.term_id == db.bindparam('b_term_id'),
+                                          tally.c.option_id == db.bindparam('b_option_id')))
+                           .values(votes=tally.c.votes + db.bindparam('b_votes')),
+                           updates)
+    if inserts:
+        db.session.execute(tally.insert(), inserts)
+
+    campaign_totals = {}
+    for (campaign_id, term_id, option_id), count in votes.items():
+        campaign_totals[campaign_id] = campaign_totals.get(campaign_id, 0) + count
+
+    now = datetime.utcnow()
+    change = next_change()
+    for campaign_id, count in campaign_totals.items():
+        db.session.execute(campaign.update()
+                           .where(campaign.c.id == campaign_id)
+                           .values(answer_count=db.func.coalesce(campaign.c.answer_count, 0) + count,
+                                   results_version=db.func.coalesce(campaign.c.results_version, 0) + 1,
+                                   results_updated=now,
+                                   changed=change))
+    for term_ids in terms_per_campaign.values():
+        mark_changed(sorted(term_ids), change)
+
+    # Majority outcomes only depend on each term's own tallies, so just the
+    # terms that got votes are updated; the other strategies are refreshed
+    # by the worker (see stale_outcomes)
+    for campaign_id, term_ids in terms_per_campaign.items():
+        update_majority_outcomes(campaign_id, sorted(term_ids))
+
+def outcome_rows(matrix):
+    """
+    (term_id, decided, answer_option_id, answer_percentage) for each term 
+    of a ResultMatrix.
+    """
+    for row, termid in enumerate(matrix.termids):
+        if matrix.conclusive[row]:
+            column = matrix.winners[row]
+            yield termid, True, matrix.optionids[column], int(matrix.percentages[row, column])
+        else:
+            yield termid, False, None, None
+
+def write_outcomes(outcomes, change=None):
+    """
+    Store terms' outcomes, given as outcome_rows, and mark them with 
+    <change> if given. Outcomes reused from an earlier campaign are left as
+    they are. Left in the session.
+    """
+    table = CampaignTerm.__table__
+    values = dict(decided=db.bindparam('b_decided'),
+                  answer_option_id=db.bindparam('b_answer_option_id'),
+                  answer_percentage=db.bindparam('b_answer_percentage'))
+    if change is not None:
+        values['changed'] = change
+    statement = table.update() \
+                     .where(table.c.id == db.bindparam('b_id')) \
+                     .where(table.c.reused_from == None) \
+                     .values(**values)
+    batch = []
+    for termid, decided, answer_option_id, answer_percentage in outcomes:
+        batch.append({'b_id': termid, 'b_decided': decided, 
+                      'b_answer_option_id': answer_option_id,
+                      'b_answer_percentage': answer_percentage})
+        if len(batch) == 1000:
+            db.session.execute(statement, batch)
+            batch = []
+    if batch:
+        db.session.execute(statement, batch)
+
+def update_majority_outcomes(campaign_id, term_ids):
+    """
+    Recompute the outcomes of <term_ids> from their tallies, if the campaign
+    uses majority voting. Called by record_votes once the campaign's results
+    version has been bumped; if its outcomes were up to date before, they
+    still are.
+    """
+    campaign = db.session.query(Campaign.aggregation, Campaign.times_per_term, Campaign.threshold,
+                                Campaign.results_version, Campaign.outcomes_version) \
+                         .filter(Campaign.id == campaign_id) \
+                         .first()
+    if campaign is None or (campaign.aggregation or 'majority') != 'majority':
+        return
+    threshold = settings.THRESHOLD if campaign.threshold is None else campaign.threshold
+    options = [(optionid, None) for optionid, in db.session.query(CampaignOption.id)
+                                                   .filter(CampaignOption.campaign_id == campaign_id)
+                                                   .order_by(CampaignOption.id)]
+
+    for batch in batches(term_ids):
+        tallies = db.session.query(CampaignTally.term_id,
+                                   CampaignTally.option_id,
+                                   CampaignTally.votes) \
+                            .filter(CampaignTally.campaign_id == campaign_id) \
+                            .filter(CampaignTally.term_id.in_(batch))
+        matrix = ResultMatrix.from_tallies([(termid, None) for termid in batch], options, tallies,
+                                           campaign.times_per_term, threshold)
+        write_outcomes(outcome_rows(matrix))
+
+    if (campaign.outcomes_version or 0) == (campaign.results_version or 0) - 1:
+        db.session.execute(Campaign.__table__.update()
+                                   .where(Campaign.__table__.c.id == campaign_id)
+                                   .values(outcomes_version=campaign.results_version))
+
+def next_change():
+    """
+    Take the next number from the change counter, to mark the terms and
+    campaigns whose results a transaction changes. The counter's row stays
+    locked until the transaction ends, so numbers are committed in order 
+    and a reader that has seen number N will see any later change as 
+    greater than N (see current_change). Left in the session.
+    """
+    table = ChangeCounter.__table__
+    if not db.session.execute(table.update()
+                                   .where(table.c.id == 1)
+                                   .values(value=table.c.value + 1)).rowcount:
+        db.session.execute(table.insert(), {'id': 1, 'value': 1})
+    return current_change()
+
+def current_change():
+    """
+    The last change number taken, 0 if there has been none.
+    """
+    return db.session.query(ChangeCounter.value).filter(ChangeCounter.id == 1).scalar() or 0
+
+def mark_changed(term_ids, change):
+    """
+    Mark terms as changed by <change>. Left in the session.
+    """
+    table = CampaignTerm.__table__
+    for start in range(0, len(term_ids), 500):
+        db.session.execute(table.update()
+                                .where(table.c.id.in_(term_ids[start:start + 500]))
+                                .values(changed=change))
+
+def stale_outcomes():
+    """
+    Ids of the campaigns whose stored term outcomes are behind their results.
+    """
+    return [campaignid for campaignid, in 
+            db.session.query(Campaign.id)
+                      .filter(db.func.coalesce(Campaign.outcomes_version, 0) != 
+                              db.func.coalesce(Campaign.results_version, 0))]
+
+def delete_campaign(campaign_id):
+    """
+    Delete a campaign and everything that belongs to it with one DELETE per
+    table, rather than loading every row through the ORM. Left in the
+    session for the caller to commit; removing the campaign's archive, if it
+    has one, is up to the caller once that's done (see archive.remove).
+    """
+    hits = db.session.query(CampaignPage.hit_id) \
+                     .filter(CampaignPage.campaign_id == campaign_id) \
+                     .subquery()
+    AssignmentSync.query.filter(AssignmentSync.hit_id.in_(hits)).delete(synchronize_session=False)
+    HitSync.query.filter(HitSync.hit_id.in_(hits)).delete(synchronize_session=False)
+    for model in (CampaignAnswer, CampaignTally, CampaignPage, CampaignTerm, CampaignOption):
+        model.query.filter(model.campaign_id == campaign_id).delete(synchronize_session=False)
+    Campaign.query.filter(Campaign.id == campaign_id).delete(synchronize_session=False)
+
+def term_counts(asked_only=False):
+    """
+    Subquery with the number of terms in each campaign, so campaign
+    listings don't have to load the terms themselves. With <asked_only>,
+    terms reused from earlier campaigns aren't counted.
+    """
+    counts = db.session.query(CampaignTerm.campaign_id.label('campaign_id'),
+                              db.func.count(CampaignTerm.id).label('num_terms'))
+    if asked_only:
+        counts = counts.filter(CampaignTerm.reused_from == None)
+    return counts.group_by(CampaignTerm.campaign_id).subquery()
+
+def pending_jobs_exist():
+    """
+    Return True if any generated campaign is still waiting for answers.
+    """
+    counts = term_counts(asked_only=True)
+    pending = db.session.query(Campaign.id) \
+                        .outerjoin(counts, Campaign.id == counts.c.campaign_id) \
+                        .filter(Campaign.job_generated == True) \
+                        .filter(db.func.coalesce(Campaign.finished, False) == False) \
+                        .filter(db.func.coalesce(Campaign.answer_count, 0) <
+                                db.func.coalesce(counts.c.num_terms, 0) * Campaign.times_per_term)
+    return pending.first() is not None
+
+def finished_campaigns(campaigns):
+    """
+    The ids of the <campaigns> that are finished (see Campaign.is_finished),
+    worked out for all of them with two grouped queries.
+    """
+    candidates = set(campaign.id for campaign in campaigns
+                     if campaign.job_generated and (campaign.finished or not campaign.adaptive))
+    if not candidates:
+        return candidates
+    waiting = db.session.query(CampaignPage.campaign_id) \
+                        .filter(CampaignPage.campaign_id.in_(candidates)) \
+                        .filter(db.func.coalesce(CampaignPage.completed, False) == False) \
+                        .distinct()
+    unreviewed = db.session.query(CampaignPage.campaign_id) \
+                           .join((HitSync, HitSync.hit_id == CampaignPage.hit_id)) \
+                           .filter(CampaignPage.campaign_id.in_(candidates)) \
+                           .filter(HitSync.status == 'stored') \
+                           .distinct()
+    return candidates - set(campaignid for campaignid, in waiting.union(unreviewed))
+
+class ResultItem():
+    """
+    A non-database class used for reporting campaign results.
+    """
+    def __init__(self, option_id, option_text, times_selected, total_selections, percentage=None):
+        self.option_id = option_id
+        self.option_text = option_text
+        self.times_selected = times_selected
+        self.total_selections = total_selections
+        if percentage is None:
+            percentage = times_selected * 100 // total_selections
+        self.percentage = percentage
+        
+    def __repr__(self):
+        return "<Result: %s, %s%%>" % (self.option_text, self.percentage)
+
+class ResultMatrix(object):
+    """
+    A non-database class holding the results of a whole campaign: one row 
+    per term and one column per option, with the vote counts in a numpy 
+    array. Percentages, winners and conclusiveness are worked out for every
+    term at once; iterating gives a CampaignResult view of each row.
+
+    The percentages are the share of votes unless <scores> from one of the
+    aggregation strategies are given.
+    """
+    def __init__(self, terms, options, counts, times_per_term, threshold=settings.THRESHOLD,
+                 scores=None):
+        self.termids = [termid for termid, term in terms]
+        self.terms = [term for termid, term in terms]
+        self.optionids = [optionid for optionid, option_text in options]
+        self.option_texts = [option_text for optionid, option_text in options]
+        self.times_per_term = times_per_term
+        self.threshold = threshold
+
+        self.counts = counts
+        if scores is None:
+            scores = aggregation.majority(counts, None, times_per_term)
+        self.percentages = numpy.floor(scores).astype(int)
+        if len(options):
+            self.winners = self.percentages.argmax(axis=1)
+            self.best = self.percentages.max(axis=1)
+        else:
+            self.winners = numpy.zeros(len(terms), dtype=int)
+            self.best = numpy.zeros(len(terms), dtype=int)
+        self.conclusive = self.best > threshold
+        self.reused = numpy.zeros(len(terms), dtype=bool)
+
+    @classmethod
+    def from_tallies(cls, terms, options, tallies, times_per_term, threshold=settings.THRESHOLD):
+        """
+        Build the matrix from (term_id, option_id, votes) rows. <terms> and 
+        <options> are lists of (id, text) pairs in display order.
+        """
+        rows = dict((termid, i) for i, (termid, term) in enumerate(terms))
+        columns = dict((optionid, j) for j, (optionid, option_text) in enumerate(options))
+        counts = numpy.zeros((len(terms), len(options)), dtype=numpy.int32)
+        for term_id, option_id, votes in tallies:
+            if term_id in rows and option_id in columns:
+                counts[rows[term_id], columns[option_id]] = votes
+        return cls(terms, options, counts, times_per_term, threshold)
+
+    @classmethod
+    def from_outcomes(cls, terms, options, tallies, times_per_term, threshold, outcomes):
+        """
+        Build the matrix for some of a campaign's terms from their tallies
+        and their stored outcomes, a list of (answer_option_id, 
+        answer_percentage) with None for undecided terms. The percentages are
+        shares of the votes, apart from the accepted answer's, which is 
+        whatever the campaign's aggregation strategy gave it.
+        """
+        matrix = cls.from_tallies(terms, options, tallies, times_per_term, threshold)
+        for row, (answer_option_id, answer_percentage) in enumerate(outcomes):
+            matrix.set_outcome(row, answer_option_id, answer_percentage)
+        return matrix
+
+    def set_outcome(self, row, answer_option_id, answer_percentage):
+        """
+        Make a term's outcome the given answer and percentage, or 
+        inconclusive if the answer isn't one of the options.
+        """
+        if answer_option_id in self.optionids:
+            column = self.optionids.index(answer_option_id)
+            self.conclusive[row] = True
+            self.winners[row] = column
+            self.percentages[row, column] = answer_percentage or 0
+            self.best[row] = answer_percentage or 0
+        else:
+            self.conclusive[row] = False
+
+    def reuse(self, outcomes):
+        """
+        Put in the outcomes reused from earlier campaigns, given as 
+        (term_id, answer_option_id, answer_percentage).
+        """
+        rows = dict((termid, row) for row, termid in enumerate(self.termids))
+        for termid, answer_option_id, answer_percentage in outcomes:
+            if termid in rows:
+                self.set_outcome(rows[termid], answer_option_id, answer_percentage)
+                self.reused[rows[termid]] = True
+
+    def inconclusive(self, threshold=None):
+        """
+        A boolean array that is True for every term whose best answer
+        hasn't passed <threshold>.
+        """
+        if threshold is None or threshold == self.threshold:
+            return ~self.conclusive
+        return ~(self.best > threshold)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __getitem__(self, row):
+        if not 0 <= row < len(self.terms):
+            raise IndexError(row)
+        return CampaignResult(self, row)
+
+    def __iter__(self):
+        for row in xrange(len(self.terms)):
+            yield CampaignResult(self, row)
+
+class CampaignResult(object):
+    """
+    A non-database class used for reporting campaign results: a view of
+    one term's row in a ResultMatrix.
+    """
+    def __init__(self, matrix, row):
+        self.matrix = matrix
+        self.row = row
+        self.termid = matrix.termids[row]
+        self.term = matrix.terms[row]
+        self.reused = bool(matrix.reused[row])
+
+    @property
+    def results(self):
+        matrix = self.matrix
+        return [ResultItem(optionid, option_text, int(votes), matrix.times_per_term, int(percentage))
+                for optionid, option_text, votes, percentage
+                in zip(matrix.optionids, matrix.option_texts, matrix.counts[self.row], 
+                       matrix.percentages[self.row])]
+
+    @property
+    def answer(self):
+        """
+        The most frequently chosen answer, if it passed the threshold.
+        """
+        matrix = self.matrix
+        if not matrix.conclusive[self.row]:
+            return ResultItem(-1, "Inconclusive", 0, 1)
+        column = matrix.winners[self.row]
+        return ResultItem(matrix.optionids[column], 
+                          matrix.option_texts[column],
+                          int(matrix.counts[self.row, column]),
+                          matrix.times_per_term,
+                          int(matrix.percentages[self.row, column]))
+
+    def answer_breakdown(self):
+        """
+        Create a breakdown of answer selections for use in the 
+        summary view of the campaign.
+        """
+        out = ""
+        for option_text, percentage in zip(self.matrix.option_texts, 
+                                           self.matrix.percentages[self.row]):
+            out += "%s: %s%% " % (option_text, percentage)
+        return out
+
+    def is_inconclusive(self, threshold=None):
+        """
+        Return True if the result is inconclusive, otherwise return False.
+        """
+        if threshold is None or threshold == self.matrix.threshold:
+            return not self.matrix.conclusive[self.row]
+        return not self.matrix.best[self.row] > threshold
+
+    def __repr__(self):
+        answer = self.answer
+        return "<CampaignResult: %s, %s, %s%%>" % (self.term, answer.option_text, answer.percentage)
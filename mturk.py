@@ -2,23 +2,164 @@
 from boto.mturk.connection import MTurkConnection
 from boto.mturk.question import QuestionContent, Question, QuestionForm, Overview, AnswerSpecification, SelectionAnswer
 from boto.mturk.qualification import LocaleRequirement, Qualifications
+from boto.exception import BotoServerError
 
-from models import db, ActionLog, Campaign, CampaignOption, CampaignTerm, CampaignAnswer
+from models import db, Campaign, CampaignOption, CampaignPage, CampaignTerm, CampaignAnswer
+from ingest import (hit_states, mark_pages_completed, pending_approvals, record_reviews, 
+                    set_hit_status, stored_assignments, store_answers)
+from instrumentation import InstrumentedConnection, log_action
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+import Queue
+import adaptive
 import cgi
+import hashlib
+import quality
 import settings
+import simulator
 import math
+import os
 import sys
+import threading
+import time
 
-### HIT Creation ###
+FETCH_WORKERS = getattr(settings, 'MTURK_FETCH_WORKERS', 8)
+PUBLISH_WORKERS = getattr(settings, 'MTURK_PUBLISH_WORKERS', 8)
+REQUESTS_PER_SECOND = getattr(settings, 'MTURK_REQUESTS_PER_SECOND', 10)
+RETRIES = getattr(settings, 'MTURK_RETRIES', 3)
+DISPOSE_HITS = getattr(settings, 'MTURK_DISPOSE_HITS', True)
+
+# MTurk's error codes for calls turned away because of the request rate
+THROTTLING_ERRORS = ('ServiceUnavailable', 'Throttling')
+# How far MTurk's clock may be behind ours when comparing HIT creation times
+CLOCK_SKEW = timedelta(minutes=10)
+
+### Connections ###
 def create_connection():
     """ 
-    Create a connection to the Mechanical Turk service 
+    Create a connection to the Mechanical Turk service, or to the shared
+    in-process simulator when MTURK_SIMULATOR is set.
     """
+    if getattr(settings, 'MTURK_SIMULATOR', False):
+        return simulator.shared_simulator()
     mtc = MTurkConnection(aws_access_key_id=settings.AWS_ACCESS_ID,
                       aws_secret_access_key=settings.AWS_SECRET_KEY,
                       host=settings.TURK_HOST)
     return mtc
 
+class ConnectionPool(object):
+    """
+    A set of MTurk connections shared between threads. Connections are 
+    created as they are first needed (up to <size> of them) and reused 
+    after that.
+    """
+    def __init__(self, factory=None, size=None):
+        self.factory = factory
+        self.size = size or max(FETCH_WORKERS, PUBLISH_WORKERS)
+        self.idle = Queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a with block.
+        """
+        try:
+            conn = self.idle.get_nowait()
+        except Queue.Empty:
+            conn = None
+            with self.lock:
+                if self.created < self.size:
+                    self.created += 1
+                    conn = True
+            if conn is True:
+                conn = InstrumentedConnection((self.factory or create_connection)())
+            else:
+                conn = self.idle.get()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+# Shared by every request in this process
+connections = ConnectionPool()
+
+def get_pool(connection_factory=None):
+    """
+    Use the shared pool unless a specific connection factory is wanted
+    (e.g. a stub for benchmarking).
+    """
+    if connection_factory is None:
+        return connections
+    return ConnectionPool(connection_factory)
+
+def run_concurrently(func, items, pool, workers=None):
+    """
+    Call func(connection, item) for each item on a bounded pool of threads,
+    returning the results in order. Connections are borrowed from <pool>.
+    """
+    def call(item):
+        with pool.connection() as connection:
+            return func(connection, item)
+
+    threads = ThreadPool(workers or FETCH_WORKERS)
+    try:
+        return threads.map(call, items)
+    finally:
+        threads.close()
+        threads.join()
+
+class RateLimiter(object):
+    """
+    Spaces out calls from any number of threads so no more than <rate>
+    start each second. A rate of 0 doesn't limit anything.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+def call_with_retry(func, retries=None, backoff=1.0, retry_if=None):
+    """
+    Call func(), retrying with exponential backoff if it raises (only errors
+    for which retry_if(error) is true, when given). The final failure is
+    re-raised.
+    """
+    if retries is None:
+        retries = RETRIES
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except Exception, error:
+            if attempt == retries or (retry_if is not None and not retry_if(error)):
+                raise
+            time.sleep(backoff * (2 ** attempt))
+
+def throttled(error):
+    """
+    Whether MTurk turned a call away because of the request rate, so it 
+    wasn't carried out and can be made again. Any other error is either 
+    permanent (bad parameters, insufficient funds) or, after a timeout or
+    an internal error, may have come after the call went through.
+    """
+    if not isinstance(error, BotoServerError):
+        return False
+    code = (error.error_code or "").split(".")[-1]
+    return error.status == 503 or code in THROTTLING_ERRORS
+
+### HIT Creation ###
+
 def build_answers(answerlist):
     """
     Build up the answer selection list from the list of tuples <answerlist>
@@ -41,138 +182,496 @@ def create_question_form(title, description, keywords):
     question_form.append(overview)
     return question_form
 
-def create_question(identifier, quizquestion, answers):
+def create_question(identifier, quizquestion, answer_spec):
     """
-    Create a question
+    Create a question. <answer_spec> is an AnswerSpecification, which can be
+    shared by every question in a campaign.
     """
     newquestion = QuestionContent()
     newquestion.append_field('Title', quizquestion)
     question = Question(identifier=identifier,
                         content=newquestion,
-                        answer_spec=AnswerSpecification(build_answers(answers)),
+                        answer_spec=answer_spec,
                         is_required=True)
     return question
+
+def create_qualifications():
+    """
+    Create a locale requirement that answerers must be in the US
+    """
+    qualifications = Qualifications()
+    qualifications.add(LocaleRequirement("EqualTo","US"))
+    return qualifications
     
-def create_campaign_hits(campaignid):
+class SerializedQuestionForm(QuestionForm):
+    """
+    A QuestionForm whose XML has already been rendered, so it is serialized
+    once no matter how many times the HIT creation is retried.
+    """
+    def __init__(self, xml):
+        QuestionForm.__init__(self)
+        self.xml = xml
+
+    def is_valid(self):
+        return True
+
+    def get_as_xml(self):
+        return self.xml
+
+class QuizLayout(object):
+    """
+    The parts of a campaign's quiz pages that are the same on every page.
+
+    The escaped option selections, answer specification and overview are 
+    serialized once, using boto's own objects with placeholders where the 
+    term goes. Rendering a page is then just string joins.
+    """
+    IDENTIFIER = "@@identifier@@"
+    QUESTION = "@@question@@"
+    QUESTIONS = "@@questions@@"
+
+    def __init__(self, campaignid, title, question, options):
+        self.campaignid = campaignid
+        self.question_parts = question.split("[term]")
+
+        # Build up an answer list for use with the question form 
+        self.selections = [(cgi.escape(option_text), 
+                            ("%s|%s" % (optionid, cgi.escape(option_text)))) 
+                           for optionid, option_text in options]
+        answer_spec = AnswerSpecification(build_answers(self.selections))
+
+        question_xml = create_question(self.IDENTIFIER, self.QUESTION, answer_spec).get_as_xml()
+        start, rest = question_xml.split(self.IDENTIFIER)
+        middle, end = rest.split(self.QUESTION)
+        self.question_template = (start, middle, end)
+
+        overview_xml = "".join(item.get_as_xml() 
+                               for item in create_question_form(title, title, "categorization"))
+        form_xml = QuestionForm.xml_template % {'items': overview_xml + self.QUESTIONS}
+        self.form_template = tuple(form_xml.split(self.QUESTIONS))
+
+    def render_question(self, termid, term):
+        """
+        A question for a single term.
+        """
+        escaped = cgi.escape(term)
+        identifier = "%s|%s|%s" % (self.campaignid, termid, escaped)
+        questiontext = escaped.join(self.question_parts)
+        start, middle, end = self.question_template
+        return "".join((start, identifier, middle, questiontext, end))
+
+    def render_page(self, terms):
+        """
+        The serialized question form for a page of (term id, term) pairs.
+        """
+        start, end = self.form_template
+        questions = "".join(self.render_question(termid, term) for termid, term in terms)
+        return SerializedQuestionForm(start + questions + end)
+
+def write_pages(pages, directory):
+    """
+    Write rendered pages to <directory> instead of publishing them. 
+    Returns the number of pages written.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    written = 0
+    for pagenum, question_form in pages:
+        with open(os.path.join(directory, "page-%05d.xml" % pagenum), "w") as out:
+            out.write(question_form.get_as_xml().encode('utf-8'))
+        written += 1
+    return written
+
+def page_digest(roundnum, assignments, termids):
+    """
+    A digest of what a page asks: its round, assignments and terms.
+    """
+    asked = "%s|%s|%s" % (roundnum, assignments, ",".join(str(termid) for termid in termids))
+    return hashlib.sha1(asked).hexdigest()[:16]
+
+def get_hits_since(connection, since, page_size=100):
+    """
+    Get the HITs of the account created since <since> (UTC) that haven't 
+    been disposed of, with their annotations. HITs are searched newest 
+    first, so only the result pages reaching back to <since> are read.
+    """
+    hits = []
+    page_number = 1
+    while True:
+        page = connection.search_hits(sort_by='CreationTime', sort_direction='Descending',
+                                      page_size=page_size, page_number=page_number,
+                                      response_groups=['Minimal', 'HITDetail'])
+        for hit in page:
+            created = quality.parse_time(getattr(hit, 'CreationTime', None))
+            if created is not None and created < since:
+                return hits
+            hits.append(hit)
+        if len(page) == 0 or page_number * page_size >= int(page.TotalNumResults):
+            return hits
+        page_number += 1
+
+def round_started(campaign, roundnum):
+    """
+    The earliest any HIT of a campaign's round can have been created: when
+    the campaign was created or, for a later round, when the last page of 
+    the round before it was published, less CLOCK_SKEW.
+    """
+    started = campaign.created_date
+    if roundnum > 0:
+        started = db.session.query(db.func.max(CampaignPage.created_date)) \
+                            .filter(CampaignPage.campaign_id == campaign.id) \
+                            .filter(CampaignPage.round == roundnum - 1) \
+                            .scalar() or started
+    if started is None:
+        return datetime.min
+    return started - CLOCK_SKEW
+
+def unrecorded_hits(connection, campaignid, since):
+    """
+    {page digest: HIT id} for the HITs created since <since> that are 
+    annotated as pages of a campaign but have no CampaignPage: their 
+    creation went through, but the worker died before recording it or the
+    call failed after MTurk had taken it.
+    """
+    recorded = set(hitid for hitid, in db.session.query(CampaignPage.hit_id)
+                                                 .filter(CampaignPage.campaign_id == campaignid))
+    found = {}
+    for hit in get_hits_since(connection, since):
+        parts = (getattr(hit, 'RequesterAnnotation', None) or "").split("|")
+        if len(parts) == 3 and parts[0] == str(campaignid) and hit.HITId not in recorded:
+            found[parts[2]] = hit.HITId
+    return found
+
+def publish_pages(campaign, pages, roundnum=0, connection_factory=None, workers=None, progress=None,
+                  dry_run_dir=None):
+    """
+    Publish <pages> of a campaign, a list of (page number, assignments, 
+    [(term_id, term), ...]), as HITs.
+
+    The pages are published concurrently (MTURK_PUBLISH_WORKERS threads), 
+    limited to MTURK_REQUESTS_PER_SECOND. Each page is recorded as soon as
+    its HIT exists. Creating a HIT is only retried when MTurk throttled the
+    call; other errors are permanent or may have come after the HIT was 
+    created. Each HIT is annotated with its campaign, page number and page
+    digest. A page that already has an unrecorded HIT (see unrecorded_hits)
+    is recorded with it instead of being published again; only the HITs 
+    created since the round could have started are searched for them.
+
+    With <dry_run_dir>, the pages are written there as XML files instead of
+    being published, nothing is recorded and <progress> is called once 
+    they have all been written.
+
+    <progress>, if given, is called with (pages done, total pages) as the
+    pages are published. Returns the number of pages that could not be 
+    published.
+    """
+    options = db.session.query(CampaignOption.id, CampaignOption.option_text) \
+                        .filter(CampaignOption.campaign_id == campaign.id) \
+                        .order_by(CampaignOption.id) \
+                        .all()
+
+    # The question layout and HIT settings are the same on every page, so build them once.
+    # The pages are built and published off the main thread, which mustn't
+    # touch the session, so read everything needed from the campaign up front
+    layout = QuizLayout(campaign.id, campaign.title, campaign.question, options)
+    hit_params = dict(title=campaign.title,
+                      description=campaign.title,
+                      duration=60*30, # allot 30 minutes per quiz 
+                      qualifications=create_qualifications(), # require the answerers be in the US
+                      reward=campaign.reward_per_quiz)
+    campaignid = campaign.id
+
+    def build_page(page):
+        """
+        A set of questions will be built for each "page"
+        """
+        pagenum, assignments, terms = page
+        return pagenum, assignments, [termid for termid, term in terms], layout.render_page(terms)
+
+    if dry_run_dir is not None:
+        written = write_pages(((pagenum, question_form) for pagenum, _, _, question_form 
+                               in (build_page(page) for page in pages)), 
+                              dry_run_dir)
+        if progress is not None:
+            progress(written, len(pages))
+        return 0
+
+    pool = get_pool(connection_factory)
+    done = 0
+    unpublished = []
+    if pages:
+        with pool.connection() as conn:
+            orphans = unrecorded_hits(conn, campaignid, round_started(campaign, roundnum))
+        for page in pages:
+            pagenum, assignments, terms = page
+            termids = [termid for termid, term in terms]
+            hitid = orphans.pop(page_digest(roundnum, assignments, termids), None)
+            if hitid is None:
+                unpublished.append(page)
+                continue
+            db.session.add(CampaignPage(campaignid, pagenum, hitid, roundnum, assignments, termids))
+            done += 1
+        db.session.commit()
+        if done and progress is not None:
+            progress(done, len(pages))
+
+    limiter = RateLimiter(REQUESTS_PER_SECOND)
+    def publish(page):
+        pagenum, assignments, termids, question_form = page
+        annotation = "%s|%s|%s" % (campaignid, pagenum, page_digest(roundnum, assignments, termids))
+        def create_hit():
+            limiter.wait()
+            with pool.connection() as conn:
+                return conn.create_hit(question=question_form,
+                                       max_assignments=assignments,
+                                       annotation=annotation,
+                                       **hit_params)
+        try:
+            return pagenum, assignments, termids, call_with_retry(create_hit, retry_if=throttled)[0].HITId, None
+        except Exception:
+            return pagenum, assignments, termids, None, sys.exc_info()[1]
+
+    rendered = (build_page(page) for page in unpublished)
+    failures = 0
+    threads = ThreadPool(workers or PUBLISH_WORKERS)
+    try:
+        # Record progress as each HIT is created
+        for pagenum, assignments, termids, hitid, error in threads.imap_unordered(publish, rendered):
+            if error is None:
+                db.session.add(CampaignPage(campaignid, pagenum, hitid, roundnum, assignments, termids))
+            else:
+                failures += 1
+                log_action("create_campaign_hits - failed",
+                           "campaign: %s, page: %s, error: %s" % (campaignid, pagenum, error))
+            db.session.commit()
+
+            done += 1
+            if progress is not None:
+                progress(done, len(pages))
+    finally:
+        threads.close()
+        threads.join()
+    return failures
+
+def create_campaign_hits(campaignid, connection_factory=None, workers=None, progress=None,
+                         dry_run_dir=None):
     """ 
-    Create HITs for a campaign. 
+    Create HITs for a campaign: every term times_per_term times or, for an
+    adaptive campaign, its first round. See publish_pages. Terms reused
+    from an earlier campaign aren't asked.
+
+    Pages that were already published are skipped, so running this again
+    after a failure only publishes the pages that are still missing. Once
+    the campaign's HITs have been generated this does nothing; the later 
+    rounds of an adaptive campaign are published by create_next_round.
     """
     campaign = Campaign.query.filter_by(id=campaignid).first()
-    options = campaign.options
-    terms = campaign.terms
-    
-    # Determine the number of quizzes that need to be generated
-    numquizzes = int(math.ceil(float(len(terms)) / campaign.terms_per_quiz))
-
-    # A set of questions will be built for each "page"
-    for pagenum in range(numquizzes):
-        conn = create_connection()
-        question_form = create_question_form(campaign.title, campaign.title,"categorization")
-
-        # Add the term questions to the page / quiz
-        for i in range(campaign.terms_per_quiz):
-            termnum = i + (pagenum * campaign.terms_per_quiz)
-            if termnum < len(terms):
-                term = terms[termnum]
-                # Build up an answer dictionary for use with the question form 
-                answers = [(cgi.escape(option.option_text), 
-                            ("%s|%s" % (option.id, cgi.escape(option.option_text)))) 
-                           for option in options]
-                # A question should be appended for each term under consideration
-                questiontext = campaign.question.replace("[term]", cgi.escape(term.term))
-                identifier = "%s|%s|%s" % (campaign.id, term.id, cgi.escape(term.term))
-                question_form.append(create_question(identifier,
-                                                     questiontext,
-                                                     answers))
-  
-        # Create a locale requirement that answerers must be in the US
-        qualifications = Qualifications()
-        lr = LocaleRequirement("EqualTo","US")
-        qualifications.add(lr)
-        print lr.get_as_params()
-
-        # Now that the questions have been added, create the HIT
-        conn.create_hit(questions=question_form,
-                        max_assignments=campaign.times_per_term,
-                        title=campaign.title,
-                        description=campaign.title,
-                        duration=60*30, # allot 30 minutes per quiz 
-                        qualifications=qualifications, # require the answerers be in the US
-                        reward=campaign.reward_per_quiz)
+    if campaign.job_generated and dry_run_dir is None:
+        return 0
+    roundnum = 0
+    if campaign.adaptive:
+        # plan_round plans the round after the last one published
+        roundnum = campaign.rounds_published or 0
+        pages = adaptive.plan_round(campaign)
+    else:
+        terms = db.session.query(CampaignTerm.id, CampaignTerm.term) \
+                          .filter(CampaignTerm.campaign_id == campaign.id) \
+                          .filter(CampaignTerm.reused_from == None) \
+                          .order_by(CampaignTerm.id) \
+                          .all()
+
+        # Determine the number of quizzes that need to be generated
+        numquizzes = int(math.ceil(float(len(terms)) / campaign.terms_per_quiz))
+        published = set()
+        if dry_run_dir is None:
+            published.update(pagenum for pagenum, in db.session.query(CampaignPage.page_number)
+                                                              .filter(CampaignPage.campaign_id == campaign.id))
+        pages = [(pagenum, campaign.times_per_term, 
+                  terms[pagenum * campaign.terms_per_quiz:(pagenum + 1) * campaign.terms_per_quiz])
+                 for pagenum in range(numquizzes) if pagenum not in published]
+
+    failures = publish_pages(campaign, pages, roundnum, connection_factory, workers, progress, dry_run_dir)
 
     # Update the campaign to prevent multiple generation attempts
-    campaign.job_generated = True
-    db.session.add(campaign)
-    db.session.commit()
+    if failures == 0 and dry_run_dir is None:
+        campaign.job_generated = True
+        campaign.rounds_published = roundnum + 1
+        db.session.add(campaign)
+        db.session.commit()
+    return failures
+
+def create_next_round(campaignid, connection_factory=None, workers=None, progress=None):
+    """
+    Publish the next round of an adaptive campaign: pages for the terms that
+    are still inconclusive (see adaptive.plan_round). When there's nothing 
+    left to ask, the campaign is marked finished instead. Returns the number
+    of pages that could not be published.
+    """
+    campaign = Campaign.query.filter_by(id=campaignid).first()
+    roundnum = campaign.rounds_published or 0
+    pages = adaptive.plan_round(campaign)
+    failures = publish_pages(campaign, pages, roundnum, connection_factory, workers, progress)
+
+    if failures == 0:
+        if CampaignPage.query.filter_by(campaign_id=campaign.id, round=roundnum).count():
+            campaign.rounds_published = roundnum + 1
+        else:
+            campaign.finished = True
+        db.session.add(campaign)
+        db.session.commit()
+    return failures
 
 ### HIT Review & Approval ###
-def retrieve_reviewable_hits():
+def get_all_reviewable_hits(connection, page_size=100):
+    """
+    Get every reviewable HIT, walking through all the result pages.
+    The largest possible page size is 100.
+    """
+    hits = []
+    page_number = 1
+    while True:
+        page = connection.get_reviewable_hits(page_size=page_size, page_number=page_number)
+        hits.extend(page)
+        if len(page) == 0 or page_number * page_size >= int(page.TotalNumResults):
+            return hits
+        page_number += 1
+
+def get_all_assignments(connection, hitid, page_size=100):
+    """
+    Get every assignment for a HIT, walking through all the result pages.
+    """
+    assignments = []
+    page_number = 1
+    while True:
+        page = connection.get_assignments(hitid, page_size=page_size, page_number=page_number)
+        assignments.extend(page)
+        if len(page) == 0 or page_number * page_size >= int(page.TotalNumResults):
+            return assignments
+        page_number += 1
+
+def review_assignment(connection, review):
+    """
+    Approve or reject an assignment, given (assignment_id, 'approved' or 
+    'rejected'). Returns None on success or the error on failure.
+    """
+    assignmentid, decision = review
+    try:
+        if decision == 'rejected':
+            connection.reject_assignment(assignmentid, quality.REJECT_FEEDBACK)
+        else:
+            connection.approve_assignment(assignmentid)
+        return None
+    except:
+        return sys.exc_info()[0]
+
+def block_worker(connection, workerid):
+    """
+    Block a worker from our HITs, returning None on success or the error on failure.
+    """
+    try:
+        connection.block_worker(workerid, quality.BLOCK_REASON)
+        return None
+    except:
+        return sys.exc_info()[0]
+
+def finish_hit(connection, hitid):
+    """
+    Take a HIT whose assignments have all been approved out of the 
+    reviewable set: dispose of it, or with MTURK_DISPOSE_HITS off just mark
+    it as being reviewed. Returns None on success or the error on failure.
+    """
+    try:
+        if DISPOSE_HITS:
+            connection.dispose_hit(hitid)
+        else:
+            connection.set_reviewing(hitid)
+        return None
+    except:
+        return sys.exc_info()[0]
+
+def retrieve_reviewable_hits(connection_factory=None, workers=None, progress=None):
     """
     Get completed HITs from Mechanical Turk. 
 
     MTurk will only return HITs if all the assignments have
     been completed for a HIT, so there will be no returns
     if 6 assignments out of 10 have been completed, for example.
+
+    Every page of reviewable HITs is processed. The assignments for a page
+    are fetched concurrently (MTURK_FETCH_WORKERS threads) and only the ones
+    that haven't been stored before are stored. Then every stored assignment
+    of the page that hasn't been reviewed yet is approved, or rejected if
+    its worker has been rejected (see quality), and the HITs with nothing
+    left to review are disposed of (or with MTURK_DISPOSE_HITS off, marked
+    as being reviewed), so they aren't reviewable the next time. HITs that
+    were reviewed by an earlier fetch aren't fetched again, just disposed 
+    of. A HIT marked as being reviewed that is reviewable again is fetched
+    again, in case it has new assignments. Finally any newly blocked 
+    workers are blocked.
+    <progress>, if given, is called with (HITs done, total HITs) as pages are processed.
     """
+    pool = get_pool(connection_factory)
+
     # Need to report back whether or not results were returned 
     results_returned = False
 
-    # Create connection to MTurk service
-    connection = create_connection()
-    
-    page_size = 100 # The largest possible page size is 100
-
     # Get reviewable HITs from MTurk
-    hits = connection.get_reviewable_hits(page_size=page_size)
-    for hit in hits:
-        # A HIT can have multiple assignments
-        assignments = connection.get_assignments(hit.HITId)
-        for assignment in assignments:
-            # Loop through the assignment collection to get the results 
-            # of each question (as multiple questions can be attached
-            # to a single assignment).
-            for answer in assignment.answers[0]:
-                for identifier, optionfield in answer.fields:
-                    # Record the answer in the database
-                    campaignid, termid, _ = identifier.split("|")
-                    optionid, _ = optionfield.split("|")
-                    ans_count = CampaignAnswer.query.filter_by(hit=hit.HITId,
-                                                                     worker=assignment.WorkerId,
-                                                                     campaign_id=campaignid,
-                                                                     term_id=termid,
-                                                                     option_id=optionid).count()
-                    if ans_count == 0:
-                        answer = CampaignAnswer(hit.HITId, 
-                                                assignment.WorkerId,
-                                                campaignid,
-                                                termid,
-                                                optionid)
-                        db.session.add(answer)
-
-                        logitem = ActionLog("retrieve_reviewable_hits::answerloop",
-                                            "campaign: %s, term: %s, option: %s" % 
-                                            (campaignid, termid, optionid))
-                        db.session.add(logitem)
-                        results_returned = True
- 
-    # Save answers to the database
+    with pool.connection() as connection:
+        hitids = [hit.HITId for hit in get_all_reviewable_hits(connection)]
+
+    page_size = 100
+    for start in range(0, len(hitids), page_size):
+        if progress is not None:
+            progress(start, len(hitids))
+        batch = hitids[start:start + page_size]
+        states = hit_states(batch)
+        finished = [hitid for hitid in batch if states.get(hitid) in ('approved', 'disposed')]
+        unfinished = [hitid for hitid in batch if hitid not in finished]
+
+        # A HIT can have multiple assignments; store the ones we haven't seen
+        stored = stored_assignments(unfinished)
+        page = [(hitid, [assignment for assignment in assignments 
+                         if assignment.AssignmentId not in stored])
+                for hitid, assignments in zip(unfinished, 
+                                              run_concurrently(get_all_assignments, unfinished,
+                                                               pool, workers))]
+        mark_pages_completed(batch)
+        if store_answers(page) > 0:
+            results_returned = True
+
+        # Review whatever is stored but not reviewed, including assignments
+        # an earlier fetch failed to approve or reject
+        pending = pending_approvals(unfinished)
+        decisions = quality.reviews(pending)
+        errors = run_concurrently(review_assignment, 
+                                  [(assignmentid, decision) for (_, assignmentid), decision
+                                   in zip(pending, decisions)],
+                                  pool, workers)
+        record_reviews([(hitid, assignmentid, decision, error) 
+                        for (hitid, assignmentid), decision, error in zip(pending, decisions, errors)])
+
+        # Take every fully approved HIT out of the reviewable set
+        states = hit_states(unfinished)
+        done = finished + [hitid for hitid in unfinished if states.get(hitid) in ('approved', 'reviewing')]
+        errors = run_concurrently(finish_hit, done, pool, workers)
+        for hitid, error in zip(done, errors):
+            if error is not None:
+                log_action("finish_hit - failed", "HITId: %s, error: %s" % (hitid, error))
+        set_hit_status([hitid for hitid, error in zip(done, errors) if error is None],
+                       'disposed' if DISPOSE_HITS else 'reviewing')
+        db.session.commit()
+
+    # Keep the workers the policy has blocked off our HITs
+    blocking = quality.workers_to_block()
+    errors = run_concurrently(block_worker, blocking, pool, workers)
+    for workerid, error in zip(blocking, errors):
+        if error is None:
+            log_action("block_worker", "WorkerId: %s" % workerid)
+        else:
+            log_action("block_worker - failed", "WorkerId: %s, error: %s" % (workerid, error))
+    quality.record_blocks([workerid for workerid, error in zip(blocking, errors) if error is None])
     db.session.commit()
 
-    # Process the HIT approvals to prevent multiple attempts to save
-    # Only do this if there were valid results returned
-    if (len(hits) > 0) and (results_returned == True):
-        for hit in hits:
-            assignments = connection.get_assignments(hit.HITId)
-            for assignment in assignments:
-                try:
-                    # Right now this is approving everything; that's probably
-                    # not going to be the correct behavior in the long term.
-                    connection.approve_assignment(assignment.AssignmentId)
-                    logitem = ActionLog("approve_assignment",
-                                        "HITId: %s, AssignmentId: %s" % (hit.HITId, assignment.AssignmentId))
-                    db.session.add(logitem)
-                except:
-                    logitem = ActionLog("approve_assignment - failed",
-                                        "HITId: %s, AssignmentId: %s, error: %s" %
-                                        (hit.HITId, assignment.AssignmentId, sys.exc_info()[0]))
+    if progress is not None:
+        progress(len(hitids), len(hitids))
     return results_returned
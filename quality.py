@@ -0,0 +1,344 @@
+"""
+Worker quality: statistics on every Mechanical Turk worker, kept up to date
+as their answers are stored, and the review policy built on them.
+
+For each page of HITs stored, the WorkerStats of the workers on it are
+added to:
+
+    * answers and assignments stored
+    * answers compared with the consensus of the other workers on the same
+      term (the option with the most of their votes, if there is one), and
+      how many of those agreed with it
+    * assignments timed (from their accept and submit times), the seconds
+      they took, and how many were rushed: quicker than
+      WORKER_MIN_SECONDS_PER_ANSWER for each answer on them
+
+The consensus comes from the tallies of the terms on the page, so nothing
+is recounted over earlier answers.
+
+With WORKER_REVIEW on, the policy then judges each worker on the page:
+
+    ok        - their assignments are approved
+    rejected  - once WORKER_MIN_COMPARED of their answers have been compared,
+                if fewer than WORKER_REJECT_AGREEMENT of them agreed; or once
+                WORKER_MIN_TIMED of their assignments have been timed, if
+                more than WORKER_MAX_RUSHED of them were rushed. Their
+                assignments are rejected, and all their answers (earlier
+                ones too) are left out of the tallies and aggregation
+    blocked   - fewer than WORKER_BLOCK_AGREEMENT agreed: rejected, and also
+                blocked from our HITs on Mechanical Turk
+
+A worker's status only gets worse. With WORKER_REVIEW off the statistics are
+still kept, but every assignment is approved.
+"""
+from datetime import datetime
+from models import db, batches, AssignmentSync, Campaign, CampaignAnswer, CampaignTally, WorkerStats, record_votes
+
+import settings
+
+WORKER_REVIEW = getattr(settings, 'WORKER_REVIEW', True)
+WORKER_MIN_COMPARED = getattr(settings, 'WORKER_MIN_COMPARED', 20)
+WORKER_REJECT_AGREEMENT = getattr(settings, 'WORKER_REJECT_AGREEMENT', 0.5)
+WORKER_BLOCK_AGREEMENT = getattr(settings, 'WORKER_BLOCK_AGREEMENT', 0.3)
+WORKER_MIN_SECONDS_PER_ANSWER = getattr(settings, 'WORKER_MIN_SECONDS_PER_ANSWER', 2)
+WORKER_MIN_TIMED = getattr(settings, 'WORKER_MIN_TIMED', 5)
+WORKER_MAX_RUSHED = getattr(settings, 'WORKER_MAX_RUSHED', 0.5)
+REJECT_FEEDBACK = getattr(settings, 'WORKER_REJECT_FEEDBACK',
+                          "Your answers mostly disagreed with the other workers' answers to the same terms.")
+BLOCK_REASON = getattr(settings, 'WORKER_BLOCK_REASON',
+                       "Answers consistently disagreed with other workers'.")
+
+# Statuses, from best to worst
+STATUSES = ['ok', 'rejected', 'blocked']
+EXCLUDED = ('rejected', 'blocked')
+
+def worker_statuses(workerids):
+    """
+    {worker_id: status} for the workers in <workerids> seen before.
+    """
+    statuses = {}
+    for batch in batches(set(workerids)):
+        statuses.update(db.session.query(WorkerStats.worker_id, WorkerStats.status)
+                                  .filter(WorkerStats.worker_id.in_(batch)))
+    return statuses
+
+def is_excluded(status):
+    return status in EXCLUDED
+
+### Statistics ###
+def parse_time(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+    except (TypeError, ValueError):
+        return None
+
+def assignment_seconds(assignment):
+    """
+    How long a worker spent on an assignment, if Mechanical Turk says.
+    """
+    accepted = parse_time(getattr(assignment, 'AcceptTime', None))
+    submitted = parse_time(getattr(assignment, 'SubmitTime', None))
+    if accepted is None or submitted is None:
+        return None
+    delta = submitted - accepted
+    return delta.days * 86400 + delta.seconds
+
+def term_tallies(terms):
+    """
+    {(campaign_id, term_id): {option_id: votes}} for a set of
+    (campaign_id, term_id) pairs.
+    """
+    per_campaign = {}
+    for campaignid, termid in terms:
+        per_campaign.setdefault(campaignid, set()).add(termid)
+    tallies = dict((key, {}) for key in terms)
+    for campaignid, termids in per_campaign.items():
+        for batch in batches(sorted(termids)):
+            for termid, optionid, votes in db.session.query(CampaignTally.term_id,
+                                                            CampaignTally.option_id,
+                                                            CampaignTally.votes) \
+                                                     .filter(CampaignTally.campaign_id == campaignid) \
+                                                     .filter(CampaignTally.term_id.in_(batch)):
+                tallies[(campaignid, termid)][optionid] = votes
+    return tallies
+
+def compare(answer, tally):
+    """
+    Compare an answer with the consensus of the other votes in its term's
+    <tally> ({option_id: votes}, including the answer itself unless it's
+    excluded). Returns (compared, agreed) as 0s and 1s.
+    """
+    others = dict(tally)
+    if not answer['excluded'] and others.get(answer['option_id']):
+        others[answer['option_id']] -= 1
+    best = max(others.values()) if others else 0
+    leaders = [optionid for optionid, votes in others.items() if votes == best]
+    if best <= 0 or len(leaders) != 1:
+        return 0, 0
+    return 1, int(leaders[0] == answer['option_id'])
+
+def record_answers(answers, assignments):
+    """
+    Add a page of newly stored answers to their workers' statistics, then
+    judge the workers (see judge). Call after the answers' votes have been
+    added to the tallies.
+
+    <answers> are the answer rows stored (dicts with worker, campaign_id,
+    term_id, option_id and excluded); <assignments> is a list of
+    (worker_id, number of answers, seconds or None) for the assignments
+    they came from. Left in the session; returns the ids of any campaigns
+    whose tallies changed because a worker was rejected.
+    """
+    now = datetime.utcnow()
+    stats = {}
+    def stats_for(workerid):
+        if workerid not in stats:
+            stats[workerid] = {'answers': 0, 'assignments': 0, 'compared': 0, 'agreed': 0,
+                               'timed': 0, 'seconds': 0.0, 'rushed': 0}
+        return stats[workerid]
+
+    tallies = term_tallies(set((answer['campaign_id'], answer['term_id']) for answer in answers))
+    for answer in answers:
+        counts = stats_for(answer['worker'])
+        compared, agreed = compare(answer, tallies[(answer['campaign_id'], answer['term_id'])])
+        counts['answers'] += 1
+        counts['compared'] += compared
+        counts['agreed'] += agreed
+
+    for workerid, numanswers, seconds in assignments:
+        counts = stats_for(workerid)
+        counts['assignments'] += 1
+        if seconds is not None:
+            counts['timed'] += 1
+            counts['seconds'] += seconds
+            if seconds < WORKER_MIN_SECONDS_PER_ANSWER * numanswers:
+                counts['rushed'] += 1
+
+    if not stats:
+        return set()
+    add_stats(stats, now)
+    return judge(stats.keys())
+
+def add_stats(stats, now):
+    """
+    Add {worker_id: {column: amount}} to the workers' statistics, creating
+    the rows of workers seen for the first time.
+    """
+    columns = ['answers', 'assignments', 'compared', 'agreed', 'timed', 'seconds', 'rushed']
+    known = worker_statuses(stats.keys())
+    table = WorkerStats.__table__
+
+    updates = []
+    for workerid in sorted(known):
+        update = dict(('b_' + column, stats[workerid][column]) for column in columns)
+        update['b_worker_id'] = workerid
+        updates.append(update)
+    if updates:
+        db.session.execute(table.update()
+                                .where(table.c.worker_id == db.bindparam('b_worker_id'))
+                                .values(updated=now, **dict((column, table.c[column] + db.bindparam('b_' + column))
+                                                            for column in columns)),
+                           updates)
+
+    inserts = []
+    for workerid in sorted(set(stats) - set(known)):
+        insert = dict(stats[workerid])
+        insert.update({'worker_id': workerid, 'status': 'ok', 'block_sent': False, 'updated': now})
+        inserts.append(insert)
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+
+### Policy ###
+def verdict(worker):
+    """
+    The status the policy gives a worker on their statistics.
+    """
+    agreement = worker.agreement()
+    if worker.compared >= WORKER_MIN_COMPARED and agreement is not None:
+        if agreement < WORKER_BLOCK_AGREEMENT:
+            return 'blocked'
+        if agreement < WORKER_REJECT_AGREEMENT:
+            return 'rejected'
+    if worker.timed >= WORKER_MIN_TIMED and worker.rushed > WORKER_MAX_RUSHED * worker.timed:
+        return 'rejected'
+    return 'ok'
+
+def judge(workerids):
+    """
+    Apply the policy to the workers in <workerids>, moving any whose verdict
+    is worse than their status to the verdict, and excluding the answers of
+    those newly rejected or blocked. Does nothing with WORKER_REVIEW off.
+    Left in the session; returns the ids of the campaigns whose tallies
+    changed.
+    """
+    if not WORKER_REVIEW:
+        return set()
+    campaignids = set()
+    for batch in batches(sorted(workerids)):
+        for worker in WorkerStats.query.filter(WorkerStats.worker_id.in_(batch)):
+            status = verdict(worker)
+            if STATUSES.index(status) <= STATUSES.index(worker.status or 'ok'):
+                continue
+            if not is_excluded(worker.status):
+                campaignids.update(exclude_answers(worker.worker_id))
+            worker.status = status
+            worker.updated = datetime.utcnow()
+    return campaignids
+
+def exclude_answers(workerid):
+    """
+    Leave a worker's answers out of the tallies from now on: mark them
+    excluded and take their votes back off. Returns the ids of the
+    campaigns they were in.
+    """
+    votes = dict(((campaignid, termid, optionid), -count)
+                 for campaignid, termid, optionid, count
+                 in db.session.query(CampaignAnswer.campaign_id, CampaignAnswer.term_id,
+                                     CampaignAnswer.option_id, db.func.count(CampaignAnswer.id))
+                              .filter(CampaignAnswer.worker == workerid)
+                              .filter(CampaignAnswer.excluded == False)
+                              .group_by(CampaignAnswer.campaign_id, CampaignAnswer.term_id,
+                                        CampaignAnswer.option_id))
+    if not votes:
+        return set()
+    CampaignAnswer.query.filter(CampaignAnswer.worker == workerid) \
+                        .filter(CampaignAnswer.excluded == False) \
+                        .update({'excluded': True}, synchronize_session=False)
+    record_votes(votes)
+    return set(campaignid for campaignid, _, _ in votes)
+
+def reviews(pending):
+    """
+    What to do with each of a list of stored (hit_id, assignment_id):
+    'rejected' if the assignment's worker has been rejected or blocked,
+    otherwise 'approved'.
+    """
+    if not WORKER_REVIEW:
+        return ['approved'] * len(pending)
+    workers = {}
+    for batch in batches(assignmentid for _, assignmentid in pending):
+        workers.update(db.session.query(AssignmentSync.assignment_id, AssignmentSync.worker_id)
+                                 .filter(AssignmentSync.assignment_id.in_(batch)))
+    statuses = worker_statuses(workerid for workerid in workers.values() if workerid)
+    return ['rejected' if is_excluded(statuses.get(workers.get(assignmentid))) else 'approved'
+            for _, assignmentid in pending]
+
+def workers_to_block():
+    """
+    The ids of blocked workers who haven't been blocked on Mechanical Turk yet.
+    """
+    if not WORKER_REVIEW:
+        return []
+    return [workerid for workerid, in db.session.query(WorkerStats.worker_id)
+                                                .filter(WorkerStats.status == 'blocked')
+                                                .filter(WorkerStats.block_sent == False)
+                                                .order_by(WorkerStats.worker_id)]
+
+def record_blocks(workerids):
+    """
+    Note that <workerids> have been blocked on Mechanical Turk. Left in the session.
+    """
+    for batch in batches(workerids):
+        WorkerStats.query.filter(WorkerStats.worker_id.in_(batch)) \
+                         .update({'block_sent': True, 'updated': datetime.utcnow()},
+                                 synchronize_session=False)
+
+### Maintenance ###
+def rebuild_worker_stats(batch_size=50000):
+    """
+    Recount every worker's answers and agreement from the raw answers, then
+    judge them all. The assignment counts and times can't be recovered from
+    the answers, so they're left as they are. Used to fill in the statistics
+    of answers stored before they were kept; the caller commits. Returns the
+    ids of the campaigns whose tallies changed.
+    """
+    stats = {}
+    for campaign in Campaign.query.order_by(Campaign.id):
+        tallies = {}
+        for termid, optionid, votes in db.session.query(CampaignTally.term_id,
+                                                        CampaignTally.option_id,
+                                                        CampaignTally.votes) \
+                                                 .filter(CampaignTally.campaign_id == campaign.id):
+            tallies.setdefault(termid, {})[optionid] = votes
+
+        lastid = 0
+        while True:
+            batch = db.session.query(CampaignAnswer.id, CampaignAnswer.worker, CampaignAnswer.term_id,
+                                     CampaignAnswer.option_id, CampaignAnswer.excluded) \
+                              .filter(CampaignAnswer.campaign_id == campaign.id) \
+                              .filter(CampaignAnswer.id > lastid) \
+                              .order_by(CampaignAnswer.id) \
+                              .limit(batch_size) \
+                              .all()
+            if not batch:
+                break
+            lastid = batch[-1][0]
+            for _, workerid, termid, optionid, excluded in batch:
+                counts = stats.setdefault(workerid, {'answers': 0, 'compared': 0, 'agreed': 0})
+                compared, agreed = compare({'option_id': optionid, 'excluded': bool(excluded)},
+                                           tallies.get(termid, {}))
+                counts['answers'] += 1
+                counts['compared'] += compared
+                counts['agreed'] += agreed
+
+    now = datetime.utcnow()
+    table = WorkerStats.__table__
+    known = worker_statuses(stats.keys())
+    updates = [{'b_worker_id': workerid, 'b_answers': counts['answers'],
+                'b_compared': counts['compared'], 'b_agreed': counts['agreed']}
+               for workerid, counts in sorted(stats.items()) if workerid in known]
+    if updates:
+        db.session.execute(table.update()
+                                .where(table.c.worker_id == db.bindparam('b_worker_id'))
+                                .values(answers=db.bindparam('b_answers'),
+                                        compared=db.bindparam('b_compared'),
+                                        agreed=db.bindparam('b_agreed'),
+                                        updated=now),
+                           updates)
+    inserts = [{'worker_id': workerid, 'answers': counts['answers'], 'assignments': 0,
+                'compared': counts['compared'], 'agreed': counts['agreed'], 'timed': 0,
+                'seconds': 0.0, 'rushed': 0, 'status': 'ok', 'block_sent': False, 'updated': now}
+               for workerid, counts in sorted(stats.items()) if workerid not in known]
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    return judge(stats.keys())
@@ -0,0 +1,136 @@
+"""
+Loading campaigns for the views.
+
+Campaigns are loaded with their options in a fixed number of queries, 
+however many terms they have; term texts are read as plain columns. 
+Anything computed while handling a request is cached on flask.g so it is
+only computed once per request.
+"""
+from flask import g, abort
+from functools import wraps
+from sqlalchemy.orm import noload, subqueryload
+
+from models import db, finished_campaigns, Campaign, CampaignTerm
+
+def request_cached(func):
+    """
+    Remember the decorated function's results (by its arguments) until the
+    end of the current request.
+    """
+    @wraps(func)
+    def wrapper(*args):
+        cache = getattr(g, 'repository_cache', None)
+        if cache is None:
+            cache = g.repository_cache = {}
+        key = (func.__name__,) + args
+        if key not in cache:
+            cache[key] = func(*args)
+        return cache[key]
+    return wrapper
+
+@request_cached
+def get_campaign(campaignid):
+    """
+    A campaign with its options already loaded (two queries in all), or a
+    404 if there is no such campaign. Its terms are only loaded if asked
+    for; the campaign page reads them a slice at a time.
+    """
+    return Campaign.query.options(subqueryload('options')) \
+                         .filter_by(id=campaignid) \
+                         .first_or_404()
+
+@request_cached
+def get_campaign_settings(campaignid):
+    """
+    A campaign to prefill a form from: its options are loaded (two queries
+    in all) and its terms relationship reads as empty instead of loading 
+    every term. See get_term_texts for the terms.
+    """
+    return Campaign.query.options(subqueryload('options'), noload('terms')) \
+                         .filter_by(id=campaignid) \
+                         .first_or_404()
+
+@request_cached
+def get_term_texts(campaignid):
+    """
+    The text of every term of a campaign in order, read as a single column.
+    """
+    return [term for term, in db.session.query(CampaignTerm.term)
+                                        .filter(CampaignTerm.campaign_id == campaignid)
+                                        .order_by(CampaignTerm.id)]
+
+@request_cached
+def get_campaign_version(campaignid):
+    """
+    Just the campaign columns that cached responses depend on (one query),
+    or a 404 if there is no such campaign.
+    """
+    version = db.session.query(Campaign.id, Campaign.results_version, Campaign.results_updated,
+                               Campaign.outcomes_version,
+                               Campaign.aggregation, Campaign.threshold, Campaign.job_generated,
+                               Campaign.adaptive, Campaign.rounds_published, Campaign.finished, 
+                               Campaign.archived) \
+                        .filter(Campaign.id == campaignid) \
+                        .first()
+    if version is None:
+        abort(404)
+    return version
+
+@request_cached
+def is_finished(campaignid):
+    """
+    Whether a campaign is finished (see Campaign.is_finished), worked out
+    from get_campaign_version without loading the campaign.
+    """
+    version = get_campaign_version(campaignid)
+    return version.id in finished_campaigns([version])
+
+@request_cached
+def get_inconclusive_terms(campaignid):
+    """
+    The terms of a campaign that haven't got a conclusive answer yet.
+    """
+    return get_campaign_settings(campaignid).get_inconclusive_terms()
+
+def get_result_batch(campaignids=None, updated_since=None, since=None, position=None, limit=100):
+    """
+    A page of results across campaigns, in campaign and term order, for 
+    syncing them elsewhere: the decided terms of <campaignids> (every 
+    campaign if None) or of those whose results were updated at or after
+    <updated_since>, or with <since> every term changed after that change
+    number, decided or not. <position> is the (campaign id, term id) the
+    last page ended at.
+
+    Each campaign on the page costs one indexed slice (see 
+    Campaign.get_result_slice), however many terms it has. Returns a list
+    of (campaign, ResultMatrix) and the position to pass for the next page,
+    or None after the last.
+    """
+    query = db.session.query(Campaign.id)
+    if campaignids is not None:
+        query = query.filter(Campaign.id.in_(campaignids))
+    if updated_since is not None:
+        query = query.filter(Campaign.results_updated >= updated_since)
+    if since is not None:
+        query = query.filter(Campaign.changed > since)
+    if position is not None:
+        query = query.filter(Campaign.id >= position[0])
+    ids = [campaignid for campaignid, in query.order_by(Campaign.id)]
+
+    pages = []
+    for num, campaignid in enumerate(ids):
+        after = position[1] if position is not None and campaignid == position[0] else None
+        campaign = get_campaign(campaignid)
+        matrix, following = campaign.get_result_slice(after=after, limit=limit,
+                                                      outcome='decided' if since is None else None,
+                                                      since=since)
+        if len(matrix):
+            pages.append((campaign, matrix))
+        limit -= len(matrix)
+        if following is not None:
+            return pages, (campaignid, following)
+        if limit == 0:
+            if num + 1 < len(ids):
+                return pages, (ids[num + 1], None)
+            break
+    return pages, None
@@ -0,0 +1,141 @@
+"""
+Reusing the results of earlier campaigns.
+
+The same question is often asked again, with the same answers, about a
+term list that overlaps one asked before (a clone of a campaign, or the
+next batch of a recurring one). Every term is stored with a fingerprint of
+its normalized question, set of answers and term text (see fingerprint),
+indexed, so the earlier outcomes of a new campaign's terms can be found
+with a few lookups however many campaigns came before.
+
+A campaign created with reuse_results has its terms that an earlier
+campaign decided, with a percentage above the new campaign's threshold,
+filled in with that outcome (see prefill). Those terms are marked with the
+term they were reused from, are left out of the campaign's HITs and its
+cost, and keep their outcome whatever the rest of the campaign's answers
+do.
+"""
+from models import db, batches, CampaignOption, CampaignTerm, next_change
+
+import hashlib
+
+def normalize(text):
+    """
+    Lower case, with runs of whitespace collapsed to single spaces.
+    """
+    return u" ".join(text.lower().split())
+
+def question_key(question, options):
+    """
+    The part of the fingerprint shared by every term of a campaign: its
+    question and its set of answers, normalized.
+    """
+    parts = [normalize(question)] + sorted(set(normalize(option) for option in options))
+    return u"\n".join(parts)
+
+def fingerprint(key, term):
+    """
+    The SHA-1 of a term's normalized text under a question_key.
+    """
+    return hashlib.sha1((key + u"\x00" + normalize(term)).encode('utf-8')).hexdigest()
+
+def campaign_key(campaign):
+    """
+    question_key of a campaign already in the database.
+    """
+    options = [text for text, in db.session.query(CampaignOption.option_text)
+                                           .filter(CampaignOption.campaign_id == campaign.id)]
+    return question_key(campaign.question, options)
+
+def fingerprint_terms(campaign):
+    """
+    Fill in the fingerprints of a campaign's terms that don't have one yet
+    (those loaded before fingerprints were kept). Left in the session.
+    """
+    key = campaign_key(campaign)
+    table = CampaignTerm.__table__
+    statement = table.update() \
+                     .where(table.c.id == db.bindparam('b_id')) \
+                     .values(fingerprint=db.bindparam('b_fingerprint'))
+    terms = db.session.query(CampaignTerm.id, CampaignTerm.term) \
+                      .filter(CampaignTerm.campaign_id == campaign.id) \
+                      .filter(CampaignTerm.fingerprint == None) \
+                      .all()
+    for batch in batches(terms):
+        db.session.execute(statement, [{'b_id': termid, 'b_fingerprint': fingerprint(key, term)}
+                                       for termid, term in batch])
+    return len(terms)
+
+def earlier_outcomes(campaign, fingerprints, threshold):
+    """
+    {fingerprint: (term id, answer text, percentage)} for the most recent
+    term of another campaign with each of <fingerprints> that was decided
+    with a percentage above <threshold>.
+    """
+    found = {}
+    rows = db.session.query(CampaignTerm.id, CampaignTerm.fingerprint,
+                            CampaignTerm.answer_option_id, CampaignTerm.answer_percentage) \
+                     .filter(CampaignTerm.fingerprint.in_(fingerprints)) \
+                     .filter(CampaignTerm.decided == True) \
+                     .filter(CampaignTerm.campaign_id != campaign.id) \
+                     .order_by(CampaignTerm.id) \
+                     .all()
+    rows = [row for row in rows if row.answer_percentage is not None and row.answer_percentage > threshold]
+    if not rows:
+        return found
+
+    optionids = set(row.answer_option_id for row in rows)
+    texts = dict(db.session.query(CampaignOption.id, CampaignOption.option_text)
+                           .filter(CampaignOption.id.in_(optionids)))
+    for termid, termfingerprint, optionid, percentage in rows:
+        if optionid in texts:
+            found[termfingerprint] = (termid, texts[optionid], percentage)
+    return found
+
+def prefill(campaign):
+    """
+    Fill in the outcomes of a campaign's terms that an earlier campaign
+    already decided (see earlier_outcomes), and mark them as reused and
+    changed. Only terms that haven't been asked or reused yet are looked
+    at. Left in the session; returns the number of terms filled in.
+    """
+    options = dict((normalize(text), optionid) for optionid, text in
+                   db.session.query(CampaignOption.id, CampaignOption.option_text)
+                             .filter(CampaignOption.campaign_id == campaign.id))
+    threshold = campaign.get_threshold()
+    terms = db.session.query(CampaignTerm.id, CampaignTerm.fingerprint) \
+                      .filter(CampaignTerm.campaign_id == campaign.id) \
+                      .filter(CampaignTerm.reused_from == None) \
+                      .filter(CampaignTerm.decided == False) \
+                      .filter(CampaignTerm.fingerprint != None) \
+                      .order_by(CampaignTerm.id) \
+                      .all()
+
+    table = CampaignTerm.__table__
+    statement = table.update() \
+                     .where(table.c.id == db.bindparam('b_id')) \
+                     .values(reused_from=db.bindparam('b_reused_from'),
+                             decided=True,
+                             answer_option_id=db.bindparam('b_answer_option_id'),
+                             answer_percentage=db.bindparam('b_answer_percentage'),
+                             changed=db.bindparam('b_changed'))
+    filled = 0
+    for batch in batches(terms):
+        found = earlier_outcomes(campaign, set(termfingerprint for _, termfingerprint in batch), threshold)
+        updates = []
+        for termid, termfingerprint in batch:
+            if termfingerprint not in found:
+                continue
+            sourceid, answer, percentage = found[termfingerprint]
+            optionid = options.get(normalize(answer))
+            if optionid is not None:
+                updates.append({'b_id': termid, 'b_reused_from': sourceid,
+                                'b_answer_option_id': optionid, 'b_answer_percentage': percentage})
+        if updates:
+            if not filled:
+                campaign.changed = next_change()
+            for update in updates:
+                update['b_changed'] = campaign.changed
+            db.session.execute(statement, updates)
+            filled += len(updates)
+    return filled
@@ -0,0 +1,254 @@
+"""
+An in-process stand-in for Mechanical Turk.
+
+MTurkSimulator implements the parts of boto's MTurkConnection that mturk.py
+uses (create_hit, search_hits, get_reviewable_hits, get_assignments, 
+approve_assignment, reject_assignment, block_worker, dispose_hit and 
+set_reviewing), returning
+objects shaped like boto's. Every HIT is answered as soon as it's created by
+synthetic workers, each of whom picks the right option with their own 
+accuracy and takes their own time over it, and is reviewable straight away.
+Blocked workers don't answer any more HITs.
+Calls can be slowed down by a fixed latency to stand in for the round trip.
+
+To run the whole application against it, set MTURK_SIMULATOR = True in
+settings.py; mturk.create_connection then returns a simulator shared by
+the process (the job worker, which both publishes and fetches).
+"""
+from boto.mturk.connection import MTurkRequestError
+from datetime import datetime, timedelta
+from xml.etree import ElementTree
+
+import random
+import settings
+import threading
+import time
+import zlib
+
+LATENCY = getattr(settings, 'MTURK_SIMULATOR_LATENCY', 0)
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+QUESTION_NS = "{http://mechanicalturk.amazonaws.com/AWSMechanicalTurkDataSchemas/2005-10-01/QuestionForm.xsd}"
+
+class ResultSet(list):
+    """
+    A list with boto's paging attributes.
+    """
+    def __init__(self, items=(), total=None, page_number=1):
+        list.__init__(self, items)
+        self.NumResults = str(len(self))
+        self.TotalNumResults = str(len(self) if total is None else total)
+        self.PageNumber = str(page_number)
+
+class Record(object):
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+class Answer(object):
+    """
+    Like boto's QuestionFormAnswer: <fields> is a list of (question id, value).
+    """
+    def __init__(self, qid, value):
+        self.qid = qid
+        self.fields = [(qid, value)]
+
+def parse_question_form(xml):
+    """
+    The (question identifier, [selection identifiers]) of every question
+    in a serialized question form.
+    """
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+    questions = []
+    for question in ElementTree.fromstring(xml).iter(QUESTION_NS + "Question"):
+        identifier = question.find(QUESTION_NS + "QuestionIdentifier").text
+        selections = [selection.text for selection
+                      in question.iter(QUESTION_NS + "SelectionIdentifier")]
+        questions.append((identifier, selections))
+    return questions
+
+def hashed_truth(identifier, selections):
+    """
+    The default right answer to a question: one of its selections, picked
+    by a hash of the question identifier so it's the same on every run.
+    """
+    return zlib.crc32(identifier.encode('utf-8')) % len(selections)
+
+class MTurkSimulator(object):
+    """
+    A fake Mechanical Turk. Thread safe, so a single simulator can be
+    shared by every thread of a connection pool.
+
+    <workers> synthetic workers answer each HIT, <accuracy> of the time
+    correctly (either one number or a list with one per worker), taking 
+    <seconds_per_answer> over each question (likewise). <truth>,
+    if given, is called with (question identifier, selections) and returns
+    the index of the right selection. Every call sleeps for <latency>
+    seconds, give or take <jitter> of it.
+    """
+    def __init__(self, workers=50, accuracy=0.9, truth=hashed_truth, latency=LATENCY,
+                 jitter=0.0, seed=0, seconds_per_answer=10):
+        self.random = random.Random(seed)
+        if isinstance(accuracy, (int, float)):
+            accuracy = [accuracy] * workers
+        if isinstance(seconds_per_answer, (int, float)):
+            seconds_per_answer = [seconds_per_answer] * workers
+        self.workers = [("SIMWORKER%04d" % num, accuracy[num]) for num in range(workers)]
+        self.seconds_per_answer = dict((workerid, seconds) for (workerid, _), seconds
+                                       in zip(self.workers, seconds_per_answer))
+        self.blocked = set()
+        self.truth = truth
+        self.latency = latency
+        self.jitter = jitter
+
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.reviewable = []
+        self.disposed = set()
+        self.assignments = {}
+        self.calls = {}
+
+    def __call__(self):
+        """
+        Lets the simulator be used as the connection factory.
+        """
+        return self
+
+    def _call(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            delay = self.latency * (1 + self.jitter * (2 * self.random.random() - 1))
+        if delay > 0:
+            time.sleep(delay)
+
+    def _answer(self, hitid, xml, max_assignments):
+        """
+        Have <max_assignments> different workers answer every question on a HIT.
+        """
+        questions = parse_question_form(xml)
+        truths = [self.truth(identifier, selections) for identifier, selections in questions]
+        available = [worker for worker in self.workers if worker[0] not in self.blocked]
+        if max_assignments > len(available):
+            raise MTurkRequestError(400, "Bad Request",
+                                    "MaxAssignments is more than the %s unblocked simulated workers" %
+                                    len(available))
+        accepted = datetime.utcnow()
+        assignments = []
+        for number, (workerid, accuracy) in enumerate(self.random.sample(available, max_assignments)):
+            answers = []
+            for (identifier, selections), right in zip(questions, truths):
+                choice = right
+                if len(selections) > 1 and self.random.random() >= accuracy:
+                    choice = self.random.choice([other for other in range(len(selections))
+                                                 if other != right])
+                answers.append(Answer(identifier, selections[choice]))
+            submitted = accepted + timedelta(seconds=self.seconds_per_answer[workerid] * len(answers))
+            assignments.append(Record(AssignmentId="%s-%s" % (hitid, number),
+                                      WorkerId=workerid,
+                                      HITId=hitid,
+                                      AssignmentStatus="Submitted",
+                                      AcceptTime=accepted.strftime(TIME_FORMAT),
+                                      SubmitTime=submitted.strftime(TIME_FORMAT),
+                                      answers=[answers]))
+        return assignments
+
+    def create_hit(self, question=None, max_assignments=1, annotation=None, **params):
+        self._call('create_hit')
+        xml = question.get_as_xml()
+        with self.lock:
+            hitid = "SIMHIT%08d" % (len(self.hits) + 1)
+            assignments = self._answer(hitid, xml, max_assignments)
+            self.hits[hitid] = Record(HITId=hitid, HITTypeId="SIMTYPE",
+                                      CreationTime=datetime.utcnow().strftime(TIME_FORMAT),
+                                      RequesterAnnotation=annotation,
+                                      MaxAssignments=max_assignments,
+                                      assignments=assignments)
+            self.reviewable.append(hitid)
+            for assignment in assignments:
+                self.assignments[assignment.AssignmentId] = assignment
+        return ResultSet([Record(HITId=hitid, HITTypeId="SIMTYPE")])
+
+    def search_hits(self, sort_by='CreationTime', sort_direction='Ascending', page_size=10, 
+                    page_number=1, **params):
+        self._call('search_hits')
+        with self.lock:
+            # HIT ids are in the order the HITs were created
+            hitids = sorted((hitid for hitid in self.hits if hitid not in self.disposed),
+                            reverse=(sort_direction == 'Descending'))
+            start = (page_number - 1) * page_size
+            hits = [Record(HITId=hitid, CreationTime=self.hits[hitid].CreationTime,
+                           RequesterAnnotation=self.hits[hitid].RequesterAnnotation)
+                    for hitid in hitids[start:start + page_size]]
+            return ResultSet(hits, len(hitids), page_number)
+
+    def get_reviewable_hits(self, page_size=10, page_number=1, **params):
+        self._call('get_reviewable_hits')
+        with self.lock:
+            start = (page_number - 1) * page_size
+            hits = [Record(HITId=hitid) for hitid in self.reviewable[start:start + page_size]]
+            return ResultSet(hits, len(self.reviewable), page_number)
+
+    def get_assignments(self, hit_id, page_size=10, page_number=1, **params):
+        self._call('get_assignments')
+        with self.lock:
+            if hit_id not in self.hits:
+                raise MTurkRequestError(400, "Bad Request", "No HIT %s" % hit_id)
+            assignments = self.hits[hit_id].assignments
+            start = (page_number - 1) * page_size
+            return ResultSet(assignments[start:start + page_size], len(assignments), page_number)
+
+    def approve_assignment(self, assignment_id, feedback=None):
+        self._call('approve_assignment')
+        with self.lock:
+            if assignment_id not in self.assignments:
+                raise MTurkRequestError(400, "Bad Request", "No assignment %s" % assignment_id)
+            self.assignments[assignment_id].AssignmentStatus = "Approved"
+        return ResultSet()
+
+    def reject_assignment(self, assignment_id, feedback=None):
+        self._call('reject_assignment')
+        with self.lock:
+            if assignment_id not in self.assignments:
+                raise MTurkRequestError(400, "Bad Request", "No assignment %s" % assignment_id)
+            self.assignments[assignment_id].AssignmentStatus = "Rejected"
+        return ResultSet()
+
+    def block_worker(self, worker_id, reason):
+        self._call('block_worker')
+        with self.lock:
+            self.blocked.add(worker_id)
+        return ResultSet()
+
+    def dispose_hit(self, hit_id):
+        self._call('dispose_hit')
+        with self.lock:
+            self.disposed.add(hit_id)
+            if hit_id in self.reviewable:
+                self.reviewable.remove(hit_id)
+        return ResultSet()
+
+    def set_reviewing(self, hit_id, revert=None):
+        self._call('set_reviewing')
+        with self.lock:
+            if hit_id not in self.hits:
+                raise MTurkRequestError(400, "Bad Request", "No HIT %s" % hit_id)
+            if revert:
+                if hit_id not in self.reviewable:
+                    self.reviewable.append(hit_id)
+            elif hit_id in self.reviewable:
+                self.reviewable.remove(hit_id)
+        return ResultSet()
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared_simulator():
+    """
+    The simulator used by mturk.create_connection when MTURK_SIMULATOR is set.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = MTurkSimulator()
+        return _shared
@@ -7,4 +7,38 @@ function addTerms(arrterms){
 
 function clearTerms(){
     $("#terms").val("");
-}
\ No newline at end of file
+}
+
+// Campaign page: load the next slice of results when "Load more" is clicked
+// or scrolled into view
+function loadMoreResults(){
+    var link = $("#more-results");
+    if (!link.length || link.data("loading")){
+	return;
+    }
+    link.data("loading", true).text("Loading...");
+    $.getJSON(link.attr("href"), function(data){
+	$("#results").append(data.html);
+	if (data.next === null){
+	    link.remove();
+	} else {
+	    link.attr("href", link.attr("href").replace(/after=\d+/, "after=" + data.next));
+	    link.data("loading", false).text("Load more");
+	}
+    }).error(function(){
+	link.data("loading", false).text("Load more");
+    });
+}
+
+$(function(){
+    $("#more-results").click(function(event){
+	event.preventDefault();
+	loadMoreResults();
+    });
+    $(window).scroll(function(){
+	var link = $("#more-results");
+	if (link.length && $(window).scrollTop() + $(window).height() > link.offset().top - 200){
+	    loadMoreResults();
+	}
+    });
+});
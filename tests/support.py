@@ -0,0 +1,81 @@
+"""
+Shared setup for the tests: the application bound to a fresh SQLite
+database, with the job queue and archives in a temporary directory, and
+helpers to build campaigns and Mechanical Turk assignments.
+
+Like the benchmarks, the tests use settings.py for everything else.
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+TEMP_DIR = tempfile.mkdtemp(prefix='docsift-tests-')
+
+import settings
+settings.DATABASE_URI = 'sqlite:///' + os.path.join(TEMP_DIR, 'test.db')
+settings.JOB_QUEUE_PATH = os.path.join(TEMP_DIR, 'jobs.db')
+settings.ARCHIVE_DIR = os.path.join(TEMP_DIR, 'archive')
+settings.ACTION_LOG_ASYNC = False
+
+from main import create_app
+from models import db
+from loader import create_campaign
+from ingest import store_answers
+import cache
+from simulator import Answer, Record
+
+app = create_app()
+# Forms are posted straight from the tests, without a CSRF token
+app.config['CSRF_ENABLED'] = False
+
+def drop_tables():
+    """
+    Drop every table in the database, including ones the models don't know
+    (such as schema_version).
+    """
+    db.session.remove()
+    metadata = db.MetaData()
+    metadata.reflect(bind=db.engine)
+    metadata.drop_all(bind=db.engine)
+
+def reset_database():
+    """
+    Start again from empty tables created from the current models, and an
+    empty response cache (campaign ids start from 1 again).
+    """
+    drop_tables()
+    db.create_all()
+    cache.responses = cache.LRUCache()
+
+def make_campaign(terms=('apple', 'beef', 'carrot'), options=('yes', 'no'), times_per_term=3, **kwargs):
+    """
+    A committed campaign asking about <terms>.
+    """
+    return create_campaign('test', 'Is [term] vegetarian?', 10, '0.05', times_per_term,
+                           "\n".join(options), "\n".join(terms), **kwargs)
+
+def make_assignment(assignmentid, workerid, campaign, answers, status='Submitted'):
+    """
+    An assignment shaped like boto's, answering {term text: option text}
+    for <campaign>.
+    """
+    terms = dict((term.term, term.id) for term in campaign.terms)
+    options = dict((option.option_text, option.id) for option in campaign.options)
+    fields = [Answer("%s|%s|%s" % (campaign.id, terms[term], term), "%s|%s" % (options[option], option))
+              for term, option in sorted(answers.items())]
+    return Record(AssignmentId=assignmentid, WorkerId=workerid, AssignmentStatus=status,
+                  answers=[fields])
+
+def answer_campaign(campaign, votes, hitid='HIT1'):
+    """
+    Store answers to <campaign> given as {term text: [option text, ...]}:
+    worker n gives the nth option of each term, all on the HIT <hitid>.
+    """
+    workers = {}
+    for term, options in votes.items():
+        for n, option in enumerate(options):
+            workers.setdefault(n, {})[term] = option
+    return store_answers([(hitid, [make_assignment('%s-A%s' % (hitid, n), 'W%s' % n, campaign, answers)
+                                   for n, answers in sorted(workers.items())])])
@@ -0,0 +1,105 @@
+"""
+Tests for publishing adaptive campaigns in rounds (adaptive.py and the 
+round handling in mturk.py).
+"""
+import os
+import unittest
+
+import support
+
+from models import db, Campaign, CampaignPage
+from simulator import MTurkSimulator
+import adaptive
+import jobs
+import mturk
+
+TERMS = ['term %s' % num for num in range(25)]
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+
+    def campaign(self, **kwargs):
+        settings = dict(terms=TERMS, times_per_term=5, threshold=50, adaptive=True)
+        settings.update(kwargs)
+        return Campaign.query.get(support.make_campaign(**settings).id)
+
+    def test_required_votes(self):
+        self.assertEqual(adaptive.required_votes(self.campaign()), 3)
+        self.assertEqual(adaptive.required_votes(self.campaign(threshold=0)), 1)
+        self.assertEqual(adaptive.required_votes(self.campaign(threshold=99)), 5)
+        self.assertEqual(adaptive.required_votes(self.campaign(times_per_term=1)), 1)
+
+    def test_first_round(self):
+        pages = adaptive.plan_round(self.campaign())
+        self.assertEqual([(pagenum, assignments, len(terms)) for pagenum, assignments, terms in pages],
+                         [(0, 3, 10), (1, 3, 10), (2, 3, 5)])
+        self.assertEqual([term for _, _, terms in pages for termid, term in terms], TERMS)
+
+    def test_budget_cut_off(self):
+        # Each page of three assignments costs $0.15
+        pages = adaptive.plan_round(self.campaign(budget='0.35'))
+        self.assertEqual([pagenum for pagenum, _, _ in pages], [0, 1])
+        self.assertEqual(adaptive.plan_round(self.campaign(budget='0.10')), [])
+
+    def test_next_round_asks_only_undecided_terms(self):
+        campaign = self.campaign(terms=('apple', 'beef', 'carrot'))
+        for page in adaptive.plan_round(campaign):
+            db.session.add(CampaignPage(campaign.id, page[0], 'HIT%s' % page[0], 0, page[1],
+                                        [termid for termid, term in page[2]]))
+        campaign.rounds_published = 1
+        db.session.commit()
+        support.answer_campaign(campaign, {'apple': ['yes', 'yes', 'yes'],
+                                           'beef': ['yes', 'yes', 'no'],
+                                           'carrot': ['yes', 'no', 'no']})
+        campaign = Campaign.query.get(campaign.id)
+        terms = dict((term.term, term.id) for term in campaign.terms)
+        self.assertEqual(adaptive.votes_needed(campaign), {terms['beef']: 1, terms['carrot']: 1})
+        pages = adaptive.plan_round(campaign)
+        self.assertEqual([(pagenum, assignments, [term for termid, term in page_terms])
+                          for pagenum, assignments, page_terms in pages],
+                         [(1, 1, ['beef', 'carrot'])])
+
+class RoundsTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+        if os.path.exists(jobs.QUEUE_PATH):
+            os.remove(jobs.QUEUE_PATH)
+        # Workers who are right about half the time leave some terms undecided
+        self.simulator = MTurkSimulator(workers=10, accuracy=[1.0, 0.0] * 5, latency=0)
+        self.campaignid = support.make_campaign(terms=TERMS, times_per_term=5, threshold=50,
+                                                adaptive=True).id
+
+    def rounds(self):
+        return sorted(set(roundnum for roundnum, in db.session.query(CampaignPage.round)))
+
+    def test_rounds(self):
+        self.assertEqual(mturk.create_campaign_hits(self.campaignid, connection_factory=self.simulator), 0)
+        self.assertEqual(Campaign.query.get(self.campaignid).rounds_published, 1)
+        mturk.retrieve_reviewable_hits(connection_factory=self.simulator)
+        self.assertEqual(mturk.create_next_round(self.campaignid, connection_factory=self.simulator), 0)
+        self.assertEqual(self.rounds(), [0, 1])
+        self.assertEqual(Campaign.query.get(self.campaignid).rounds_published, 2)
+
+        # Generating again doesn't publish another round, under any round number
+        published = CampaignPage.query.count()
+        self.assertEqual(mturk.create_campaign_hits(self.campaignid, connection_factory=self.simulator), 0)
+        self.assertEqual(CampaignPage.query.count(), published)
+        self.assertEqual(Campaign.query.get(self.campaignid).rounds_published, 2)
+
+    def test_generate_only_once(self):
+        client = support.app.test_client()
+        client.post('/campaigns/%s/generate' % self.campaignid)
+        job = jobs.latest_job('generate_hits', self.campaignid)
+        self.assertEqual(job.status, jobs.QUEUED)
+
+        jobs.claim()
+        mturk.create_campaign_hits(self.campaignid, connection_factory=self.simulator)
+        jobs.finish(job.id)
+        response = client.post('/campaigns/%s/generate' % self.campaignid)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(jobs.latest_job('generate_hits', self.campaignid).id, job.id)
+        self.assertEqual(jobs.claim(), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Tests for the answer aggregation strategies in aggregation.py.
+"""
+import numpy
+import unittest
+
+import support
+
+from models import Campaign
+import aggregation
+
+def answers_from(votes):
+    """
+    (counts, (rows, columns, workers)) for <votes>, one list per term of
+    the option column each worker chose (None if they didn't answer).
+    """
+    rows, columns, workers = [], [], []
+    for row, choices in enumerate(votes):
+        for worker, column in enumerate(choices):
+            if column is not None:
+                rows.append(row)
+                columns.append(column)
+                workers.append(worker)
+    rows, columns, workers = [numpy.array(values, dtype=numpy.int64) for values in (rows, columns, workers)]
+    counts = numpy.zeros((len(votes), 2), dtype=numpy.int32)
+    numpy.add.at(counts, (rows, columns), 1)
+    return counts, (rows, columns, workers)
+
+# Workers 0-2 always give the right answer (option 0 for the first four
+# terms, option 1 for the next four); worker 3 always gives the other one
+VOTES = [[0, 0, 0, 1]] * 4 + [[1, 1, 1, 0]] * 4
+
+class StrategyTest(unittest.TestCase):
+    def test_majority(self):
+        counts, answers = answers_from(VOTES[:1] + VOTES[4:5])
+        self.assertEqual(aggregation.majority(counts, answers, 4).tolist(), [[75, 25], [25, 75]])
+        self.assertEqual(aggregation.majority(counts, answers, 0).tolist(), [[300, 100], [100, 300]])
+
+    def test_worker_weighted(self):
+        counts, answers = answers_from(VOTES)
+        scores = aggregation.worker_weighted(counts, answers, 4)
+        # Workers 0-2 weigh (8 + 1) / (8 + 2), worker 3 weighs 1 / 10
+        self.assertTrue(numpy.allclose(scores[0], [2.7 / 2.8 * 100, 0.1 / 2.8 * 100]))
+        self.assertTrue(numpy.allclose(scores[4], scores[0][::-1]))
+
+    def test_worker_weighted_scales_down_unfinished_terms(self):
+        counts, answers = answers_from(VOTES + [[0, 0, None, None]])
+        scores = aggregation.worker_weighted(counts, answers, 4)
+        self.assertTrue(numpy.allclose(scores[8], [50, 0]))
+
+    def test_dawid_skene(self):
+        counts, answers = answers_from(VOTES + [[None, None, None, None]])
+        scores = aggregation.dawid_skene(counts, answers, 4)
+        self.assertEqual(scores[:8].argmax(axis=1).tolist(), [0] * 4 + [1] * 4)
+        self.assertTrue((scores[:8].max(axis=1) > 95).all())
+        self.assertTrue(numpy.allclose(scores[:8].sum(axis=1), 100))
+        self.assertEqual(scores[8].tolist(), [0, 0])
+
+    def test_dawid_skene_trusts_reliable_workers(self):
+        # Workers 0-2 are always right and workers 3 and 4 only half the time,
+        # so on the last term worker 0 on its own outweighs workers 3 and 4
+        votes = []
+        for num in range(16):
+            right = num % 2
+            votes.append([right, right, right,
+                          right if (num // 2) % 2 else 1 - right,
+                          right if (num // 4) % 2 else 1 - right])
+        votes.append([0, None, None, 1, 1])
+        counts, answers = answers_from(votes)
+        self.assertEqual(aggregation.majority(counts, answers, 3)[-1].argmax(), 1)
+        self.assertEqual(aggregation.dawid_skene(counts, answers, 3)[-1].argmax(), 0)
+
+    def test_no_answers(self):
+        counts, answers = answers_from([[], []])
+        for strategy in aggregation.strategies.values():
+            self.assertEqual(strategy(counts, answers, 3).tolist(), [[0, 0], [0, 0]])
+
+class CampaignAggregationTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+
+    def test_campaign_results(self):
+        terms = ['term %s' % num for num in range(8)]
+        votes = dict((term, [['yes', 'no'][column] for column in choices]) for term, choices in zip(terms, VOTES))
+        outcomes = {}
+        for strategy in ('majority', 'weighted', 'dawid_skene'):
+            campaign = support.make_campaign(terms=terms, times_per_term=4, threshold=80, aggregation=strategy)
+            support.answer_campaign(campaign, votes, hitid='HIT-' + strategy)
+            campaign = Campaign.query.get(campaign.id)
+            results = campaign.get_results()
+            outcomes[strategy] = [result.answer.option_text for result in results]
+            self.assertEqual(campaign.get_inconclusive_terms(),
+                             [result.term for result in results if result.is_inconclusive()])
+            self.assertEqual([result[1] for result in campaign.get_result_dump()],
+                             [("" if text == 'Inconclusive' else text) for text in outcomes[strategy]])
+
+        self.assertEqual(outcomes['majority'], ['Inconclusive'] * 8)
+        self.assertEqual(outcomes['weighted'], ['yes'] * 4 + ['no'] * 4)
+        self.assertEqual(outcomes['dawid_skene'], ['yes'] * 4 + ['no'] * 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Tests for archiving a finished campaign's answers and tallies (archive.py
+and Campaign.archive).
+"""
+import os
+import unittest
+
+import support
+
+from ingest import set_hit_status
+from models import db, Campaign, CampaignAnswer, CampaignPage, CampaignTally
+import archive
+import export
+import jobs
+
+VOTES = {'apple': ['yes', 'yes', 'yes'],
+         'beef': ['no', 'no', 'yes'],
+         'carrot': ['yes', 'no']}
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+        campaign = support.make_campaign(threshold=60)
+        campaign.job_generated = True
+        db.session.commit()
+        support.answer_campaign(campaign, VOTES)
+        self.campaignid = campaign.id
+        self.client = support.app.test_client()
+
+    def tearDown(self):
+        archive.remove(self.campaignid)
+
+    def campaign(self):
+        db.session.expire_all()
+        return Campaign.query.get(self.campaignid)
+
+    def results(self):
+        campaign = self.campaign()
+        return ([(result.term, result.answer.option_text, result.answer.percentage)
+                 for result in campaign.get_results()],
+                sorted(campaign.count_votes()),
+                "".join(export.export_results(campaign, 'csv')[0]))
+
+    def archive(self):
+        archived = self.campaign().archive()
+        db.session.commit()
+        return archived
+
+    def test_results_read_back_from_the_archive(self):
+        before = self.results()
+        page = self.client.get('/campaigns/%s' % self.campaignid).data
+
+        self.assertTrue(self.archive())
+        self.assertTrue(os.path.exists(archive.archive_path(self.campaignid)))
+        self.assertEqual(CampaignAnswer.query.filter_by(campaign_id=self.campaignid).count(), 0)
+        self.assertEqual(CampaignTally.query.filter_by(campaign_id=self.campaignid).count(), 0)
+        self.assertEqual(self.results(), before)
+        self.assertEqual(self.client.get('/campaigns/%s' % self.campaignid).data.count('vegetarian'),
+                         page.count('vegetarian'))
+        self.assertEqual(self.client.get('/campaigns/%s.csv' % self.campaignid).data, before[2])
+
+    def test_archived_rows(self):
+        answers = [(answer.id, answer.worker, answer.term_id, answer.option_id)
+                   for answer in CampaignAnswer.query.order_by(CampaignAnswer.id)]
+        tallies = sorted((tally.term_id, tally.option_id, tally.votes) for tally in CampaignTally.query)
+        excluded = answers[0][0]
+        CampaignAnswer.query.filter_by(id=excluded).update({'excluded': True})
+        db.session.commit()
+
+        self.archive()
+        self.assertEqual(archive.read_answers(self.campaignid, include_excluded=True), answers)
+        self.assertEqual(archive.read_answers(self.campaignid), answers[1:])
+        self.assertEqual(sorted(archive.read_tallies(self.campaignid)), tallies)
+        termid = tallies[0][0]
+        self.assertEqual(archive.read_tallies(self.campaignid, [termid]),
+                         [tally for tally in tallies if tally[0] == termid])
+        self.assertEqual(archive.read_tallies(self.campaignid, first=termid + 1),
+                         [tally for tally in tallies if tally[0] > termid])
+
+    def test_only_finished_campaigns_are_archived(self):
+        db.session.add(CampaignPage(self.campaignid, 0, 'HIT1'))
+        db.session.commit()
+        self.assertFalse(self.archive())
+        self.assertFalse(os.path.exists(archive.archive_path(self.campaignid)))
+
+        # Its HIT has come back, but its assignments haven't been reviewed
+        CampaignPage.query.update({'completed': True})
+        db.session.commit()
+        self.assertFalse(self.archive())
+
+        set_hit_status(['HIT1'], 'disposed')
+        db.session.commit()
+        self.assertTrue(self.archive())
+        self.assertFalse(self.archive())
+
+    def test_archive_job(self):
+        if os.path.exists(jobs.QUEUE_PATH):
+            os.remove(jobs.QUEUE_PATH)
+        response = self.client.post('/campaigns/%s/archive' % self.campaignid)
+        self.assertEqual(response.status_code, 302)
+        jobs.run_job(jobs.claim())
+        self.assertEqual(jobs.latest_job(campaign_id=self.campaignid).status, jobs.DONE)
+        self.assertTrue(self.campaign().archived is not None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+Tests for syncing results across campaigns a page at a time (results.json
+with its cursor and watermark).
+"""
+import json
+import unittest
+
+import support
+
+from models import Campaign
+
+class BatchResultsTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+        self.client = support.app.test_client()
+        first = support.make_campaign(terms=('apple', 'beef', 'carrot'), threshold=60)
+        support.answer_campaign(first, {'apple': ['yes', 'yes'], 'beef': ['no', 'no'], 'carrot': ['yes', 'no']})
+        support.make_campaign(terms=('dates',))
+        third = support.make_campaign(terms=('eggs', 'figs'), threshold=60)
+        support.answer_campaign(third, {'eggs': ['yes', 'yes'], 'figs': ['no', 'no']}, hitid='HIT2')
+        self.campaignids = [first.id, third.id]
+
+    def get(self, **args):
+        response = self.client.get('/results.json', query_string=args)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def sync(self, before=None, **args):
+        """
+        Every page's [(campaign id, term, decided)], and the watermark.
+        """
+        pages = []
+        data = self.get(**args)
+        watermark = data['watermark']
+        while True:
+            if before is not None and len(pages) == 1:
+                before()
+            pages.append([(result['campaign_id'], result['term'], result['decided'])
+                          for result in data['results']])
+            self.assertEqual(data['watermark'], watermark)
+            if data['next'] is None:
+                return pages, watermark
+            self.assertEqual(data['next'].split('-')[0], str(watermark))
+            data = self.get(cursor=data['next'], **args)
+
+    def answer(self, campaignid, votes, hitid):
+        support.answer_campaign(Campaign.query.get(campaignid), votes, hitid=hitid)
+
+    def test_pages_of_decided_terms(self):
+        first, third = self.campaignids
+        decided = [(first, 'apple', True), (first, 'beef', True), (third, 'eggs', True), (third, 'figs', True)]
+        pages, watermark = self.sync(limit=1)
+        self.assertEqual(pages, [[result] for result in decided])
+        pages, watermark = self.sync(limit=3)
+        self.assertEqual(pages, [decided[:3], decided[3:]])
+        pages, watermark = self.sync()
+        self.assertEqual(pages, [decided])
+        self.assertEqual(self.sync(campaigns='%s' % third)[0], [decided[2:]])
+        self.assertEqual(self.sync(updated_since='2000-01-01', limit=2)[0], [decided[:2], decided[2:]])
+        self.assertEqual(self.sync(updated_since='2100-01-01')[0], [[]])
+
+    def test_changes_since_the_watermark(self):
+        first, third = self.campaignids
+        pages, watermark = self.sync(limit=2)
+        self.assertEqual(self.sync(since=watermark)[0], [[]])
+        # Since a watermark, terms that aren't decided are sent as well
+        self.assertTrue((first, 'carrot', False) in sum(self.sync(since=0)[0], []))
+
+        # carrot is decided, and beef's answer changes
+        self.answer(first, {'carrot': ['yes', 'yes'], 'beef': ['yes', 'yes', 'yes']}, 'HIT3')
+        pages, later = self.sync(since=watermark, limit=1)
+        self.assertEqual(pages, [[(first, 'beef', True)], [(first, 'carrot', True)]])
+        self.assertEqual(self.get(since=watermark)['results'][0]['answer'], 'yes')
+        self.assertTrue(later > watermark)
+        self.assertEqual(self.sync(since=later)[0], [[]])
+
+    def test_changes_while_paging_are_caught_next_time(self):
+        first, third = self.campaignids
+        pages, watermark = self.sync(before=lambda: self.answer(first, {'carrot': ['yes', 'yes']}, 'HIT3'),
+                                     limit=1)
+        # The first page was read before carrot was decided
+        self.assertFalse((first, 'carrot', True) in sum(pages, []))
+        self.assertEqual(self.sync(since=watermark)[0], [[(first, 'carrot', True)]])
+
+    def test_bad_arguments(self):
+        for args in ({'cursor': 'x'}, {'cursor': '1-2'}, {'since': 'x'}, 
+                     {'campaigns': '1,x'}, {'updated_since': 'yesterday'}):
+            self.assertEqual(self.client.get('/results.json', query_string=args).status_code, 400)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+"""
+Tests for the response cache and the conditional responses of the 
+campaign page and downloads.
+"""
+import time
+import unittest
+
+import support
+
+from models import db, Campaign
+import cache
+
+class LRUCacheTest(unittest.TestCase):
+    def test_get_and_set(self):
+        responses = cache.LRUCache(max_bytes=100, max_entry_bytes=50)
+        responses.set(1, 'csv', 'v1', 'x' * 10)
+        self.assertEqual(responses.get(1, 'csv', 'v1'), 'x' * 10)
+        self.assertEqual(responses.get(1, 'csv', 'v2'), None)
+        # A stale entry is dropped once it's been asked for under a new ETag
+        self.assertEqual(responses.get(1, 'csv', 'v1'), None)
+        self.assertEqual(responses.stats(), {'entries': 0, 'bytes': 0, 'hits': 1, 'misses': 2})
+
+    def test_least_recently_used_go_first(self):
+        responses = cache.LRUCache(max_bytes=100, max_entry_bytes=50)
+        responses.set(1, 'csv', 'v1', 'a' * 40)
+        responses.set(2, 'csv', 'v1', 'b' * 40)
+        responses.get(1, 'csv', 'v1')
+        responses.set(3, 'csv', 'v1', 'c' * 40)
+        self.assertEqual(responses.get(2, 'csv', 'v1'), None)
+        self.assertEqual(responses.get(1, 'csv', 'v1'), 'a' * 40)
+        responses.set(4, 'csv', 'v1', 'd' * 51)
+        self.assertEqual(responses.get(4, 'csv', 'v1'), None)
+
+    def test_get_or_build_and_invalidate(self):
+        responses = cache.LRUCache()
+        built = []
+        def build():
+            built.append(1)
+            return "body"
+        self.assertEqual(responses.get_or_build(1, 'details', 'v1', build), "body")
+        self.assertEqual(responses.get_or_build(1, 'details', 'v1', build), "body")
+        self.assertEqual(len(built), 1)
+        responses.invalidate(1)
+        responses.get_or_build(1, 'details', 'v1', build)
+        self.assertEqual(len(built), 2)
+
+    def test_tee_keeps_only_whole_bodies(self):
+        responses = cache.LRUCache(max_entry_bytes=5)
+        self.assertEqual("".join(responses.tee(1, 'csv', 'v1', iter(["ab", "cd"]))), "abcd")
+        self.assertEqual(responses.get(1, 'csv', 'v1'), "abcd")
+        stream = responses.tee(1, 'json', 'v1', iter(["ab", "cd"]))
+        stream.next()
+        stream.close()
+        self.assertEqual(responses.get(1, 'json', 'v1'), None)
+        "".join(responses.tee(1, 'ndjson', 'v1', iter(["abc", "def"])))
+        self.assertEqual(responses.get(1, 'ndjson', 'v1'), None)
+
+class ConditionalResponseTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+        self.campaign = support.make_campaign()
+        # Results are only shown once the jobs have been generated
+        self.campaign.job_generated = True
+        db.session.commit()
+        self.client = support.app.test_client()
+
+    def answer(self, hitid, option):
+        campaign = Campaign.query.get(self.campaign.id)
+        support.answer_campaign(campaign, {'apple': [option]}, hitid=hitid)
+
+    def test_campaign_page(self):
+        url = '/campaigns/%s' % self.campaign.id
+        first = self.client.get(url)
+        etag = first.headers['ETag']
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+
+        again = self.client.get(url)
+        self.assertEqual((again.headers['ETag'], again.data), (etag, first.data))
+        self.assertEqual(cache.responses.stats()['hits'], 1)
+
+        # Answers are stored by the job worker, which can't reach this cache;
+        # the new results version in the ETag is what keeps the page fresh
+        self.answer('HIT1', 'yes')
+        changed = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers['ETag'], etag)
+        self.assertNotEqual(changed.data, first.data)
+
+    def test_pages_with_flashed_messages_are_not_cached(self):
+        url = '/campaigns/%s' % self.campaign.id
+        with self.client.session_transaction() as session:
+            session['_flashes'] = [('message', 'Hello')]
+        response = self.client.get(url)
+        self.assertTrue('Hello' in response.data)
+        self.assertFalse('ETag' in response.headers)
+        self.assertFalse('Hello' in self.client.get(url).data)
+
+    def test_download(self):
+        url = '/campaigns/%s.csv' % self.campaign.id
+        first = self.client.get(url)
+        body = first.data
+        etag, last_modified = first.headers['ETag'], first.headers['Last-Modified']
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(self.client.get(url, headers={'If-Modified-Since': last_modified}).status_code, 304)
+        self.assertEqual(self.client.get(url).data, body)
+        self.assertEqual(cache.responses.stats()['hits'], 1)
+
+        # A different format has its own ETag
+        self.assertNotEqual(self.client.get(url + '.gz').headers['ETag'], etag)
+
+        time.sleep(1)
+        self.answer('HIT1', 'yes')
+        changed = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertTrue('apple,,1,0' in changed.data)
+        self.assertEqual(self.client.get(url, headers={'If-Modified-Since': last_modified}).status_code, 200)
+
+if __name__ == '__main__':
+    unittest.main()
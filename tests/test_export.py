@@ -0,0 +1,88 @@
+"""
+Tests for the streaming result exports in export.py.
+"""
+from cStringIO import StringIO
+
+import csv
+import gzip
+import json
+import unittest
+
+import support
+
+from models import Campaign
+import export
+
+VOTES = {u'caf\xe9': ['yes', 'yes', 'yes', 'no'],
+         'salt, "sea"': ['yes', 'yes', 'no', 'maybe'],
+         'beef': ['no', 'no', 'no', 'no']}
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+        campaign = support.make_campaign(terms=sorted(VOTES), options=('yes', 'no', 'maybe'),
+                                         times_per_term=4, threshold=50)
+        support.answer_campaign(campaign, VOTES)
+        self.campaignid = campaign.id
+
+    def export(self, filetype):
+        stream, mimetype = export.export_results(Campaign.query.get(self.campaignid), filetype)
+        return "".join(stream), mimetype
+
+    def test_csv(self):
+        data, mimetype = self.export('csv')
+        self.assertEqual(mimetype, 'text/csv')
+        self.assertTrue('"salt, ""sea"""' in data)
+        self.assertEqual(list(csv.reader(StringIO(data))),
+                         [['term', 'answer', 'yes', 'no', 'maybe'],
+                          ['beef', 'no', '0', '4', '0'],
+                          ['caf\xc3\xa9', 'yes', '3', '1', '0'],
+                          ['salt, "sea"', '', '2', '1', '1']])
+
+    def test_answers_agree_with_the_campaign_page(self):
+        # salt is at exactly the threshold, which doesn't pass it
+        page = dict((result.term, "" if result.is_inconclusive() else result.answer.option_text)
+                    for result in Campaign.query.get(self.campaignid).get_results())
+        self.assertEqual(page['salt, "sea"'], "")
+        data, _ = self.export('ndjson')
+        self.assertEqual(dict((term, answer) for term, answer, votes in map(json.loads, data.splitlines())),
+                         page)
+
+    def test_json_and_ndjson(self):
+        data, mimetype = self.export('json')
+        self.assertEqual(mimetype, 'text/json')
+        results = json.loads(data)
+        self.assertEqual(results[0], ['beef', 'no', {'yes': 0, 'no': 4, 'maybe': 0}])
+
+        data, mimetype = self.export('ndjson')
+        self.assertEqual(mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in data.splitlines()], results)
+
+    def test_chunks_join_up(self):
+        whole = [self.export(filetype)[0] for filetype in ('csv', 'json', 'ndjson')]
+        chunk_size, export.CHUNK_SIZE = export.CHUNK_SIZE, 1
+        try:
+            self.assertEqual([self.export(filetype)[0] for filetype in ('csv', 'json', 'ndjson')], whole)
+        finally:
+            export.CHUNK_SIZE = chunk_size
+
+    def test_gzip(self):
+        for filetype in ('csv', 'json', 'ndjson'):
+            data, mimetype = self.export(filetype + '.gz')
+            self.assertEqual(mimetype, 'application/x-gzip')
+            self.assertEqual(gzip.GzipFile(fileobj=StringIO(data)).read(), self.export(filetype)[0])
+
+    def test_unsupported_filetypes(self):
+        campaign = Campaign.query.get(self.campaignid)
+        for filetype in ('xml', 'xml.gz', 'gz'):
+            self.assertEqual(export.export_results(campaign, filetype), None)
+            self.assertEqual(export.export_mimetype(filetype), None)
+
+    def test_download(self):
+        response = support.app.test_client().get('/campaigns/%s.csv.gz' % self.campaignid)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'application/x-gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(response.data)).read(), self.export('csv')[0])
+
+if __name__ == '__main__':
+    unittest.main()
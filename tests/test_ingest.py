@@ -0,0 +1,143 @@
+"""
+Tests for storing fetched answers and their sync state in ingest.py, and
+for fetching them in mturk.py: every step can be repeated after an 
+interrupted fetch without storing, counting or reviewing anything twice.
+"""
+import unittest
+
+import support
+
+from models import db, AssignmentSync, Campaign, CampaignAnswer, CampaignPage, HitSync
+from simulator import MTurkSimulator
+import ingest
+import mturk
+
+class IngestTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+        self.campaign = support.make_campaign()
+        self.page = [('HIT1', [support.make_assignment('A1', 'W1', self.campaign, {'apple': 'yes', 'beef': 'no'}),
+                               support.make_assignment('A2', 'W2', self.campaign, {'apple': 'yes', 'beef': 'yes'})]),
+                     ('HIT2', [support.make_assignment('A3', 'W1', self.campaign, {'carrot': 'yes'})])]
+
+    def tallies(self):
+        db.session.expire_all()
+        return sorted(Campaign.query.get(self.campaign.id).get_tallies())
+
+    def sync_state(self):
+        return (sorted((row.hit_id, row.status) for row in HitSync.query),
+                sorted((row.assignment_id, row.status) for row in AssignmentSync.query))
+
+    def test_store_answers(self):
+        self.assertEqual(ingest.store_answers(self.page), 5)
+        terms = dict((term.term, term.id) for term in self.campaign.terms)
+        yes, no = [option.id for option in self.campaign.options]
+        self.assertEqual(self.tallies(), [(terms['apple'], yes, 2), (terms['beef'], yes, 1),
+                                          (terms['beef'], no, 1), (terms['carrot'], yes, 1)])
+        self.assertEqual(sorted((answer.hit, answer.worker, answer.term_id, answer.option_id)
+                                for answer in CampaignAnswer.query),
+                         sorted([('HIT1', 'W1', terms['apple'], yes), ('HIT1', 'W1', terms['beef'], no),
+                                 ('HIT1', 'W2', terms['apple'], yes), ('HIT1', 'W2', terms['beef'], yes),
+                                 ('HIT2', 'W1', terms['carrot'], yes)]))
+
+    def test_storing_a_page_twice(self):
+        self.assertEqual(ingest.store_answers(self.page), 5)
+        tallies, state = self.tallies(), self.sync_state()
+        self.assertEqual(ingest.store_answers(self.page), 0)
+        self.assertEqual(CampaignAnswer.query.count(), 5)
+        self.assertEqual(Campaign.query.get(self.campaign.id).answer_count, 5)
+        self.assertEqual(self.tallies(), tallies)
+        self.assertEqual(self.sync_state(), state)
+
+    def test_partly_stored_page(self):
+        ingest.store_answers(self.page[:1])
+        self.assertEqual(ingest.store_answers(self.page), 1)
+        self.assertEqual(Campaign.query.get(self.campaign.id).answer_count, 5)
+        self.assertEqual(sum(votes for _, _, votes in self.tallies()), 5)
+
+    def test_record_sync(self):
+        ingest.store_answers(self.page)
+        self.assertEqual(self.sync_state(),
+                         ([('HIT1', 'stored'), ('HIT2', 'stored')],
+                          [('A1', 'stored'), ('A2', 'stored'), ('A3', 'stored')]))
+        self.assertEqual(ingest.stored_assignments(['HIT1', 'HIT2']), set(['A1', 'A2', 'A3']))
+
+        ingest.record_sync(self.page)
+        db.session.commit()
+        self.assertEqual(AssignmentSync.query.count(), 3)
+        self.assertEqual(HitSync.query.count(), 2)
+
+    def test_assignments_already_reviewed_on_mechanical_turk(self):
+        page = [('HIT3', [support.make_assignment('A4', 'W3', self.campaign, {'apple': 'no'}, status='Approved')])]
+        ingest.store_answers(page)
+        self.assertEqual(self.sync_state(), ([('HIT3', 'approved')], [('A4', 'approved')]))
+        self.assertEqual(ingest.pending_approvals(['HIT3']), [])
+
+    def test_new_assignment_on_a_reviewed_hit(self):
+        ingest.store_answers(self.page[1:])
+        ingest.record_reviews([('HIT2', 'A3', 'approved', None)])
+        page = [('HIT2', [support.make_assignment('A5', 'W2', self.campaign, {'carrot': 'no'})])]
+        ingest.store_answers(page)
+        self.assertEqual(ingest.hit_states(['HIT2']), {'HIT2': 'stored'})
+        self.assertEqual(ingest.pending_approvals(['HIT2']), [('HIT2', 'A5')])
+
+    def test_recording_reviews_twice(self):
+        ingest.store_answers(self.page)
+        reviews = [('HIT1', 'A1', 'approved', None),
+                   ('HIT1', 'A2', 'rejected', None),
+                   ('HIT2', 'A3', 'approved', RuntimeError("throttled"))]
+        self.assertEqual(ingest.record_reviews(reviews), ['HIT1'])
+        state = self.sync_state()
+        self.assertEqual(state, ([('HIT1', 'approved'), ('HIT2', 'stored')],
+                                 [('A1', 'approved'), ('A2', 'rejected'), ('A3', 'stored')]))
+        self.assertEqual(ingest.pending_approvals(['HIT1', 'HIT2']), [('HIT2', 'A3')])
+
+        self.assertEqual(ingest.record_reviews(reviews), ['HIT1'])
+        self.assertEqual(self.sync_state(), state)
+        self.assertEqual(AssignmentSync.query.get('A3').error, "throttled")
+
+        self.assertEqual(ingest.record_reviews([('HIT2', 'A3', 'approved', None)]), ['HIT2'])
+        self.assertEqual(ingest.pending_approvals(['HIT1', 'HIT2']), [])
+
+class FetchTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+        self.dispose = mturk.DISPOSE_HITS
+        self.simulator = MTurkSimulator(workers=5, latency=0)
+        self.campaignid = support.make_campaign(terms=['term %s' % num for num in range(25)]).id
+        mturk.create_campaign_hits(self.campaignid, connection_factory=self.simulator)
+
+    def tearDown(self):
+        mturk.DISPOSE_HITS = self.dispose
+
+    def fetch(self):
+        return mturk.retrieve_reviewable_hits(connection_factory=self.simulator)
+
+    def hit_states(self):
+        return sorted(set(status for status, in db.session.query(HitSync.status)))
+
+    def test_fetch(self):
+        mturk.DISPOSE_HITS = True
+        self.assertTrue(self.fetch())
+        self.assertEqual(CampaignAnswer.query.count(), 75)
+        self.assertEqual(self.hit_states(), ['disposed'])
+        self.assertEqual(CampaignPage.query.filter_by(completed=False).count(), 0)
+        self.assertEqual(self.simulator.calls['approve_assignment'], 9)
+        self.assertFalse(self.fetch())
+
+    def test_hits_marked_as_reviewing(self):
+        mturk.DISPOSE_HITS = False
+        self.fetch()
+        self.assertEqual(self.hit_states(), ['reviewing'])
+        self.assertEqual(self.simulator.calls['get_assignments'], 3)
+
+        # Reviewing HITs that are reviewable again are fetched again, in
+        # case they have new assignments, but nothing is stored twice
+        self.simulator.reviewable.extend(sorted(self.simulator.hits))
+        self.assertFalse(self.fetch())
+        self.assertEqual(self.simulator.calls['get_assignments'], 6)
+        self.assertEqual(self.simulator.calls['approve_assignment'], 9)
+        self.assertEqual(CampaignAnswer.query.count(), 75)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+Tests for the background job queue in jobs.py.
+"""
+import os
+import time
+import unittest
+
+import support
+
+import jobs
+
+class QueueTest(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(jobs.QUEUE_PATH):
+            os.remove(jobs.QUEUE_PATH)
+
+    def set_running_since(self, jobid, seconds_ago):
+        conn = jobs.connect()
+        try:
+            then = time.time() - seconds_ago
+            conn.execute("UPDATE job SET status = ?, started = ?, heartbeat = ? WHERE id = ?",
+                         (jobs.RUNNING, then, then, jobid))
+        finally:
+            conn.close()
+
+    def test_enqueue_skips_a_task_already_waiting(self):
+        first = jobs.enqueue('generate_hits', 1)
+        self.assertEqual(jobs.enqueue('generate_hits', 1), first)
+        self.assertNotEqual(jobs.enqueue('generate_hits', 2), first)
+        self.assertNotEqual(jobs.enqueue('fetch_results'), first)
+        self.assertEqual(jobs.enqueue('fetch_results'), jobs.latest_job('fetch_results').id)
+
+    def test_claim_takes_the_oldest_queued_job(self):
+        self.assertEqual(jobs.claim(), None)
+        first = jobs.enqueue('generate_hits', 1)
+        second = jobs.enqueue('generate_hits', 2)
+
+        job = jobs.claim()
+        self.assertEqual((job.id, job.status), (first, jobs.RUNNING))
+        self.assertTrue(job.active)
+        self.assertEqual(jobs.claim().id, second)
+        self.assertEqual(jobs.claim(), None)
+
+    def test_enqueue_skips_a_task_already_running(self):
+        jobid = jobs.enqueue('generate_hits', 1)
+        jobs.claim()
+        self.assertEqual(jobs.enqueue('generate_hits', 1), jobid)
+
+        jobs.finish(jobid)
+        self.assertEqual(jobs.get_job(jobid).status, jobs.DONE)
+        self.assertNotEqual(jobs.enqueue('generate_hits', 1), jobid)
+
+    def test_failed_job(self):
+        jobid = jobs.enqueue('generate_hits', 1)
+        jobs.claim()
+        jobs.finish(jobid, "Traceback")
+        job = jobs.get_job(jobid)
+        self.assertEqual((job.status, job.error, job.active), (jobs.FAILED, "Traceback", False))
+
+    def test_stale_running_job_is_failed_and_queued_again(self):
+        jobid = jobs.enqueue('generate_hits', 1)
+        jobs.claim()
+        self.set_running_since(jobid, jobs.JOB_TIMEOUT + 1)
+
+        requeued = jobs.enqueue('generate_hits', 1)
+        self.assertNotEqual(requeued, jobid)
+        self.assertEqual(jobs.get_job(jobid).status, jobs.FAILED)
+        self.assertEqual(jobs.claim().id, requeued)
+
+    def test_expired_job_finishing_late_stays_failed(self):
+        jobid = jobs.enqueue('generate_hits', 1)
+        jobs.claim()
+        self.set_running_since(jobid, jobs.JOB_TIMEOUT + 1)
+        jobs.claim()
+        error = jobs.get_job(jobid).error
+
+        jobs.finish(jobid)
+        job = jobs.get_job(jobid)
+        self.assertEqual((job.status, job.error), (jobs.FAILED, error))
+        jobs.finish(jobid, "Traceback")
+        self.assertEqual(jobs.get_job(jobid).error, error)
+
+    def test_heartbeat_keeps_a_running_job(self):
+        jobid = jobs.enqueue('generate_hits', 1)
+        jobs.claim()
+        self.set_running_since(jobid, jobs.JOB_TIMEOUT + 1)
+        jobs.beat(jobid)
+        self.assertEqual(jobs.enqueue('generate_hits', 1), jobid)
+        self.assertEqual(jobs.get_job(jobid).status, jobs.RUNNING)
+
+    def test_progress_counts_as_a_heartbeat(self):
+        jobid = jobs.enqueue('generate_hits', 1)
+        jobs.claim()
+        self.set_running_since(jobid, jobs.JOB_TIMEOUT + 1)
+        jobs.update_progress(jobid, "1 of 2 pages published")
+        self.assertEqual(jobs.claim(), None)
+        self.assertEqual(jobs.get_job(jobid).status, jobs.RUNNING)
+
+if __name__ == '__main__':
+    unittest.main()
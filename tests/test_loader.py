@@ -0,0 +1,91 @@
+"""
+Tests for loading campaign options and terms in bulk (loader.py), from the
+command line, the new and clone forms and the add terms endpoint.
+"""
+from cStringIO import StringIO
+
+import unittest
+
+import support
+
+from models import db, Campaign, CampaignOption, CampaignTerm
+import loader
+
+FORM = {'title': 'upload', 'question': 'Is [term] vegetarian?', 'options': 'yes\nno',
+        'terms_per_quiz': '10', 'reward': '0.05', 'times_per_term': '3', 'aggregation': 'majority'}
+
+def terms(campaignid):
+    return [term for term, in db.session.query(CampaignTerm.term)
+                                        .filter(CampaignTerm.campaign_id == campaignid)
+                                        .order_by(CampaignTerm.id)]
+
+class LoaderTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+        self.batch_size = loader.BATCH_SIZE
+
+    def tearDown(self):
+        loader.BATCH_SIZE = self.batch_size
+
+    def test_iter_lines(self):
+        expected = [u'apple', u'caf\xe9', u'carrot']
+        self.assertEqual(list(loader.iter_lines("apple\r\n\n  caf\xc3\xa9 \rcarrot\n")), expected)
+        self.assertEqual(list(loader.iter_lines(u"apple\ncaf\xe9\ncarrot")), expected)
+        self.assertEqual(list(loader.iter_lines(StringIO("apple\n\ncaf\xc3\xa9\ncarrot"))), expected)
+        self.assertEqual(list(loader.iter_lines(["apple\n", "\n", u"caf\xe9\n", "carrot"])), expected)
+
+    def test_create_campaign_in_batches(self):
+        loader.BATCH_SIZE = 2
+        campaign = support.make_campaign(terms=('apple', 'beef', 'apple', 'carrot', 'dates', 'beef'))
+        self.assertEqual(terms(campaign.id), ['apple', 'beef', 'carrot', 'dates'])
+        self.assertEqual([option.option_text for option in campaign.options], ['yes', 'no'])
+        self.assertEqual(CampaignTerm.query.filter(CampaignTerm.fingerprint == None).count(), 0)
+
+    def test_add_terms(self):
+        campaign = support.make_campaign(terms=('apple', 'beef'))
+        client = support.app.test_client()
+        response = client.post('/campaigns/%s/terms' % campaign.id, data="beef\ncarrot\ncarrot\n",
+                               content_type='text/plain')
+        self.assertEqual(response.data, "Added 1 terms.\n")
+        self.assertEqual(terms(campaign.id), ['apple', 'beef', 'carrot'])
+
+        Campaign.query.get(campaign.id).job_generated = True
+        db.session.commit()
+        response = client.post('/campaigns/%s/terms' % campaign.id, data="dates\n",
+                               content_type='text/plain')
+        self.assertEqual(response.status_code, 409)
+
+    def post_form(self, url, **fields):
+        data = dict(FORM)
+        data.update(fields)
+        return support.app.test_client().post(url, data=data)
+
+    def test_new_campaign_from_an_uploaded_file(self):
+        response = self.post_form('/campaigns/new', terms='',
+                                  terms_file=(StringIO("apple\nbeef\n\ncarrot\n"), 'terms.txt'))
+        self.assertEqual(response.status_code, 302)
+        campaign = Campaign.query.filter_by(title='upload').one()
+        self.assertEqual(terms(campaign.id), ['apple', 'beef', 'carrot'])
+
+    def test_clone_campaign_from_an_uploaded_file(self):
+        original = support.make_campaign()
+        response = support.app.test_client().get('/campaigns/%s/clone' % original.id)
+        self.assertTrue('value="Is [term] vegetarian?"' in response.data)
+        response = self.post_form('/campaigns/%s/clone' % original.id, terms='',
+                                  terms_file=(StringIO("dates\neggs\n"), 'terms.txt'))
+        self.assertEqual(response.status_code, 302)
+        campaign = Campaign.query.filter_by(title='upload').one()
+        self.assertEqual(terms(campaign.id), ['dates', 'eggs'])
+
+    def test_new_campaign_needs_some_terms(self):
+        response = self.post_form('/campaigns/new', terms='  ')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('Enter some terms or upload a file of terms' in response.data)
+        self.assertEqual(Campaign.query.count(), 0)
+
+        response = self.post_form('/campaigns/new', title='', terms_file=(StringIO("apple\n"), 'terms.txt'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Campaign.query.count(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+Tests for the schema migrations: a database created by the first release,
+before any migration, is brought up to date with its answers counted.
+"""
+from cStringIO import StringIO
+
+import sys
+import unittest
+
+import support
+
+from models import db, Campaign, CampaignAnswer, CampaignTally, CampaignTerm
+import migrations
+
+# The tables as the first release created them
+FIRST_SCHEMA = [
+    """CREATE TABLE campaign (
+           id INTEGER NOT NULL PRIMARY KEY,
+           title VARCHAR(80),
+           question VARCHAR(500),
+           reward_per_quiz NUMERIC,
+           terms_per_quiz INTEGER,
+           times_per_term INTEGER,
+           job_generated BOOLEAN,
+           created_date DATETIME)""",
+    """CREATE TABLE action_log (
+           id INTEGER NOT NULL PRIMARY KEY,
+           log_time DATETIME,
+           log_source VARCHAR(100),
+           log_message VARCHAR(2000))""",
+    """CREATE TABLE campaign_option (
+           id INTEGER NOT NULL PRIMARY KEY,
+           option_text VARCHAR(500),
+           campaign_id INTEGER REFERENCES campaign (id))""",
+    """CREATE TABLE campaign_term (
+           id INTEGER NOT NULL PRIMARY KEY,
+           term VARCHAR(100),
+           campaign_id INTEGER REFERENCES campaign (id))""",
+    """CREATE TABLE campaign_answer (
+           id INTEGER NOT NULL PRIMARY KEY,
+           hit VARCHAR(50),
+           worker VARCHAR(50),
+           campaign_id INTEGER REFERENCES campaign (id),
+           term_id INTEGER REFERENCES campaign_term (id),
+           option_id INTEGER REFERENCES campaign_option (id))""",
+]
+
+FIRST_DATA = [
+    "INSERT INTO campaign VALUES (1, 'old', 'Is [term] vegetarian?', 0.05, 2, 2, 1, '2011-11-01 00:00:00')",
+    "INSERT INTO campaign_option VALUES (1, 'yes', 1)",
+    "INSERT INTO campaign_option VALUES (2, 'no', 1)",
+    "INSERT INTO campaign_term VALUES (1, 'carrot', 1)",
+    "INSERT INTO campaign_term VALUES (2, 'beef', 1)",
+    "INSERT INTO campaign_answer VALUES (1, 'H1', 'w1', 1, 1, 1)",
+    "INSERT INTO campaign_answer VALUES (2, 'H1', 'w2', 1, 1, 1)",
+    "INSERT INTO campaign_answer VALUES (3, 'H1', 'w1', 1, 2, 2)",
+    "INSERT INTO campaign_answer VALUES (4, 'H1', 'w2', 1, 2, 1)",
+]
+
+def upgrade():
+    """
+    migrations.upgrade(), without its progress output.
+    """
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        return migrations.upgrade()
+    finally:
+        sys.stdout = stdout
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        support.drop_tables()
+        for statement in FIRST_SCHEMA + FIRST_DATA:
+            db.engine.execute(statement)
+
+    def tearDown(self):
+        support.reset_database()
+
+    def state(self):
+        db.session.remove()
+        campaign = Campaign.query.get(1)
+        return (campaign.answer_count,
+                sorted((tally.term_id, tally.option_id, tally.votes) for tally in CampaignTally.query),
+                sorted((term.id, term.decided, term.answer_option_id) for term in CampaignTerm.query),
+                [answer.excluded for answer in CampaignAnswer.query.order_by(CampaignAnswer.id)])
+
+    def test_upgrade_from_the_first_release(self):
+        latest = migrations.latest_version()
+        self.assertEqual(upgrade(), latest)
+        self.assertEqual(migrations.get_version(), latest)
+        self.assertEqual(self.state(),
+                         (4, [(1, 1, 2), (2, 1, 1), (2, 2, 1)],
+                          [(1, True, 1), (2, False, None)],
+                          [False] * 4))
+        indexes = migrations.index_names('campaign_term')
+        for index in CampaignTerm.__table__.indexes:
+            self.assertTrue(index.name in indexes, index.name)
+
+    def test_upgrade_twice(self):
+        upgrade()
+        state = self.state()
+        self.assertEqual(upgrade(), migrations.latest_version())
+        self.assertEqual(self.state(), state)
+
+    def test_new_database_is_already_up_to_date(self):
+        support.reset_database()
+        self.assertEqual(upgrade(), migrations.latest_version())
+        self.assertEqual(Campaign.query.count(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""
+Tests for publishing campaign HITs in mturk.py, against the simulator.
+"""
+from boto.exception import BotoServerError
+from datetime import datetime, timedelta
+
+import socket
+import unittest
+
+import support
+
+from models import db, Campaign, CampaignPage
+from simulator import MTurkSimulator, Record, TIME_FORMAT
+import mturk
+
+def error(status, code=None):
+    body = None
+    if code is not None:
+        body = "<Response><Errors><Error><Code>%s</Code><Message>...</Message></Error></Errors></Response>" % code
+    return BotoServerError(status, "Reason", body)
+
+class RetryTest(unittest.TestCase):
+    def test_throttled(self):
+        self.assertTrue(mturk.throttled(error(503)))
+        self.assertTrue(mturk.throttled(error(200, 'AWS.ServiceUnavailable')))
+        self.assertTrue(mturk.throttled(error(400, 'Throttling')))
+        self.assertFalse(mturk.throttled(error(200, 'AWS.BadParameters')))
+        self.assertFalse(mturk.throttled(error(400, 'AWS.MechanicalTurk.InsufficientFunds')))
+        self.assertFalse(mturk.throttled(error(500)))
+        self.assertFalse(mturk.throttled(socket.timeout()))
+
+    def test_only_throttled_calls_are_retried(self):
+        for failure, calls in ((error(503), 3), (error(200, 'AWS.BadParameters'), 1)):
+            made = []
+            def call():
+                made.append(1)
+                raise failure
+            self.assertRaises(BotoServerError, mturk.call_with_retry, call, retries=2, backoff=0,
+                              retry_if=mturk.throttled)
+            self.assertEqual(len(made), calls)
+
+class PublishTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+        self.campaign = support.make_campaign(terms=['term %s' % num for num in range(25)])
+        self.simulator = MTurkSimulator(workers=5, latency=0)
+
+    def publish(self):
+        return mturk.create_campaign_hits(self.campaign.id, connection_factory=self.simulator, workers=2)
+
+    def pages(self):
+        return sorted((page.page_number, page.hit_id) for page in CampaignPage.query)
+
+    def add_hit(self, annotation, created):
+        hitid = "OLDHIT%08d" % len(self.simulator.hits)
+        self.simulator.hits[hitid] = Record(HITId=hitid, RequesterAnnotation=annotation,
+                                            CreationTime=created.strftime(TIME_FORMAT))
+        return hitid
+
+    def test_publish(self):
+        self.assertEqual(self.publish(), 0)
+        self.assertEqual([pagenum for pagenum, hitid in self.pages()], [0, 1, 2])
+        self.assertEqual(self.simulator.calls['create_hit'], 3)
+        campaign = Campaign.query.get(self.campaign.id)
+        self.assertTrue(campaign.job_generated)
+
+        self.assertEqual(self.publish(), 0)
+        self.assertEqual(self.simulator.calls['create_hit'], 3)
+
+    def test_unrecorded_hit_is_recorded_instead_of_published_again(self):
+        self.publish()
+        lost = CampaignPage.query.filter_by(page_number=1).one()
+        hitid = lost.hit_id
+        db.session.delete(lost)
+        Campaign.query.get(self.campaign.id).job_generated = False
+        db.session.commit()
+
+        self.assertEqual(self.publish(), 0)
+        self.assertEqual(self.simulator.calls['create_hit'], 3)
+        self.assertEqual(dict(self.pages())[1], hitid)
+
+    def test_hits_created_before_a_timeout_are_not_created_again(self):
+        simulator = self.simulator
+        class TimesOut(object):
+            def __getattr__(self, name):
+                return getattr(simulator, name)
+            def create_hit(self, **params):
+                simulator.create_hit(**params)
+                raise socket.timeout("timed out")
+
+        connection = TimesOut()
+        failures = mturk.create_campaign_hits(self.campaign.id, connection_factory=lambda: connection)
+        self.assertEqual(failures, 3)
+        self.assertEqual((len(simulator.hits), len(self.pages())), (3, 0))
+
+        self.assertEqual(self.publish(), 0)
+        self.assertEqual(self.simulator.calls['create_hit'], 3)
+        self.assertEqual(sorted(hitid for pagenum, hitid in self.pages()), sorted(simulator.hits))
+
+    def test_only_hits_created_since_the_campaign_are_searched(self):
+        old = self.campaign.created_date - mturk.CLOCK_SKEW - timedelta(days=1)
+        for num in range(150):
+            self.add_hit(None, old)
+        # Looks like one of the campaign's pages, but is older than the campaign
+        digest = mturk.page_digest(0, self.campaign.times_per_term, [term.id for term in self.campaign.terms[:10]])
+        self.add_hit("%s|0|%s" % (self.campaign.id, digest), old)
+
+        self.publish()
+        self.assertEqual(self.simulator.calls['search_hits'], 1)
+        self.assertEqual(self.simulator.calls['create_hit'], 3)
+        self.assertTrue(all(hitid.startswith("SIMHIT") for pagenum, hitid in self.pages()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+Tests for the worker review policy in quality.py.
+"""
+import unittest
+
+import support
+
+from models import db, CampaignAnswer, WorkerStats
+from ingest import store_answers
+import quality
+
+def answer(option_id, excluded=False):
+    return {'option_id': option_id, 'excluded': excluded}
+
+class CompareTest(unittest.TestCase):
+    def test_agrees_with_the_other_votes(self):
+        self.assertEqual(quality.compare(answer(1), {1: 3, 2: 1}), (1, 1))
+
+    def test_disagrees_with_the_other_votes(self):
+        self.assertEqual(quality.compare(answer(2), {1: 3, 2: 1}), (1, 0))
+
+    def test_own_vote_is_left_out_of_the_consensus(self):
+        # Without its own vote the other workers are split 1-1
+        self.assertEqual(quality.compare(answer(1), {1: 2, 2: 1}), (0, 0))
+
+    def test_excluded_answer_has_no_vote_to_leave_out(self):
+        self.assertEqual(quality.compare(answer(1, excluded=True), {1: 2, 2: 1}), (1, 1))
+
+    def test_no_other_votes(self):
+        self.assertEqual(quality.compare(answer(1), {1: 1}), (0, 0))
+        self.assertEqual(quality.compare(answer(1), {}), (0, 0))
+
+    def test_tied_consensus(self):
+        self.assertEqual(quality.compare(answer(3), {1: 2, 2: 2, 3: 1}), (0, 0))
+
+class JudgeTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+        self.review = quality.WORKER_REVIEW
+        quality.WORKER_REVIEW = True
+
+    def tearDown(self):
+        quality.WORKER_REVIEW = self.review
+
+    def add_worker(self, workerid, compared=0, agreed=0, timed=0, rushed=0, status='ok'):
+        worker = WorkerStats(workerid)
+        worker.status = status
+        worker.answers = worker.compared = compared
+        worker.agreed = agreed
+        worker.timed = timed
+        worker.rushed = rushed
+        db.session.add(worker)
+        db.session.commit()
+
+    def status(self, workerid):
+        db.session.expire_all()
+        return WorkerStats.query.get(workerid).status
+
+    def test_verdicts(self):
+        compared = quality.WORKER_MIN_COMPARED
+        self.add_worker('good', compared, compared)
+        self.add_worker('poor', compared, int(compared * (quality.WORKER_REJECT_AGREEMENT - 0.1)))
+        self.add_worker('bad', compared, 0)
+        self.add_worker('new', compared - 1, 0)
+        self.add_worker('rushed', timed=quality.WORKER_MIN_TIMED, rushed=quality.WORKER_MIN_TIMED)
+        quality.judge(['good', 'poor', 'bad', 'new', 'rushed'])
+        db.session.commit()
+        self.assertEqual([self.status(workerid) for workerid in ('good', 'poor', 'bad', 'new', 'rushed')],
+                         ['ok', 'rejected', 'blocked', 'ok', 'rejected'])
+        self.assertEqual(quality.workers_to_block(), ['bad'])
+
+    def test_status_only_gets_worse(self):
+        compared = quality.WORKER_MIN_COMPARED
+        self.add_worker('blocked', compared, compared, status='blocked')
+        self.add_worker('rejected', compared, 0, status='rejected')
+        quality.judge(['blocked', 'rejected'])
+        db.session.commit()
+        self.assertEqual(self.status('blocked'), 'blocked')
+        self.assertEqual(self.status('rejected'), 'blocked')
+
+    def test_rejected_workers_answers_are_excluded(self):
+        campaign = support.make_campaign()
+        term = campaign.terms[0]
+        yes, no = [option.id for option in campaign.options]
+        store_answers([('HIT1', [support.make_assignment('A1', 'bad', campaign, {term.term: 'no'}),
+                                 support.make_assignment('A2', 'good', campaign, {term.term: 'yes'})])])
+        self.assertEqual(dict((option, votes) for _, option, votes in campaign.get_tallies()), {yes: 1, no: 1})
+
+        compared = quality.WORKER_MIN_COMPARED
+        WorkerStats.query.filter_by(worker_id='bad').update({'compared': compared, 'agreed': 0})
+        db.session.commit()
+        self.assertEqual(quality.judge(['bad']), set([campaign.id]))
+        db.session.commit()
+        self.assertEqual(dict((option, votes) for _, option, votes in campaign.get_tallies()), {yes: 1, no: 0})
+        self.assertEqual([row.excluded for row in CampaignAnswer.query.filter_by(worker='bad')], [True])
+        self.assertEqual(quality.reviews([('HIT1', 'A1'), ('HIT1', 'A2')]), ['rejected', 'approved'])
+
+    def test_review_off(self):
+        quality.WORKER_REVIEW = False
+        self.add_worker('bad', quality.WORKER_MIN_COMPARED, 0)
+        self.assertEqual(quality.judge(['bad']), set())
+        self.assertEqual(self.status('bad'), 'ok')
+
+if __name__ == '__main__':
+    unittest.main()
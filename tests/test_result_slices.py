@@ -0,0 +1,90 @@
+"""
+Tests for paging through a campaign's results by term (get_result_slice
+and the campaign's results.json).
+"""
+import json
+import unittest
+
+import support
+
+from models import db, Campaign
+
+TERMS = ['apple', 'beef', 'carrot', 'dates', 'eggs', 'figs', 'gelatin']
+VOTES = {'apple': ['yes', 'yes', 'yes'],
+         'beef': ['no', 'no', 'yes'],
+         'carrot': ['yes', 'no'],
+         'eggs': ['yes', 'yes', 'no'],
+         'gelatin': ['no', 'no', 'no']}
+
+class ResultSliceTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+        campaign = support.make_campaign(terms=TERMS, threshold=60)
+        campaign.job_generated = True
+        db.session.commit()
+        support.answer_campaign(campaign, VOTES)
+        self.campaignid = campaign.id
+        self.client = support.app.test_client()
+
+    def campaign(self):
+        db.session.expire_all()
+        return Campaign.query.get(self.campaignid)
+
+    def walk(self, limit, outcome=None):
+        """
+        Every slice's (terms, answers), following each slice's next id.
+        """
+        slices = []
+        after = None
+        while True:
+            matrix, after = self.campaign().get_result_slice(after=after, limit=limit, outcome=outcome)
+            slices.append([(result.term, result.answer.option_text) for result in matrix])
+            if after is None:
+                return slices
+
+    def test_slices_join_up_to_the_whole_page(self):
+        whole = [(result.term, result.answer.option_text) for result in self.campaign().get_results()]
+        slices = self.walk(3)
+        self.assertEqual([len(terms) for terms in slices], [3, 3, 1])
+        self.assertEqual(sum(slices, []), whole)
+        self.assertEqual(self.walk(7), [whole])
+        self.assertEqual(self.walk(100), [whole])
+
+    def test_outcome_filters(self):
+        options = dict((option.option_text, option.id) for option in self.campaign().options)
+        self.assertEqual(sum(self.walk(2, 'decided'), []),
+                         [('apple', 'yes'), ('beef', 'no'), ('eggs', 'yes'), ('gelatin', 'no')])
+        self.assertEqual([term for term, answer in sum(self.walk(2, 'inconclusive'), [])],
+                         ['carrot', 'dates', 'figs'])
+        self.assertEqual([term for term, answer in sum(self.walk(1, options['no']), [])], ['beef', 'gelatin'])
+
+    def test_results_json(self):
+        url = '/campaigns/%s/results.json' % self.campaignid
+        terms = []
+        after = ''
+        while after is not None:
+            data = json.loads(self.client.get(url + '?limit=2&after=%s' % after).data)
+            self.assertTrue(len(data['results']) <= 2)
+            terms.extend(result['term'] for result in data['results'])
+            after = data['next']
+        self.assertEqual(terms, TERMS)
+
+        data = json.loads(self.client.get(url + '?outcome=decided&limit=1').data)
+        self.assertEqual([(result['term'], result['answer'], result['votes']) for result in data['results']],
+                         [('apple', 'yes', {'yes': 3, 'no': 0})])
+        self.assertTrue('apple' in data['html'])
+
+    def test_results_json_limits_and_etag(self):
+        url = '/campaigns/%s/results.json' % self.campaignid
+        self.assertEqual(len(json.loads(self.client.get(url + '?limit=0').data)['results']), 1)
+        self.assertEqual(len(json.loads(self.client.get(url + '?limit=100000').data)['results']), 7)
+        self.assertEqual(self.client.get(url + '?outcome=maybe').status_code, 400)
+
+        etag = self.client.get(url).headers['ETag']
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+        self.assertNotEqual(self.client.get(url + '?limit=3').headers['ETag'], etag)
+        support.answer_campaign(self.campaign(), {'dates': ['yes', 'yes']}, hitid='HIT2')
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 200)
+
+if __name__ == '__main__':
+    unittest.main()
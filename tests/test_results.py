@@ -0,0 +1,70 @@
+"""
+Tests for the numpy-backed ResultMatrix and the CampaignResult rows it
+hands out.
+"""
+import numpy
+import unittest
+
+import support
+
+from models import Campaign, ResultMatrix
+
+TERMS = [(10, 'apple'), (11, 'beef'), (12, 'carrot'), (13, 'dates')]
+OPTIONS = [(1, 'yes'), (2, 'no')]
+
+class ResultMatrixTest(unittest.TestCase):
+    def setUp(self):
+        # Three answers a term: 3-0, 1-2, a 2-1 that doesn't pass 66.67% and no answers
+        tallies = [(10, 1, 3), (11, 1, 1), (11, 2, 2), (12, 1, 2), (12, 2, 1), (99, 1, 5), (10, 7, 5)]
+        self.matrix = ResultMatrix.from_tallies(TERMS, OPTIONS, tallies, 3, threshold=66)
+
+    def test_from_tallies(self):
+        self.assertEqual(self.matrix.counts.tolist(), [[3, 0], [1, 2], [2, 1], [0, 0]])
+        self.assertEqual(self.matrix.percentages.tolist(), [[100, 0], [33, 66], [66, 33], [0, 0]])
+        self.assertEqual(self.matrix.winners.tolist(), [0, 1, 0, 0])
+        self.assertEqual(self.matrix.conclusive.tolist(), [True, False, False, False])
+
+    def test_inconclusive_at_another_threshold(self):
+        self.assertEqual(self.matrix.inconclusive().tolist(), [False, True, True, True])
+        self.assertEqual(self.matrix.inconclusive(50).tolist(), [False, False, False, True])
+
+    def test_rows(self):
+        self.assertEqual(len(self.matrix), 4)
+        results = list(self.matrix)
+        self.assertEqual([(result.termid, result.term) for result in results], TERMS)
+        self.assertEqual(results[0].answer.option_text, 'yes')
+        self.assertEqual(results[0].answer.percentage, 100)
+        self.assertEqual(results[1].answer.option_text, 'Inconclusive')
+        self.assertTrue(results[1].is_inconclusive())
+        self.assertFalse(results[1].is_inconclusive(50))
+        self.assertEqual([(item.option_text, item.times_selected, item.percentage) for item in results[2].results],
+                         [('yes', 2, 66), ('no', 1, 33)])
+        self.assertEqual(results[2].answer_breakdown(), "yes: 66% no: 33% ")
+        self.assertEqual(self.matrix[3].term, 'dates')
+        self.assertRaises(IndexError, lambda: self.matrix[4])
+
+    def test_no_options(self):
+        matrix = ResultMatrix(TERMS, [], numpy.zeros((4, 0), dtype=numpy.int32), 3)
+        self.assertEqual(matrix.conclusive.tolist(), [False] * 4)
+        self.assertEqual(matrix[0].answer.option_text, 'Inconclusive')
+
+class CampaignResultsTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+
+    def test_page_and_inconclusive_terms_agree(self):
+        campaign = support.make_campaign(terms=('apple', 'beef', 'carrot', 'dates'), times_per_term=4, threshold=50)
+        support.answer_campaign(campaign, {'apple': ['yes', 'yes', 'yes', 'no'],
+                                           'beef': ['yes', 'yes', 'no', 'no'],
+                                           'carrot': ['no', 'no', 'no']})
+        campaign = Campaign.query.get(campaign.id)
+        results = campaign.get_results()
+        self.assertEqual([(result.term, result.answer.option_text) for result in results],
+                         [('apple', 'yes'), ('beef', 'Inconclusive'), ('carrot', 'no'), ('dates', 'Inconclusive')])
+        self.assertEqual(campaign.get_inconclusive_terms(), ['beef', 'dates'])
+        self.assertEqual(campaign.get_inconclusive_terms(75), ['apple', 'beef', 'carrot', 'dates'])
+        self.assertEqual([result.term for result in results if result.is_inconclusive(75)],
+                         ['apple', 'beef', 'carrot', 'dates'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+Tests for filling in a new campaign's terms from the outcomes of earlier
+campaigns (reuse.py).
+"""
+import unittest
+
+import support
+
+from models import db, Campaign, CampaignTerm
+import reuse
+
+VOTES = {'apple': ['yes', 'yes', 'yes'],
+         'beef': ['no', 'no', 'yes'],
+         'carrot': ['yes', 'no']}
+
+def reused(campaignid):
+    """
+    {term: (answer, percentage)} for a campaign's reused terms.
+    """
+    campaign = Campaign.query.get(campaignid)
+    return dict((result.term, (result.answer.option_text, result.answer.percentage))
+                for result in campaign.get_results() if result.reused)
+
+class FingerprintTest(unittest.TestCase):
+    def test_normalized(self):
+        key = reuse.question_key(u'Is [term]  vegetarian?', [u'yes', u'no'])
+        self.assertEqual(key, reuse.question_key(u'is [term] Vegetarian?', [u'No', u'YES', u'yes']))
+        self.assertEqual(reuse.fingerprint(key, u' Apple  pie'), reuse.fingerprint(key, u'apple pie'))
+        self.assertNotEqual(reuse.fingerprint(key, u'apple'), reuse.fingerprint(key, u'apples'))
+        self.assertNotEqual(reuse.fingerprint(key, u'apple'),
+                            reuse.fingerprint(reuse.question_key(u'Is [term] vegan?', [u'yes', u'no']), u'apple'))
+
+class PrefillTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_database()
+        original = support.make_campaign(threshold=60)
+        support.answer_campaign(original, VOTES)
+        self.originalid = original.id
+
+    def make_campaign(self, terms=('Apple', 'beef', 'carrot', 'dates'), **kwargs):
+        kwargs.setdefault('reuse_results', True)
+        return support.make_campaign(terms=terms, **kwargs).id
+
+    def test_decided_terms_are_filled_in(self):
+        campaignid = self.make_campaign(threshold=60, options=('No', 'Yes'))
+        self.assertEqual(reused(campaignid), {'Apple': ('Yes', 100), 'beef': ('No', 66)})
+        campaign = Campaign.query.get(campaignid)
+        self.assertEqual(campaign.reused_count(), 2)
+        self.assertEqual(campaign.get_inconclusive_terms(), ['carrot', 'dates'])
+        # Two terms asked three times fit in one quiz of ten, four take two
+        self.assertEqual(campaign.cost(), 0.05)
+        self.assertEqual(campaign.savings(), 0.05)
+
+    def test_only_outcomes_above_the_new_threshold(self):
+        campaignid = self.make_campaign(threshold=70)
+        self.assertEqual(reused(campaignid), {'Apple': ('yes', 100)})
+
+    def test_not_reused(self):
+        self.assertEqual(reused(self.make_campaign(reuse_results=False)), {})
+        self.assertEqual(reused(self.make_campaign(options=('yes', 'no', 'maybe'))), {})
+
+    def test_reused_outcome_stands(self):
+        campaignid = self.make_campaign(threshold=60)
+        support.answer_campaign(Campaign.query.get(campaignid), {'Apple': ['no', 'no', 'no']}, hitid='HIT2')
+        self.assertEqual(reused(campaignid)['Apple'], ('yes', 100))
+        term = CampaignTerm.query.filter_by(campaign_id=campaignid, term='Apple').one()
+        self.assertEqual(term.reused_from,
+                         CampaignTerm.query.filter_by(campaign_id=self.originalid, term='apple').one().id)
+
+    def test_added_terms_are_filled_in(self):
+        campaignid = self.make_campaign(terms=('dates',), threshold=60)
+        response = support.app.test_client().post('/campaigns/%s/terms' % campaignid,
+                                                  data="apple\neggs\n", content_type='text/plain')
+        self.assertEqual(response.data, "Added 2 terms.\n")
+        self.assertEqual(reused(campaignid), {'apple': ('yes', 100)})
+
+    def test_clone_reuses_by_default(self):
+        client = support.app.test_client()
+        response = client.get('/campaigns/%s/clone' % self.originalid)
+        self.assertTrue('checked' in response.data)
+        form = {'title': 'clone', 'question': 'Is [term] vegetarian?', 'options': 'yes\nno',
+                'terms_per_quiz': '10', 'reward': '0.05', 'times_per_term': '3', 
+                'aggregation': 'majority', 'threshold': '60', 'reuse_results': 'y', 
+                'terms': 'apple\nbeef\ncarrot'}
+        self.assertEqual(client.post('/campaigns/%s/clone' % self.originalid, data=form).status_code, 302)
+        clone = Campaign.query.filter_by(title='clone').one()
+        self.assertEqual(sorted(reused(clone.id)), ['apple', 'beef'])
+
+if __name__ == '__main__':
+    unittest.main()
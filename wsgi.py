@@ -0,0 +1,12 @@
+"""
+Entry point for serving docsift with a production WSGI server, e.g.
+
+    gunicorn --workers 4 --threads 8 wsgi:application
+    uwsgi --http :5000 --processes 4 --threads 8 --module wsgi:application
+
+Bring the schema up to date first with "python manage.py migrate"; the
+application doesn't create any tables itself.
+"""
+from main import create_app
+
+application = create_app()